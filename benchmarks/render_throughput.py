@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Measures the throughput (issues and comments rendered per second) of the
+render stage of gh-issues-import.py on synthetic issues, both serially and
+with the pool of render workers used by --render-workers, and checks that
+both produce exactly the same output.
+
+No requests are made; run it from anywhere with e.g.:
+
+    python benchmarks/render_throughput.py --comments 100000 --workers 4
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import OrderedDict
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'gh-issues-import.py')
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('gh_issues_import', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that the render workers can find the module's functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_user(login):
+    return {'login': login, 'html_url': 'https://github.com/' + login,
+            'avatar_url': 'https://avatars.example.com/u/' + login}
+
+
+def make_issues(gh, num_issues, comments_per_issue, sources):
+    """
+    Returns an iterator over ``(orig_issue_id, orig_issue, comments)`` for the
+    given number of synthetic source issues and their comments.  The bodies
+    contain cross references both to issues being migrated and to others.
+    """
+
+    users = [make_user('user%d' % n) for n in range(50)]
+    comment_id = 0
+    for n in range(num_issues):
+        repo = sources[n % len(sources)]
+        number = n // len(sources) + 1
+        orig_issue = {
+            'repository': repo,
+            'number': number,
+            'title': 'Issue %d' % number,
+            'closed_at': None if n % 3 else '2020-01-02T03:04:05Z',
+            'user': users[n % len(users)],
+            'created_at': '2019-%02d-%02dT12:%02d:00Z' % (
+                n % 12 + 1, n % 28 + 1, n % 60),
+            'html_url': 'https://github.com/%s/issues/%d' % (repo, number),
+            'body': ('Issue %d in %s, see #%d and %s#%d; also unrelated/repo#%d'
+                     '\n\n' % (number, repo, max(1, number - 1), sources[0],
+                               number + 1, number)) * 4,
+            'comments': comments_per_issue,
+            'labels': [{'name': 'Bug Report', 'color': 'ff0000'}],
+            'milestone': None
+        }
+        orig_issue_id = gh.Issue(repo, number)
+
+        comments = []
+        for c in range(comments_per_issue):
+            comment_id += 1
+            comments.append({
+                'id': comment_id,
+                'user': users[(n + c) % len(users)],
+                'created_at': '2019-%02d-%02dT13:%02d:%02dZ' % (
+                    n % 12 + 1, n % 28 + 1, c % 60, n % 60),
+                'html_url': '%s#issuecomment-%d' % (orig_issue['html_url'],
+                                                    comment_id),
+                'body': 'Comment %d: fixed by #%d, duplicate of %s#%d.' % (
+                    c, number + c, sources[-1], number)
+            })
+        yield orig_issue_id, orig_issue, comments
+
+
+def render_serial(gh, issues, issue_map):
+    """
+    Render the issues as the import does without --render-workers: each new
+    issue's body is rendered by `make_new_issue`, and its comments as they are
+    posted.  Returns the rendered issues.
+    """
+
+    new_issues = []
+    for orig_issue_id, orig_issue, comments in issues:
+        new_issue = gh.make_new_issue(orig_issue_id, orig_issue, issue_map)
+        for comment in comments:
+            comment['rendered'] = gh.rendered_comment(
+                    comment, orig_issue_id.repository, issue_map)
+        new_issue['comments'] = comments
+        new_issues.append(new_issue)
+
+    return new_issues
+
+
+def render_parallel(gh, issues, issue_map, workers):
+    """
+    Render the issues as the import does with --render-workers: the new
+    issues are made without rendering them, then rendered along with their
+    comments by `render_new_issues`.  Returns the rendered issues.
+    """
+
+    new_issues = OrderedDict()
+    for orig_issue_id, orig_issue, comments in issues:
+        new_issue = gh.make_new_issue(orig_issue_id, orig_issue, issue_map,
+                                      render=False)
+        new_issue['comments'] = comments
+        new_issues[orig_issue_id] = new_issue
+
+    gh.render_new_issues(new_issues, issue_map, workers)
+    return list(new_issues.values())
+
+
+def digest(new_issues):
+    """
+    Returns the number of items (issues and comments) rendered and a hash of
+    everything rendered, in order.
+    """
+
+    h = hashlib.sha256()
+    items = 0
+    for new_issue in new_issues:
+        h.update(new_issue['body'].encode('utf-8'))
+        items += 1
+        for comment in new_issue.get('comments', []):
+            h.update(comment['rendered'].encode('utf-8'))
+            items += 1
+
+    return items, h.hexdigest()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=1000000,
+            help="Total number of comments to render (default: 1000000).")
+    parser.add_argument('--comments-per-issue', type=int, default=20,
+            help="Number of comments on each issue (default: 20).")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help="Number of render workers (default: the number of CPUs).")
+    args = parser.parse_args(argv)
+
+    gh = load_script()
+    sources = ['example/one', 'example/two']
+    gh.config['global'].update({
+        'sources': sources, 'target': 'example/target',
+        'create-backrefs': True, 'import-comments': False,
+        'import-labels': True, 'normalize-labels': True})
+
+    num_issues = max(1, args.comments // args.comments_per_issue)
+    issue_map = OrderedDict(
+            (gh.Issue(sources[n % len(sources)], n // len(sources) + 1),
+             gh.Issue('example/target', n + 1))
+            for n in range(num_issues))
+
+    # The synthetic issues are generated up front, so that only rendering
+    # them is timed
+    issues = list(make_issues(gh, num_issues, args.comments_per_issue,
+                              sources))
+    start = time.perf_counter()
+    rendered = render_serial(gh, issues, issue_map)
+    serial_time = time.perf_counter() - start
+    serial = digest(rendered)
+
+    # Rendering modifies the source issues, so render fresh ones in parallel
+    issues = list(make_issues(gh, num_issues, args.comments_per_issue,
+                              sources))
+    start = time.perf_counter()
+    rendered = render_parallel(gh, issues, issue_map, args.workers)
+    parallel_time = time.perf_counter() - start
+    parallel = digest(rendered)
+
+    items = serial[0]
+    print("Rendered %d issues with %d comments (%d items)" %
+          (num_issues, items - num_issues, items))
+    print("  serial:     %8.2fs  %10.0f items/s" %
+          (serial_time, items / serial_time))
+    print("  %2d workers: %8.2fs  %10.0f items/s  (%.2fx)" %
+          (args.workers, parallel_time, items / parallel_time,
+           serial_time / parallel_time))
+
+    if serial != parallel:
+        print("ERROR: the output of the render workers differs from the "
+              "serial output")
+        return 1
+
+    print("Output is identical")
+    return 0
+
+
+if __name__ == '__main__':
+    # The render workers rely on inheriting the loaded script
+    multiprocessing.set_start_method('fork')
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Replays recorded GitHub webhook payloads against the listener started with
+gh-issues-import.py --listen, as GitHub would deliver them.
+
+Each payload file is named after the event it was recorded from and its
+action, e.g. ``issues.opened.json`` or ``issue_comment.created.json``; the
+part before the first dot is sent as the ``X-GitHub-Event`` header.  Run it
+from anywhere with e.g.:
+
+    python examples/replay_webhooks.py http://localhost:8080/ \\
+        examples/webhooks/*.json --repo myorg/myrepo --issue 12
+
+Payloads are signed with ``--secret`` if the listener was started with
+--webhook-secret.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def load_payload(filename, repo=None, issue=None):
+    """
+    Returns the event and the encoded payload recorded in a file, pointed at
+    another source repository and/or issue number if given.
+    """
+
+    event = os.path.basename(filename).split('.', 1)[0]
+    with open(filename) as payload_file:
+        data = json.load(payload_file)
+
+    if repo is not None:
+        data['repository']['full_name'] = repo
+        data['repository']['name'] = repo.split('/')[-1]
+    if issue is not None:
+        data['issue']['number'] = issue
+
+    return event, json.dumps(data).encode('utf-8')
+
+
+def deliver(url, event, payload, secret=None):
+    """Post a payload to the listener, returning the response status."""
+
+    headers = {'Content-Type': 'application/json',
+               'User-Agent': 'GitHub-Hookshot/replay',
+               'X-GitHub-Event': event}
+    if secret:
+        digest = hmac.new(secret.encode('utf-8'), payload,
+                          hashlib.sha256).hexdigest()
+        headers['X-Hub-Signature-256'] = 'sha256=' + digest
+
+    request = urllib.request.Request(url, payload, headers, method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url', help='URL of the listener, e.g. '
+                        'http://localhost:8080/')
+    parser.add_argument('payloads', nargs='+', metavar='payload',
+                        help='Recorded payload files, delivered in order')
+    parser.add_argument('--repo', help='Source repository to deliver the '
+                        'payloads for, instead of the recorded one')
+    parser.add_argument('--issue', type=int, help='Issue number to deliver '
+                        'the payloads for, instead of the recorded one')
+    parser.add_argument('--secret', help='Webhook secret to sign the payloads '
+                        'with')
+    parser.add_argument('--interval', type=float, default=0, help='Seconds to '
+                        'wait between deliveries (default: 0, to test '
+                        'coalescing)')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for n, filename in enumerate(args.payloads):
+        if n and args.interval:
+            time.sleep(args.interval)
+
+        event, payload = load_payload(filename, args.repo, args.issue)
+        status = deliver(args.url, event, payload, args.secret)
+        print('%s: %s -> %d' % (filename, event, status))
+        if status >= 400:
+            failed += 1
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
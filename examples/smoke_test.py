@@ -0,0 +1,645 @@
+#!/usr/bin/env python
+"""
+Runs gh-issues-import.py end to end against an in-memory fake of the GitHub
+API, and checks that the imports made with retries of failed requests,
+hedged reads, the HTTP cache, the record and replay options, an on-disk
+working set with render workers, and a coordinator with workers all leave the
+repositories exactly as a plain import does.
+
+No requests are made over the network; run it from anywhere with e.g.:
+
+    python examples/smoke_test.py
+
+or with the names of the scenarios to run, e.g. ``retries cache``.  The
+output of the script is only shown for the scenarios that fail, unless
+``--verbose`` is given.
+"""
+
+import argparse
+import contextlib
+import copy
+import hashlib
+import http.client
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+
+from collections import Counter
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'gh-issues-import.py')
+
+CONFIG = """\
+[global]
+sources = src/a, src/b
+target = dst/t
+
+[login]
+username = smoke
+password = test
+"""
+
+# The repositories the fake API starts out with: the number of issues in
+# each, and the comments, labels and milestones on them
+REPOSITORIES = {
+    'src/a': {'issues': 12, 'comments': 3,
+              'labels': ['bug', 'Feature Request'], 'milestones': ['v1.0']},
+    'src/b': {'issues': 5, 'comments': 2},
+    'dst/t': {'issues': 2}
+}
+
+# The script as loaded for the current scenario, and the fake API it talks to
+gh = None
+github = None
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('gh_issues_import', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that the render workers can find the module's functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    # Confirm the import, keep the delays short, and read several pages of
+    # issues when verifying
+    module.yes_no = lambda question, default=True: True
+    module.RETRY_BASE_DELAY = 0.01
+    module.RETRY_MAX_DELAY = 0.05
+    module.HEDGE_MIN_SAMPLES = 5
+    module.WORK_DIR_POLL_INTERVAL = 0.05
+    module.VERIFY_PAGE_SIZE = 5
+    return module
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def make_user(login):
+    return {'login': login, 'html_url': 'https://github.com/' + login,
+            'avatar_url': 'https://avatars.example.com/u/' + login}
+
+
+class FakeGitHub:
+    """
+    The state of the repositories behind the fake API, and the handling of
+    the requests made to it.
+
+    Faults can be injected: ``fail_every`` fails every so many requests with
+    a 502 response, ``drop_every`` drops the response to every so many POST
+    and PATCH requests after they were carried out, and ``slow_every`` delays
+    the response to every so many GET requests by ``slow_delay`` seconds.
+    GET requests made while the same request is still being delayed are
+    counted as hedged.
+    """
+
+    def __init__(self, repositories):
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.next_comment_id = 1000
+        self.requests = Counter()
+        self.faults = Counter()
+        self.fail_every = self.drop_every = self.slow_every = 0
+        self.slow_delay = 0
+        self.delayed = Counter()
+
+        for index, (name, spec) in enumerate(repositories.items()):
+            repo = self.repos[name] = {'issues': {}, 'comments': {},
+                                       'labels': {}, 'milestones': {}}
+            for label in spec.get('labels', []):
+                self.add_label(name, {'name': label, 'color': 'aaaaaa'})
+            for title in spec.get('milestones', []):
+                self.add_milestone(name, {'title': title})
+
+            for n in range(spec['issues']):
+                # No two issues are created at the same time, so that they
+                # are imported in the same order every time
+                created = '2014-01-01T%02d:%02d:%02dZ' % (n // 60, n % 60,
+                                                          index)
+                issue = self.add_issue(name, {
+                    'title': '%s issue %d' % (name, n + 1),
+                    'body': 'Body of %d refers to #%d' % (n + 1, max(1, n)),
+                    'state': 'closed' if n % 3 == 2 else 'open'
+                }, make_user('user%d' % (n % 5)), created)
+                if n % 7 == 6:
+                    issue['pull_request'] = {'html_url': issue['html_url']}
+                if repo['labels']:
+                    labels = list(repo['labels'].values())
+                    issue['labels'] = [labels[n % len(labels)]]
+                if repo['milestones'] and n % 4 == 0:
+                    issue['milestone'] = repo['milestones'][1]
+
+                for c in range(spec.get('comments', 0) if n % 2 == 0 else 1):
+                    self.add_comment(name, issue['number'],
+                                     'Comment %d on #%d' % (c, n + 1),
+                                     make_user('user%d' % (c % 3)), created)
+
+    def add_issue(self, repo, data, user, created=None):
+        issues = self.repos[repo]['issues']
+        number = len(issues) + 1
+        html_url = 'https://github.com/%s/issues/%d' % (repo, number)
+        issue = issues[number] = {
+            'number': number, 'title': data['title'], 'body': '',
+            'state': 'open', 'user': user, 'labels': [], 'milestone': None,
+            'assignee': None, 'comments': 0, 'closed_at': None,
+            'created_at': created or now(), 'updated_at': created or now(),
+            'html_url': html_url, 'node_id': 'I_%s_%d' % (repo, number)
+        }
+        self.update_issue(repo, issue, data)
+        if created:
+            issue['updated_at'] = created
+        return issue
+
+    def update_issue(self, repo, issue, data):
+        labels = self.repos[repo]['labels']
+        milestones = self.repos[repo]['milestones']
+        for field in ('title', 'body'):
+            if field in data:
+                issue[field] = data[field]
+        if 'state' in data:
+            issue['state'] = data['state']
+            issue['closed_at'] = now() if data['state'] == 'closed' else None
+        if 'labels' in data:
+            issue['labels'] = [labels.get(name) or
+                               self.add_label(repo, {'name': name})
+                               for name in data['labels']]
+        if data.get('milestone') is not None:
+            issue['milestone'] = milestones[data['milestone']]
+        if data.get('assignee') is not None:
+            issue['assignee'] = make_user(data['assignee'])
+        issue['updated_at'] = now()
+
+    def add_comment(self, repo, number, body, user, created=None):
+        self.next_comment_id += 1
+        comment_id = self.next_comment_id
+        issue = self.repos[repo]['issues'][number]
+        comment = self.repos[repo]['comments'][comment_id] = {
+            'id': comment_id, 'body': body, 'user': user,
+            'created_at': created or now(), 'updated_at': created or now(),
+            'html_url': '%s#issuecomment-%d' % (issue['html_url'],
+                                                comment_id),
+            'issue_number': number, 'node_id': 'IC_%d' % comment_id
+        }
+        issue['comments'] += 1
+        return comment
+
+    def add_label(self, repo, data):
+        label = {'name': data['name'], 'color': data.get('color', 'ffffff')}
+        self.repos[repo]['labels'][data['name']] = label
+        return label
+
+    def add_milestone(self, repo, data):
+        milestones = self.repos[repo]['milestones']
+        number = len(milestones) + 1
+        milestone = milestones[number] = {
+            'number': number, 'title': data['title'], 'state': 'open',
+            'description': data.get('description'),
+            'due_on': data.get('due_on'),
+            'url': 'https://api.github.com/repos/%s/milestones/%d' % (repo,
+                                                                     number)
+        }
+        return milestone
+
+    def request(self, method, url, data=None, etag=None):
+        """
+        Handle a request, returning the status, headers and body of the
+        response; `None` is returned as the status if the response is
+        dropped.
+        """
+
+        with self.lock:
+            self.requests[method] += 1
+            count = sum(self.requests.values())
+            slow = (method == 'GET' and self.slow_every and
+                    self.requests['GET'] % self.slow_every == 0)
+            if method == 'GET' and self.delayed[url]:
+                self.faults['hedged'] += 1
+            if self.fail_every and count % self.fail_every == 0:
+                self.faults['failed'] += 1
+                return 502, {}, {'message': 'Server Error'}
+
+            try:
+                status, headers, body = self.route(method, url, data)
+            except (KeyError, ValueError) as error:
+                status, headers, body = 404, {}, {'message': 'Not Found: %s'
+                                                  % error}
+
+            body = copy.deepcopy(body)
+            if (method != 'GET' and self.drop_every and
+                    (self.requests['POST'] + self.requests['PATCH']) %
+                    self.drop_every == 0):
+                self.faults['dropped'] += 1
+                status = None
+
+            if slow:
+                self.faults['slowed'] += 1
+                self.delayed[url] += 1
+
+        if slow:
+            time.sleep(self.slow_delay)
+            with self.lock:
+                self.delayed[url] -= 1
+
+        headers['X-RateLimit-Remaining'] = '4000'
+        headers['X-RateLimit-Reset'] = str(int(time.time()) + 3600)
+        if status == 200 and method == 'GET':
+            headers['ETag'] = '"%s"' % hashlib.md5(
+                    json.dumps(body, sort_keys=True).encode()).hexdigest()
+            if headers['ETag'] == etag:
+                with self.lock:
+                    self.faults['not modified'] += 1
+                return 304, headers, None
+
+        return status, headers, body
+
+    def route(self, method, url, data):
+        parts = urllib.parse.urlparse(url)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        match = re.match(r'(?:/api/v3)?/repos/([^/]+/[^/]+)/(.*)$', parts.path)
+        if match is None:
+            return 404, {}, {'message': 'Not Found'}
+
+        repo = self.repos[match.group(1).lower()]
+        name, path = match.group(1).lower(), match.group(2)
+        if path == 'issues':
+            if method == 'POST':
+                return 201, {}, self.add_issue(name, data,
+                                               make_user('smoke'))
+
+            issues = sorted(repo['issues'].values(),
+                            key=lambda issue: issue['number'],
+                            reverse=query.get('direction') == 'desc')
+            if query.get('state', 'open') != 'all':
+                issues = [issue for issue in issues
+                          if issue['state'] == query.get('state', 'open')]
+            return self.page(url, issues, query)
+
+        match = re.match(r'issues/(\d+)$', path)
+        if match:
+            issue = repo['issues'][int(match.group(1))]
+            if method == 'PATCH':
+                self.update_issue(name, issue, data)
+            return 200, {}, issue
+
+        match = re.match(r'issues/(\d+)/comments$', path)
+        if match:
+            number = int(match.group(1))
+            if method == 'POST':
+                return 201, {}, self.add_comment(name, number, data['body'],
+                                                 make_user('smoke'))
+
+            comments = [comment for comment in repo['comments'].values()
+                        if comment['issue_number'] == number and
+                        comment['updated_at'] >= query.get('since', '')]
+            return self.page(url, comments, query)
+
+        match = re.match(r'issues/comments/(\d+)$', path)
+        if match:
+            comment = repo['comments'][int(match.group(1))]
+            if method == 'PATCH':
+                comment['body'] = data['body']
+                comment['updated_at'] = now()
+            return 200, {}, comment
+
+        if path == 'labels':
+            if method == 'POST':
+                if data['name'] in repo['labels']:
+                    return 422, {}, {'message': 'Validation Failed'}
+                return 201, {}, self.add_label(name, data)
+            return self.page(url, list(repo['labels'].values()), query)
+
+        if path.startswith('labels/'):
+            return 200, {}, repo['labels'][urllib.parse.unquote(path[7:])]
+
+        if path == 'milestones':
+            if method == 'POST':
+                return 201, {}, self.add_milestone(name, data)
+            return self.page(url, list(repo['milestones'].values()), query)
+
+        return 404, {}, {'message': 'Not Found'}
+
+    @staticmethod
+    def page(url, items, query):
+        """Returns a page of items, with a Link header to the next one."""
+
+        per_page = int(query.get('per_page', 30))
+        page = int(query.get('page', 1))
+        headers = {}
+        if page * per_page < len(items):
+            parts = urllib.parse.urlparse(url)
+            links = []
+            last = (len(items) + per_page - 1) // per_page
+            for rel, number in (('next', page + 1), ('last', last)):
+                query['page'] = number
+                links.append('<%s>; rel="%s"' % (parts._replace(
+                    query=urllib.parse.urlencode(query)).geturl(), rel))
+            headers['Link'] = ', '.join(links)
+
+        return 200, headers, items[(page - 1) * per_page:page * per_page]
+
+    def snapshot(self):
+        """
+        Returns the contents of the repositories, leaving out what differs
+        between imports (the times and the IDs of comments).
+        """
+
+        with self.lock:
+            return dict((name, {
+                'issues': [(issue['number'], issue['title'], issue['body'],
+                            issue['state'],
+                            sorted(label['name'] for label in issue['labels']),
+                            issue['milestone'] and issue['milestone']['title'],
+                            [comment['body'] for comment in
+                             repo['comments'].values()
+                             if comment['issue_number'] == issue['number']])
+                           for issue in repo['issues'].values()],
+                'labels': sorted(repo['labels']),
+                'milestones': sorted(milestone['title'] for milestone in
+                                     repo['milestones'].values())
+            }) for name, repo in self.repos.items())
+
+
+class FakeTransport:
+    """
+    A `Transport` (given with the transport option) that sends requests to
+    the fake API.
+    """
+
+    def __init__(self):
+        self.github = github
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        status, response_headers, body = self.github.request(
+                method, url, data, headers.get('If-None-Match'))
+        if status is None:
+            raise gh.TransportError('Connection reset by peer')
+
+        message = http.client.HTTPMessage()
+        for name, value in response_headers.items():
+            message[name] = value
+
+        response = gh.Response(status, message, body)
+        if status >= 400:
+            raise gh.HTTPStatusError(response)
+        return response
+
+    def close(self):
+        pass
+
+
+def async_transport():
+    """
+    Returns the `FakeTransport` as an `AsyncTransport` of the script as loaded
+    for the current scenario (for the transport option, instead of a class).
+    """
+
+    class AsyncFakeTransport(gh.AsyncTransport):
+        def __init__(self):
+            self.transport = FakeTransport()
+
+        async def request(self, method, url, headers, data=None,
+                          timeout=None):
+            return self.transport.request(method, url, headers, data, timeout)
+
+    return AsyncFakeTransport()
+
+
+def run(work_dir, *args):
+    """
+    Runs the script (loaded afresh) with the given arguments against the fake
+    API, and returns its exit status.
+    """
+
+    global gh
+
+    gh = load_script()
+    argv = ['--config', os.path.join(work_dir, 'config.ini'),
+            '--transport', '%s:FakeTransport' % __name__] + list(args)
+    try:
+        return gh.main(argv) or 0
+    except SystemExit as exc:
+        return exc.code or 0
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_import(work_dir, expected, *args):
+    """Run an import, and check that it gives the expected repositories."""
+
+    status = run(work_dir, '--all', *args)
+    check(status == 0, 'the import exited with %r' % (status,))
+
+    snapshot = github.snapshot()
+    for name, repo in expected.items():
+        for field, items in repo.items():
+            for n, item in enumerate(items):
+                found = snapshot[name][field][n:n + 1]
+                check(found == [item], '%s of %s differ from a plain import: '
+                      'expected %r, found %r' % (field, name, item,
+                                                 found[0] if found else None))
+            check(len(snapshot[name][field]) == len(items),
+                  '%s of %s differ from a plain import: expected %d, found '
+                  '%d' % (field, name, len(items),
+                          len(snapshot[name][field])))
+
+
+def plain(work_dir, expected):
+    """A plain import, which creates all the source issues in the target."""
+
+    check_import(work_dir, expected)
+    snapshot = github.snapshot()
+    num_issues = len(snapshot['dst/t']['issues'])
+    check(num_issues == 19, 'expected 19 issues in dst/t, found %d' %
+          num_issues)
+    check(all(re.match(r'\*Migrated to dst/t#', issue[2])
+              for name in ('src/a', 'src/b')
+              for issue in snapshot[name]['issues']),
+          'not all source issues have a backref')
+
+
+def retries(work_dir, expected):
+    """
+    An import during which requests fail, or are carried out but their
+    responses lost; no issues or comments should be created twice.
+    """
+
+    github.fail_every = 7
+    github.drop_every = 3
+    check_import(work_dir, expected, '--max-retries', '10')
+    check(github.faults['failed'] and github.faults['dropped'],
+          'no faults were injected')
+
+
+def hedging(work_dir, expected):
+    """An import with hedged reads, some of which are slow."""
+
+    github.slow_every = 5
+    github.slow_delay = 0.2
+    check_import(work_dir, expected, '--hedge-percentile', '50',
+                 '--read-deadline', '10')
+    check(github.faults['hedged'], 'no reads were hedged')
+
+
+def cache(work_dir, expected):
+    """
+    An import with the HTTP cache, then verifying it twice with the same
+    cache.
+    """
+
+    cache_file = os.path.join(work_dir, 'cache.db')
+    check_import(work_dir, expected, '--http-cache', cache_file)
+    # The second time round the responses are all revalidated
+    for n in range(2):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = run(work_dir, '--verify', '--http-cache', cache_file)
+        print(output.getvalue(), end='')
+        check(status == 0 and 'Verified 17 migrated issues: 0 mismatched' in
+              output.getvalue(), 'verifying exited with %r, or did not '
+              'verify all the migrated issues' % (status,))
+    check(github.faults['not modified'],
+          'no cached responses were revalidated')
+
+
+def record(work_dir, expected):
+    """
+    An import recorded through an asynchronous transport, then replaying it.
+    """
+
+    global github
+
+    recording = os.path.join(work_dir, 'recording.jsonl')
+    check_import(work_dir, expected, '--record', recording, '--transport',
+                 '%s:async_transport' % __name__)
+
+    # Replaying the recording doesn't touch the repositories at all
+    github = FakeGitHub(REPOSITORIES)
+    before = github.snapshot()
+    status = run(work_dir, '--all', '--replay', recording,
+                 '--replay-latency', '0')
+    check(status == 0, 'the replayed import exited with %r' % (status,))
+    check(gh.transport.count == gh.transport.recorded,
+          'replayed %d of %d recorded requests' % (gh.transport.count,
+                                                   gh.transport.recorded))
+    check(github.snapshot() == before and not github.requests,
+          'the replayed import made requests')
+
+
+def working_set(work_dir, expected):
+    """An import with its working sets on disk, and render workers."""
+
+    check_import(work_dir, expected, '--working-set',
+                 os.path.join(work_dir, 'working-set.db'),
+                 '--render-workers', '2')
+
+
+def work(work_dir, coordinate_dir):
+    """Run a worker of a distributed import, in a separate process."""
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            sys.exit(run(work_dir, '--worker', coordinate_dir))
+
+
+def distributed(work_dir, expected):
+    """
+    A distributed import, with two workers started before the coordinator.
+    """
+
+    coordinate_dir = os.path.join(work_dir, 'coordinate')
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=work, args=(work_dir, coordinate_dir))
+               for n in range(2)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        check_import(work_dir, expected, '--coordinate', coordinate_dir)
+    finally:
+        for worker in workers:
+            worker.join(10)
+            if worker.exitcode is None:
+                worker.terminate()
+
+    check(all(worker.exitcode == 0 for worker in workers),
+          'workers exited with %s' % [worker.exitcode for worker in workers])
+
+
+SCENARIOS = [plain, retries, hedging, cache, record, working_set, distributed]
+
+
+def main(argv):
+    global github
+
+    names = [scenario.__name__.replace('_', '-') for scenario in SCENARIOS]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='Scenarios to run, of: %s (default: all)' %
+                        ', '.join(names))
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the script's output")
+    args = parser.parse_args(argv)
+
+    for name in args.scenarios:
+        if name not in names:
+            parser.error("unknown scenario '%s'" % name)
+
+    # The repositories after a plain import, as every scenario should leave
+    # them
+    github = FakeGitHub(REPOSITORIES)
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.path.join(work_dir, 'config.ini'), 'w') as f:
+            f.write(CONFIG)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(work_dir, '--all')
+    expected = github.snapshot()
+
+    failed = 0
+    for name, scenario in zip(names, SCENARIOS):
+        if args.scenarios and name not in args.scenarios:
+            continue
+
+        github = FakeGitHub(REPOSITORIES)
+        output = io.StringIO()
+        start = time.monotonic()
+        with tempfile.TemporaryDirectory() as work_dir:
+            with open(os.path.join(work_dir, 'config.ini'), 'w') as f:
+                f.write(CONFIG)
+
+            try:
+                if args.verbose:
+                    scenario(work_dir, expected)
+                else:
+                    with contextlib.redirect_stdout(output):
+                        scenario(work_dir, expected)
+            except Exception:
+                failed += 1
+                print(output.getvalue(), end='')
+                traceback.print_exc()
+                print('%s: FAIL' % name)
+                continue
+
+        print('%s: PASS (%d requests, %s, in %.1f seconds)' % (
+            name, sum(github.requests.values()),
+            ', '.join('%d %s' % (count, fault) for fault, count in
+                      sorted(github.faults.items())) or 'no faults',
+            time.monotonic() - start))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,21 +1,48 @@
 #!/usr/bin/env python3
 
+import _thread
 import argparse
+import asyncio
+import atexit
 import base64
+import bisect
+import concurrent.futures
 import configparser
+import contextlib
+import cProfile
+import functools
 import getpass
+import hashlib
+import hmac
+import http.client
+import http.server
+import importlib
 import json
 import os
+import queue
+import random
 import re
+import signal
+import sqlite3
 import sys
+import threading
+import time
+import tracemalloc
 import urllib.request
 import urllib.error
 import urllib.parse
 
-from collections import defaultdict, OrderedDict, namedtuple
+from collections import defaultdict, deque, OrderedDict, namedtuple
+from collections.abc import MutableMapping
 from datetime import datetime
 from string import Template
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(),
                                 os.path.dirname(__file__)))
@@ -44,12 +71,487 @@ class state:
     LOADING_CONFIG       = "loading-config"
     FETCHING_ISSUES      = "fetching-issues"
     GENERATING           = "generating"
+    RENDERING            = "rendering"
     IMPORT_CONFIRMATION  = "import-confirmation"
     IMPORTING            = "importing"
     IMPORT_COMPLETE      = "import-complete"
+    VERIFYING            = "verifying"
     COMPLETE             = "script-complete"
 
 state.current = state.INITIALIZING
+# Time (from time.perf_counter) at which the current state was entered
+state.started = time.perf_counter()
+
+
+class Tracer:
+    """
+    Records timed spans of the stages of the import, and of work on individual
+    issues and requests within them, to be saved as a trace in the Chrome
+    trace event format (as loaded by chrome://tracing or Perfetto).
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, end, args=None):
+        """Record a span that lasted from ``start`` to ``end``."""
+
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = len(self.threads) + 1
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                    'tid': self.threads[thread.ident],
+                    'args': {'name': thread.name}})
+
+            self.events.append({
+                'name': name, 'cat': category, 'ph': 'X',
+                'ts': max(0, start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6, 'pid': os.getpid(),
+                'tid': self.threads[thread.ident], 'args': args or {}})
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter(), args)
+
+    def save(self, filename):
+        with self.lock:
+            with open(filename, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f)
+
+
+# The Tracer, if the trace option is given, and the profiler for the current
+# stage, if the profile option is given
+tracer = None
+stage_profiler = None
+
+
+def set_state(new_state):
+    """
+    Transition to a new stage of the import, closing the trace span and
+    saving the profile (if enabled) of the previous stage.
+    """
+
+    global stage_profiler
+
+    now = time.perf_counter()
+    if tracer is not None:
+        tracer.add(state.current, 'stage', state.started, now)
+
+    if stage_profiler is not None:
+        stage_profiler.disable()
+        stage_profiler.dump_stats(os.path.join(
+                config['global']['profile'], state.current + '.prof'))
+        stage_profiler = None
+
+    memory.stage_done(state.current)
+
+    state.current = new_state
+    state.started = now
+
+    if config['global'].get('profile') and new_state != state.COMPLETE:
+        stage_profiler = cProfile.Profile()
+        stage_profiler.enable()
+
+
+class Progress:
+    """
+    Keeps track of the progress of the import: the number of issues and
+    comments imported so far out of those planned, the rate of requests, and
+    the time spent waiting to retry requests (including waiting for rate
+    limits to reset).
+
+    Once started, progress is reported periodically in the background while
+    importing, both on the terminal and, if the status-file option is given,
+    by rewriting the status file.
+    """
+
+    # Window (in seconds) over which the request rate is measured
+    rate_window = 60
+
+    def __init__(self):
+        self.started = time.time()
+        self.import_started = None
+        self.planned_issues = 0
+        self.planned_comments = 0
+        self.issues_done = 0
+        self.comments_done = 0
+        self.requests = 0
+        self.recent_requests = deque()
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def plan(self, issues, comments):
+        with self.lock:
+            self.import_started = time.time()
+            self.planned_issues = issues
+            self.planned_comments = comments
+
+    def request(self):
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.recent_requests.append(now)
+            while self.recent_requests[0] < now - self.rate_window:
+                self.recent_requests.popleft()
+
+    def throttle(self, seconds):
+        with self.lock:
+            self.throttled += seconds
+
+    def issue_done(self):
+        with self.lock:
+            self.issues_done += 1
+
+    def comment_done(self):
+        with self.lock:
+            self.comments_done += 1
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            while (self.recent_requests and
+                    self.recent_requests[0] < now - self.rate_window):
+                self.recent_requests.popleft()
+
+            window = min(self.rate_window, now - self.started) or 1
+            status = {
+                'state': state.current,
+                'elapsed': round(now - self.started, 1),
+                'issues_done': self.issues_done,
+                'issues_planned': self.planned_issues,
+                'comments_done': self.comments_done,
+                'comments_planned': self.planned_comments,
+                'requests': self.requests,
+                'requests_per_second': round(len(self.recent_requests) /
+                                             window, 2),
+                'throttled_seconds': round(self.throttled, 1),
+                'eta_seconds': None,
+                'updated_at': time.strftime(ISO_8601_UTC, time.gmtime(now))
+            }
+
+            # Estimate the time remaining from the rate at which issues and
+            # comments have been imported so far, counting each as one unit
+            # of work (each is one request to create it, and one to add its
+            # backref)
+            done = self.issues_done + self.comments_done
+            planned = self.planned_issues + self.planned_comments
+            if self.import_started is not None and done:
+                rate = done / (now - self.import_started)
+                status['eta_seconds'] = round((planned - done) / rate, 1)
+
+        return status
+
+    def report(self):
+        status = self.status()
+
+        if state.current == state.IMPORTING and (status['issues_planned'] or
+                                                 status['comments_planned']):
+            eta = status['eta_seconds']
+            print("Progress: %d/%d issues, %d/%d comments; %.1f requests/s, "
+                  "%ds waiting on retries/rate limits; ETA %s" %
+                  (status['issues_done'], status['issues_planned'],
+                   status['comments_done'], status['comments_planned'],
+                   status['requests_per_second'], status['throttled_seconds'],
+                   'unknown' if eta is None else
+                   time.strftime('%H:%M:%S', time.gmtime(eta))))
+
+        filename = config['global'].get('status-file')
+        if filename:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(status, f, indent=2)
+
+            os.replace(filename + '.tmp', filename)
+
+    def start(self):
+        """Start reporting progress in the background."""
+
+        interval = float(config['global'].get('progress-interval') or 10)
+
+        def reporter():
+            while not self.stopped.wait(interval):
+                self.report()
+
+        threading.Thread(target=reporter, daemon=True).start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            if config['global'].get('status-file'):
+                self.report()
+
+
+progress = Progress()
+
+
+def current_rss():
+    """
+    Returns the resident set size of the process in bytes, or its peak so far
+    where the current size is not known; `None` if neither is.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process so far in bytes, or
+    `None` if it is not known.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def deep_sizeof(obj):
+    """
+    Estimate the memory used by a record as decoded from JSON (nested dicts
+    and lists of strings, numbers and so on), counting each object once.
+    """
+
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+
+    return size
+
+
+def format_bytes(size):
+    if size is None:
+        return 'unknown'
+
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+
+    return '%.1f GB' % size
+
+
+class MemoryAccounting:
+    """
+    Keeps track of the memory used by each stage of the import: the resident
+    set size of the process (and its peak) at the end of each stage, and with
+    the memory-report option the memory traced by tracemalloc (and its peak
+    during the stage) and the sites with the most memory allocated at the end
+    of it.  The size in memory of fetched issues and comments is estimated
+    from a sample of them.
+
+    With the max-memory option, the resident set size is checked in the
+    background, and the import is interrupted if it exceeds the maximum (see
+    `abort`).
+    """
+
+    # Number of allocation sites reported for each stage
+    top_sites = 5
+
+    # The first records of each kind are all measured, and after that only a
+    # sample of them
+    sample_first = 1000
+    sample_every = 100
+
+    # How often (in seconds) to check the memory use with max-memory
+    check_interval = 0.5
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = []
+        # For each kind of record, the number seen, the number measured and
+        # their total size
+        self.records = defaultdict(lambda: [0, 0, 0])
+        self.max_memory = None
+        self.exceeded = None
+        self.reported = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        if config['global'].get('memory-report'):
+            tracemalloc.start()
+            atexit.register(self.report)
+
+        max_memory = config['global'].get('max-memory')
+        if max_memory:
+            self.max_memory = float(max_memory) * 1024 * 1024
+            threading.Thread(target=self.monitor, name='memory monitor',
+                             daemon=True).start()
+            atexit.register(self.stopped.set)
+
+        self.enabled = (tracemalloc.is_tracing() or
+                        self.max_memory is not None)
+
+    def measure(self, stage):
+        """Returns the memory use for the given stage, as of now."""
+
+        usage = {'stage': stage, 'rss': current_rss(), 'rss_peak': peak_rss()}
+        if tracemalloc.is_tracing():
+            usage['traced'], usage['traced_peak'] = \
+                    tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__)])
+            usage['top_sites'] = [
+                    (str(stat.traceback[0]), stat.size, stat.count)
+                    for stat in snapshot.statistics('lineno')[:self.top_sites]]
+
+        return usage
+
+    def stage_done(self, stage):
+        if not self.enabled:
+            return
+
+        usage = self.measure(stage)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        with self.lock:
+            self.stages.append(usage)
+
+    def record(self, kind, record):
+        """Account for a fetched record (an issue or comment) of some kind."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            counts = self.records[kind]
+            counts[0] += 1
+            seen = counts[0]
+
+        if seen <= self.sample_first or seen % self.sample_every == 0:
+            size = deep_sizeof(record)
+            with self.lock:
+                counts[1] += 1
+                counts[2] += size
+
+    def monitor(self):
+        while True:
+            rss = current_rss()
+            if rss is not None and rss > self.max_memory:
+                self.exceeded = rss
+                # Interrupt the main thread, even if it is blocked waiting
+                if hasattr(signal, 'pthread_kill'):
+                    signal.pthread_kill(threading.main_thread().ident,
+                                        signal.SIGINT)
+                else:
+                    _thread.interrupt_main()
+                return
+
+            if self.stopped.wait(self.check_interval):
+                return
+
+    def report(self):
+        if self.reported or not self.enabled:
+            return
+
+        self.reported = True
+        with self.lock:
+            stages = list(self.stages)
+            records = dict(self.records)
+
+        if state.current != state.COMPLETE:
+            stages.append(self.measure(state.current + ' (unfinished)'))
+
+        print("Memory use by stage:")
+        for usage in stages:
+            line = "  %-32s RSS %s (peak %s)" % (
+                    usage['stage'], format_bytes(usage['rss']),
+                    format_bytes(usage['rss_peak']))
+            if 'traced' in usage:
+                line += "; traced %s (peak %s)" % (
+                        format_bytes(usage['traced']),
+                        format_bytes(usage['traced_peak']))
+            print(line)
+            for site, size, count in usage.get('top_sites', []):
+                print("      %10s in %7d blocks: %s" %
+                      (format_bytes(size), count, site))
+
+        if records:
+            print("Estimated size of records in memory:")
+        for kind, (seen, measured, total) in sorted(records.items()):
+            average = total / measured if measured else 0
+            print("  %-10s %8d records, ~%s each (~%s in total)" %
+                  (kind, seen, format_bytes(average),
+                   format_bytes(average * seen)))
+
+    def abort(self):
+        """
+        Report the memory use and exit, once the main thread was interrupted
+        for exceeding max-memory.
+        """
+
+        self.report()
+        sys.exit("ERROR: Aborted in stage '%s': the memory in use (%s) "
+                 "exceeded the maximum of %s" %
+                 (state.current, format_bytes(self.exceeded),
+                  format_bytes(self.max_memory)))
+
+
+memory = MemoryAccounting()
+
+
+def trace_span(name, category='issue', **args):
+    """
+    Returns a context manager recording a span in the trace, if tracing is
+    enabled (and doing nothing otherwise).
+    """
+
+    if tracer is None:
+        return contextlib.nullcontext()
+
+    return tracer.span(name, category, args)
+
+
+def start_tracing():
+    """
+    Enable tracing and profiling if the trace and profile options are given.
+    """
+
+    global tracer
+
+    filename = config['global'].get('trace')
+    if filename:
+        tracer = Tracer()
+        atexit.register(tracer.save, filename)
+
+    profile_dir = config['global'].get('profile')
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+# Fingerprints of migrated source issues as of when they were last migrated or
+# updated, keyed on fingerprint_key; see issue_fingerprint
+fingerprints = {}
 
 
 HTTP_ERROR_MESSAGES = {
@@ -65,13 +567,95 @@ HTTP_ERROR_MESSAGES = {
 # Basically the same problem. GitHub returns 403 instead to prevent abuse.
 HTTP_ERROR_MESSAGES[403] = HTTP_ERROR_MESSAGES[401]
 
+# Base and maximum delay (in seconds) between retries of failed requests
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+# Number of successful reads from a server that must have been observed before
+# reads to it are hedged, and the number of latencies remembered per server
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 500
+
+# The rate limit assumed for credentials until a response tells us otherwise
+DEFAULT_RATE_LIMIT = 5000
+
+# Maximum number of updates sent in a single GraphQL request when batching
+# updates to the source repositories
+GRAPHQL_BATCH_SIZE = 50
+
+# Fields requested for issues updated with GraphQL, from which a REST-like
+# issue is reconstructed (see graphql_issue_to_rest)
+GRAPHQL_ISSUE_FIELDS = ('updatedAt title state comments { totalCount } '
+                        'labels(first: 100) { nodes { name } } '
+                        'milestone { title } '
+                        'assignees(first: 1) { nodes { login } }')
+
+# Options filtering which issues are selected from the source repositories,
+# mapped to the equivalent parameters of the issues list API; selecting issues
+# with any of the other filters requires using the search API instead
+ISSUE_FILTER_OPTS = ('filter-labels', 'filter-milestone', 'filter-creator',
+                     'created-since', 'created-before', 'updated-since',
+                     'updated-before', 'issue-type')
+LIST_API_FILTERS = {'filter-labels': 'labels', 'filter-creator': 'creator',
+                    'updated-since': 'since'}
+
+# The search API returns at most this many results for any one query
+SEARCH_RESULT_LIMIT = 1000
+
+# Maximum number of fetched issues waiting to be added to the working set
+FETCH_QUEUE_SIZE = 1000
+
+# With --pipeline, the number of new issues whose comments may be fetched ahead
+# of the issue being created
+PIPELINE_DEPTH = 20
+
+# With --render-workers, the number of new issues (with their comments) in each
+# batch sent to a render worker, and the number of batches queued per worker
+RENDER_BATCH_SIZE = 50
+RENDER_QUEUE_DEPTH = 2
+
+# Fields of a source issue needed to render the body of its new issue (see
+# make_new_issue)
+RENDER_FIELDS = ('repository', 'user', 'created_at', 'html_url', 'body',
+                 'comments', 'pull_request')
+
+# With --coordinate, the number of issues in each batch claimed by a worker,
+# and how often (in seconds) workers and the coordinator check for new files
+# in the shared directory
+SHARD_SIZE = 20
+WORK_DIR_POLL_INTERVAL = 0.5
+
+# With --coordinate, how long (in seconds) a worker may make no progress on a
+# batch it claimed before the batch is put back for another worker
+SHARD_CLAIM_TIMEOUT = 600
+
+# With --verify, the number of pages of issues fetched concurrently, and the
+# number of issues per page
+VERIFY_WORKERS = 8
+VERIFY_PAGE_SIZE = 100
+
+# The maximum length of the body of an issue or comment accepted by GitHub
+MAX_BODY_LENGTH = 65536
+
+# Closed issues are migrated as open issues with this prefix to their title
+CLOSED_TITLE_PREFIX = '[CLOSED] '
+
+# With --collapse-comments, marks each comment in the body of a migrated issue
+# or comment with the original comment it was migrated from
+COLLAPSED_COMMENT_MARKER = '<!-- migrated-comment: %s#%s -->'
+COLLAPSED_COMMENT_RE = re.compile(r'<!-- migrated-comment: (\S+)#(\d+) -->')
+COLLAPSED_COMMENT_SEPARATOR = '\n\n----\n\n'
+
 
 # Maps command-line options to their associated config file options (if any)
 CONFIG_MAP = {
     'username': {'section': 'login', 'option': 'username'},
     'password': {'section': 'login', 'option': 'password'},
+    'token': {'section': 'login', 'option': 'token'},
+    'read_tokens': {'section': 'login', 'option': 'read-tokens',
+                    'multiple': True},
     'sources': {'section': 'global', 'option': 'sources', 'multiple': True},
-    'target': {'section': 'global', 'option': 'target'},
+    'target': {'section': 'global', 'option': 'target', 'multiple': True},
     'update_existing': {'section': 'global', 'option': 'update-existing'},
     'ignore_comments': {'section': 'global', 'option': 'import-comments',
                         'negate': True},
@@ -84,13 +668,56 @@ CONFIG_MAP = {
     'no_backrefs': {'section': 'global', 'option': 'create-backrefs',
                     'negate': True},
     'close_issues': {'section': 'global', 'option': 'close-issues'},
+    'collapse_comments': {'section': 'global',
+                          'option': 'collapse-comments'},
+    'pipeline': {'section': 'global', 'option': 'pipeline'},
+    'render_workers': {'section': 'global', 'option': 'render-workers'},
     'import_issues': {'section': 'global', 'option': 'import-issues',
                       'multiple': True},
     'normalize_labels': {'section': 'global', 'option': 'normalize-labels'},
     'issue_template': {'section': 'format', 'option': 'issue-template'},
     'comment_template': {'section': 'format', 'option': 'comment-template'},
     'pull_request_template': {'section': 'format',
-                              'option': 'comment-template'}
+                              'option': 'comment-template'},
+    'listen': {'section': 'global', 'option': 'listen'},
+    'verify': {'section': 'global', 'option': 'verify'},
+    'coordinate': {'section': 'global', 'option': 'coordinate'},
+    'worker': {'section': 'global', 'option': 'worker'},
+    'webhook_secret': {'section': 'global', 'option': 'webhook-secret'},
+    'coalesce_delay': {'section': 'global', 'option': 'coalesce-delay'},
+    'working_set': {'section': 'global', 'option': 'working-set'},
+    'timeout': {'section': 'global', 'option': 'request-timeout'},
+    'max_retries': {'section': 'global', 'option': 'max-retries'},
+    'read_deadline': {'section': 'global', 'option': 'read-deadline'},
+    'hedge_percentile': {'section': 'global', 'option': 'hedge-percentile'},
+    'fingerprints': {'section': 'global', 'option': 'fingerprints'},
+    'batch_source_updates': {'section': 'global',
+                             'option': 'batch-source-updates'},
+    'trace': {'section': 'global', 'option': 'trace'},
+    'profile': {'section': 'global', 'option': 'profile'},
+    'status_file': {'section': 'global', 'option': 'status-file'},
+    'progress_interval': {'section': 'global', 'option': 'progress-interval'},
+    'memory_report': {'section': 'global', 'option': 'memory-report'},
+    'max_memory': {'section': 'global', 'option': 'max-memory'},
+    'filter_labels': {'section': 'global', 'option': 'filter-labels',
+                      'multiple': True},
+    'filter_milestone': {'section': 'global', 'option': 'filter-milestone'},
+    'filter_creator': {'section': 'global', 'option': 'filter-creator'},
+    'created_since': {'section': 'global', 'option': 'created-since'},
+    'created_before': {'section': 'global', 'option': 'created-before'},
+    'updated_since': {'section': 'global', 'option': 'updated-since'},
+    'updated_before': {'section': 'global', 'option': 'updated-before'},
+    'issue_type': {'section': 'global', 'option': 'issue-type'},
+    'select': {'section': 'global', 'option': 'select'},
+    'snapshot': {'section': 'global', 'option': 'snapshot'},
+    'http_cache': {'section': 'global', 'option': 'http-cache'},
+    'http_cache_size': {'section': 'global', 'option': 'http-cache-size'},
+    'http_cache_ttl': {'section': 'global', 'option': 'http-cache-ttl',
+                       'multiple': True},
+    'record': {'section': 'global', 'option': 'record'},
+    'replay': {'section': 'global', 'option': 'replay'},
+    'replay_latency': {'section': 'global', 'option': 'replay-latency'},
+    'transport': {'section': 'global', 'option': 'transport'}
 }
 
 
@@ -98,7 +725,9 @@ CONFIG_MAP = {
 # can either be in the global section, or in per-repository sections
 BOOLEAN_OPTS = set(['import-comments',  'import-milestone', 'import-labels',
                     'import-assignee', 'create-backrefs', 'close-issues',
-                    'normalize-labels', 'update-existing'])
+                    'normalize-labels', 'update-existing',
+                    'batch-source-updates', 'collapse-comments',
+                    'pipeline', 'memory-report'])
 
 class Issue(namedtuple('Issue', ('repository', 'number'))):
     """
@@ -111,6 +740,169 @@ class Issue(namedtuple('Issue', ('repository', 'number'))):
         return '%s#%s' % self
 
 
+class DiskDict(MutableMapping):
+    """
+    An ordered mapping stored in a table of an SQLite database, used to spill
+    the import's working sets to disk (see the --working-set option).
+
+    Keys and values are stored as JSON; since JSON has no notion of tuples,
+    ``key_type`` and ``value_type`` can be given to convert keys and values
+    back into (named)tuples such as `Issue` when they are read.  Values read
+    from the mapping are always fresh copies, so any modifications to them
+    must be written back explicitly.
+
+    Items are iterated in insertion order, unless ``sort_key`` is given, in
+    which case they are iterated in the order of the string ``sort_key(value)``
+    (ties broken by insertion order).  Replacing the value of an existing key
+    retains its original position.
+    """
+
+    # Number of rows read per query while iterating
+    page_size = 1000
+
+    connections = {}
+    lock = threading.RLock()
+
+    def __init__(self, filename, table, key_type=None, value_type=None,
+                 sort_key=None):
+        self.table = table
+        self.key_type = key_type
+        self.value_type = value_type
+        self.sort_key = sort_key
+
+        with self.lock:
+            if filename not in self.connections:
+                conn = sqlite3.connect(filename, isolation_level=None,
+                                       check_same_thread=False)
+                # This is scratch storage for a single run; there is no point
+                # in paying for durability
+                conn.execute('PRAGMA synchronous = OFF')
+                conn.execute('PRAGMA journal_mode = MEMORY')
+                self.connections[filename] = conn
+
+            self.conn = self.connections[filename]
+            self.conn.execute('DROP TABLE IF EXISTS "%s"' % table)
+            self.conn.execute(
+                'CREATE TABLE "%s" (seq INTEGER PRIMARY KEY, '
+                'key TEXT UNIQUE NOT NULL, sort TEXT NOT NULL, '
+                'value TEXT NOT NULL)' % table)
+            self.conn.execute('CREATE INDEX "%s_sort" ON "%s" (sort, seq)' %
+                              (table, table))
+
+    def _encode_key(self, key):
+        return json.dumps(key)
+
+    def _decode_key(self, data):
+        key = json.loads(data)
+        return self.key_type(*key) if self.key_type else key
+
+    def _decode_value(self, data):
+        value = json.loads(data)
+        return self.value_type(*value) if self.value_type else value
+
+    def _query(self, sql, *params):
+        with self.lock:
+            return self.conn.execute(sql % self.table, params).fetchall()
+
+    def __getitem__(self, key):
+        rows = self._query('SELECT value FROM "%s" WHERE key = ?',
+                           self._encode_key(key))
+        if not rows:
+            raise KeyError(key)
+        return self._decode_value(rows[0][0])
+
+    def __setitem__(self, key, value):
+        sort = self.sort_key(value) if self.sort_key else ''
+        self._query('INSERT INTO "%s" (key, sort, value) VALUES (?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET sort = excluded.sort, '
+                    'value = excluded.value',
+                    self._encode_key(key), sort, json.dumps(value))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._query('DELETE FROM "%s" WHERE key = ?', self._encode_key(key))
+
+    def __contains__(self, key):
+        return bool(self._query('SELECT 1 FROM "%s" WHERE key = ?',
+                                self._encode_key(key)))
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM "%s"')[0][0]
+
+    def _iter_rows(self):
+        # Rows are read a page at a time (rather than through one long-lived
+        # cursor) so that the mapping may be modified while iterating over it
+        last = ('', -1)
+        while True:
+            rows = self._query('SELECT sort, seq, key, value FROM "%s" '
+                               'WHERE (sort, seq) > (?, ?) '
+                               'ORDER BY sort, seq LIMIT ' +
+                               str(self.page_size), *last)
+            for row in rows:
+                yield row
+
+            if len(rows) < self.page_size:
+                break
+
+            last = rows[-1][:2]
+
+    def __iter__(self):
+        for _, _, key, _ in self._iter_rows():
+            yield self._decode_key(key)
+
+    def items(self):
+        for _, _, key, value in self._iter_rows():
+            yield self._decode_key(key), self._decode_value(value)
+
+    def values(self):
+        for _, _, _, value in self._iter_rows():
+            yield self._decode_value(value)
+
+
+def new_working_set(name, key_type=None, value_type=None, sort_key=None):
+    """
+    Returns a new, empty mapping for one of the import's working sets.
+
+    This is an `OrderedDict` by default, or a `DiskDict` table named ``name``
+    if the working-set option is set.  Code using working sets should work
+    with either, which in particular means writing back any changes made to
+    the values read from them.
+    """
+
+    filename = config['global'].get('working-set')
+    if filename:
+        return DiskDict(filename, name, key_type=key_type,
+                        value_type=value_type, sort_key=sort_key)
+
+    return OrderedDict()
+
+
+def target_working_set_name(name, target):
+    """
+    Returns the name of the working set ``name`` for the import into the given
+    target repository; those for the first target keep their plain name.
+    """
+
+    if target == config['global']['target']:
+        return name
+
+    return '%s:%s' % (name, target)
+
+
+def sort_working_set(working_set, sort_key):
+    """
+    Returns the given working set ordered by ``sort_key``.  A `DiskDict` that
+    was created with the same ``sort_key`` is kept in that order already.
+    """
+
+    if isinstance(working_set, DiskDict):
+        return working_set
+
+    return OrderedDict(sorted(working_set.items(),
+                              key=lambda item: sort_key(item[1])))
+
+
 def init_config(argv):
     """
     Handle command-line and config file processing; returns a `dict` of
@@ -149,6 +941,19 @@ def init_config(argv):
                  "create the new issues. The password will not be stored "
                  "anywhere if passed in as an argument.")
 
+    arg_parser.add_argument('--token',
+            help="A personal access token to authenticate with instead of a "
+                 "username and password.  This is the identity that all "
+                 "changes (new issues, comments, etc.) are made with.")
+
+    arg_parser.add_argument('--read-tokens', dest='read_tokens', nargs='+',
+            metavar='TOKEN',
+            help="Additional access tokens that are only used for reading "
+                 "from the repositories.  Reads are spread across these "
+                 "tokens and the main credentials according to how much of "
+                 "their rate limit each has left, multiplying the number of "
+                 "reads that can be made per hour.")
+
     arg_parser.add_argument('-s', '--sources', nargs='+',
             help="The source repository or repositories from which the "
                  "issues should be copied.  If given more than one repository "
@@ -157,9 +962,12 @@ def init_config(argv):
                  "creation.  Each repository should be in the format "
                  "`user/repository`.")
 
-    arg_parser.add_argument('-t', '--target',
+    arg_parser.add_argument('-t', '--target', nargs='+',
             help="The destination repository which the issues should be "
-                 "copied to. Should be in the format `user/repository`.")
+                 "copied to. Should be in the format `user/repository`.  If "
+                 "given more than one repository the issues are fetched and "
+                 "rendered once, and imported into each of the target "
+                 "repositories concurrently.")
 
     arg_parser.add_argument('--update-existing', dest='update_existing',
             action='store_true',
@@ -170,6 +978,14 @@ def init_config(argv):
                  'that were not previously migrated (if not '
                  '--ignore-comments)')
 
+    arg_parser.add_argument('--fingerprints', metavar='FILE',
+            help="Record a fingerprint of each migrated issue in the given "
+                 "file (based on when it was last updated, its number of "
+                 "comments, title, labels, milestone, assignee and state).  "
+                 "With --update-existing, issues whose fingerprint has not "
+                 "changed since the previous run are skipped without making "
+                 "any further requests for them.")
+
     arg_parser.add_argument('--ignore-comments', dest='ignore_comments',
             action='store_true', help="Do not import comments in the issue.")
 
@@ -195,6 +1011,24 @@ def init_config(argv):
             action='store_true',
             help="Close original issues after they have been migrated.")
 
+    arg_parser.add_argument('--collapse-comments', dest='collapse_comments',
+            action='store_true',
+            help="Rather than migrating each comment as a separate comment, "
+                 "append the whole discussion on an issue (each comment "
+                 "rendered with the comment template) to the body of the "
+                 "migrated issue, continuing in as few comments as needed to "
+                 "stay within GitHub's limit on their length.  Original "
+                 "comments are not updated with backrefs.")
+
+    arg_parser.add_argument('--batch-source-updates',
+            dest='batch_source_updates', action='store_true',
+            help="Rather than updating each original issue and comment (to "
+                 "add backrefs or close it) as soon as it has been migrated, "
+                 "queue the updates and send them in batches of GraphQL "
+                 "mutations.  This greatly reduces the number of requests "
+                 "made to the source repositories, but requires "
+                 "authenticating with a token.")
+
     arg_parser.add_argument('--issue-template',
             help="Specify a template file for use with issues.")
 
@@ -209,7 +1043,263 @@ def init_config(argv):
                  "normalize the label names by setting them to all lowercase "
                  "and replacing all whitespace with a single hyphen.")
 
-    include_group = arg_parser.add_mutually_exclusive_group(required=True)
+    arg_parser.add_argument('--timeout', type=float,
+            help="The timeout, in seconds, for each request to the GitHub "
+                 "API (default: 60).")
+
+    arg_parser.add_argument('--max-retries', dest='max_retries', type=int,
+            help="The number of times to retry a request that fails with a "
+                 "network error, timeout, server error or rate limiting, "
+                 "waiting exponentially longer between each attempt "
+                 "(default: 5).  Requests that create new issues, comments, "
+                 "labels or milestones are only retried after verifying that "
+                 "the failed attempt did not create them after all.")
+
+    arg_parser.add_argument('--read-deadline', dest='read_deadline',
+            type=float, metavar='SECONDS',
+            help="Give up on any read from the GitHub API (including hedged "
+                 "duplicates, see --hedge-percentile) that has not completed "
+                 "within this many seconds, and retry it as with any other "
+                 "timeout.")
+
+    arg_parser.add_argument('--hedge-percentile', dest='hedge_percentile',
+            type=float, metavar='PERCENTILE',
+            help="Hedge reads from the GitHub API: if a read has not "
+                 "completed after the given percentile (e.g. 95) of the "
+                 "latencies observed so far for reads from the same server, "
+                 "send a duplicate request and use whichever response "
+                 "arrives first.  Requests that modify anything are never "
+                 "hedged.")
+
+    arg_parser.add_argument('--pipeline', action='store_true',
+            help="Do not fetch the comments on new issues before asking for "
+                 "confirmation (the number of new comments shown is taken "
+                 "from the issues' comment counts); instead, while importing, "
+                 "fetch the comments for the next few issues in the "
+                 "background while the earlier ones are being created.")
+
+    arg_parser.add_argument('--render-workers', dest='render_workers',
+            type=int, metavar='N',
+            help="Render the new issues and their comments (fixing up cross "
+                 "references and filling in the templates) in a separate "
+                 "stage, in a pool of N processes, rather than one at a time "
+                 "as they are fetched and created.  The result is the same "
+                 "either way.")
+
+    arg_parser.add_argument('--working-set', dest='working_set',
+            metavar='FILE',
+            help="Keep the working set of the import (fetched issues, the "
+                 "issue map, and the generated new and updated issues with "
+                 "their comments) in an SQLite database at the given path "
+                 "instead of in memory, so that memory use stays flat "
+                 "regardless of the size of the source repositories.  Any "
+                 "previous working set in the file is discarded.")
+
+    arg_parser.add_argument('--http-cache', dest='http_cache', metavar='FILE',
+            help="Cache the responses to all reads from the GitHub API in an "
+                 "SQLite database at the given path, which persists between "
+                 "runs.  Cached responses are revalidated with a conditional "
+                 "request, which does not count against the rate limit when "
+                 "nothing has changed.")
+
+    arg_parser.add_argument('--http-cache-size', dest='http_cache_size',
+            type=float, metavar='MB',
+            help="The maximum size of the --http-cache; the least recently "
+                 "used responses are evicted beyond this (default: 100).")
+
+    arg_parser.add_argument('--http-cache-ttl', dest='http_cache_ttl',
+            nargs='+', metavar='ENDPOINT=SECONDS',
+            help="Use responses from the --http-cache for the given kind of "
+                 "endpoint (`issues`, `comments`, `labels`, `milestones`, "
+                 "etc.) without revalidating them for up to the given number "
+                 "of seconds after they were fetched, unless the same "
+                 "repository has since been written to.  By default all "
+                 "cached responses are revalidated.")
+
+    arg_parser.add_argument('--transport', metavar='MODULE:CLASS',
+            help="Send all requests to the GitHub API through an alternative "
+                 "transport: a subclass of Transport or AsyncTransport (see "
+                 "the source), given as the module to import it from and its "
+                 "name, which is instantiated without arguments.  By default "
+                 "requests are sent with urllib.")
+
+    replay_group = arg_parser.add_mutually_exclusive_group()
+    replay_group.add_argument('--record', metavar='FILE',
+            help="Record every request made to the GitHub API, along with its "
+                 "response and how long it took, to the given file, to be "
+                 "replayed later with --replay.")
+
+    replay_group.add_argument('--replay', metavar='FILE',
+            help="Instead of making requests to the GitHub API, serve the "
+                 "responses recorded with --record in the given file, so "
+                 "that a run can be repeated offline (for example to compare "
+                 "the number of requests made and the time taken by "
+                 "different versions of this script).")
+
+    arg_parser.add_argument('--replay-latency', dest='replay_latency',
+            type=float, metavar='FACTOR',
+            help="With --replay, wait for each response for the time the "
+                 "original request took multiplied by this factor (default: "
+                 "1, i.e. the original latencies; 0 to respond "
+                 "immediately).")
+
+    arg_parser.add_argument('--trace', metavar='FILE',
+            help="Record how long each stage of the import takes, along with "
+                 "the time spent on each issue (fetching, rendering, "
+                 "creating it, its comments and the backref) and on each "
+                 "request, and save it to the given file in the Chrome trace "
+                 "event format (which can be viewed in chrome://tracing or "
+                 "https://ui.perfetto.dev).")
+
+    arg_parser.add_argument('--profile', metavar='DIR',
+            help="Profile each stage of the import with cProfile, saving the "
+                 "profile of each stage to the given directory as "
+                 "<stage>.prof.")
+
+    arg_parser.add_argument('--memory-report', dest='memory_report',
+            action='store_true',
+            help="Trace memory allocations (with tracemalloc, which slows the "
+                 "import down), and at the end of the run report the memory "
+                 "used by each stage of the import (traced and resident, "
+                 "including peaks) with the largest allocation sites, and "
+                 "the estimated size in memory of each issue and comment.")
+
+    arg_parser.add_argument('--max-memory', dest='max_memory', type=float,
+            metavar='MB',
+            help="Abort the import, with a report of the memory used by each "
+                 "stage so far, if the resident memory of the process exceeds "
+                 "the given size.  As with an interrupted import, the "
+                 "backrefs and fingerprints of the issues imported so far are "
+                 "saved.  The memory of any --render-workers is not "
+                 "included.")
+
+    arg_parser.add_argument('--status-file', dest='status_file',
+            metavar='FILE',
+            help="Periodically write the status of the import (the current "
+                 "stage, the number of issues and comments imported so far "
+                 "and planned, the request rate, time spent waiting on rate "
+                 "limits and retries, and the estimated time remaining) to "
+                 "the given file as JSON, for other tools to monitor.")
+
+    arg_parser.add_argument('--progress-interval', dest='progress_interval',
+            type=float, metavar='SECONDS',
+            help="How often to report progress during the import, on the "
+                 "terminal and in the --status-file (default: 10).")
+
+    arg_parser.add_argument('--listen', metavar='[HOST:]PORT',
+            help="Instead of performing a one-off import, run continuously "
+                 "as a mirroring daemon: listen on the given local port for "
+                 "`issues` and `issue_comment` webhook payloads from the "
+                 "source repositories and apply each event to the target "
+                 "repository as it arrives.  The issue selection options "
+                 "(--open, --closed, etc.) act as a filter on which issues "
+                 "are mirrored, and default to --all.")
+
+    arg_parser.add_argument('--verify', action='store_true',
+            help="Instead of importing anything, check that the issues "
+                 "already migrated to the target repository match their "
+                 "originals: compare the body each would be migrated with "
+                 "now, the number of comments, the labels, the milestone, "
+                 "the title and whether the issue is open or closed, and "
+                 "report any mismatches.  Exits with a non-zero status if any "
+                 "are found.")
+
+    distribute_group = arg_parser.add_mutually_exclusive_group()
+    distribute_group.add_argument('--coordinate', metavar='DIR',
+            help="Distribute fetching the comments on and rendering the new "
+                 "issues among worker processes (see --worker) sharing the "
+                 "given directory, which must not contain a previous plan.  "
+                 "This process assigns the new issue numbers and then creates "
+                 "the issues rendered by the workers, in order.  Already "
+                 "migrated issues are skipped; --update-existing is not "
+                 "supported.")
+
+    distribute_group.add_argument('--worker', metavar='DIR',
+            help="Run as a worker for a --coordinate process sharing the given "
+                 "directory (possibly on another host), with the same "
+                 "configuration: repeatedly claim a batch of the planned "
+                 "issues, fetch their comments and render them, until none "
+                 "are left.")
+
+    arg_parser.add_argument('--webhook-secret', dest='webhook_secret',
+            help="The secret configured on the source repositories' "
+                 "webhooks; if given, payloads received with --listen that "
+                 "are not signed with this secret are rejected.")
+
+    arg_parser.add_argument('--coalesce-delay', dest='coalesce_delay',
+            type=float,
+            help="With --listen, the number of seconds to wait for further "
+                 "events on the same issue before mirroring it, so that a "
+                 "burst of events results in a single update (default: 5).")
+
+    filter_group = arg_parser.add_argument_group('issue filters',
+            description="Further restrict the issues selected with --all, "
+                        "--open, --closed or --migrated.  These filters are "
+                        "applied by the GitHub API (using the search API "
+                        "where the issues list API does not support them), "
+                        "so that issues that are not selected are never "
+                        "downloaded.  Dates are given as YYYY-MM-DD or as a "
+                        "full ISO-8601 timestamp (YYYY-MM-DDTHH:MM:SSZ).")
+
+    filter_group.add_argument('--label', dest='filter_labels', nargs='+',
+            metavar='LABEL',
+            help="Only select issues that have all of the given labels.")
+
+    filter_group.add_argument('--milestone', dest='filter_milestone',
+            metavar='TITLE',
+            help="Only select issues in the milestone with the given title.")
+
+    filter_group.add_argument('--creator', dest='filter_creator',
+            metavar='USER',
+            help="Only select issues opened by the given user.")
+
+    filter_group.add_argument('--created-since', dest='created_since',
+            metavar='DATE',
+            help="Only select issues created at or after the given date.")
+
+    filter_group.add_argument('--created-before', dest='created_before',
+            metavar='DATE',
+            help="Only select issues created before the given date.")
+
+    filter_group.add_argument('--updated-since', dest='updated_since',
+            metavar='DATE',
+            help="Only select issues last updated at or after the given "
+                 "date.")
+
+    filter_group.add_argument('--updated-before', dest='updated_before',
+            metavar='DATE',
+            help="Only select issues last updated before the given date.")
+
+    filter_group.add_argument('--type', dest='issue_type',
+            choices=('issues', 'pulls'),
+            help="Only select issues (`issues`) or pull requests (`pulls`); "
+                 "by default both are selected.")
+
+    select_group = arg_parser.add_argument_group('local selection',
+            description="Select issues locally, from those fetched (or "
+                        "loaded from a snapshot), to quickly try out "
+                        "different selections without fetching the issues "
+                        "again.")
+
+    select_group.add_argument('--select', metavar='EXPR',
+            help="Only import the issues matching the given expression: "
+                 "terms of the form label:NAME, milestone:TITLE, "
+                 "author:USER, repo:OWNER/REPO, state:open|closed, "
+                 "is:issue|pr, no:label|milestone, created:DATE, "
+                 "updated:DATE or closed:DATE (where DATE may be preceded "
+                 "by <, <=, > or >=, and otherwise matches dates starting "
+                 "with it), and words or \"quoted phrases\" to find in the "
+                 "title or body, combined with AND (implied between "
+                 "adjacent terms), OR, NOT and parentheses, e.g. "
+                 "'label:bug (crash OR \"out of memory\") NOT "
+                 "created:<2020'.")
+
+    select_group.add_argument('--snapshot', metavar='FILE',
+            help="If the given file exists, load the issues from it rather "
+                 "than fetching them; otherwise save the fetched issues to "
+                 "it.")
+
+    include_group = arg_parser.add_mutually_exclusive_group()
     include_group.add_argument('--all', dest='import_issues',
             action='store_const', const='all',
             help="Import all issues, regardless of state.")
@@ -271,15 +1361,7 @@ def init_config(argv):
             val = config[section].get(option)
             if val is not None:
                 if config_map.get('multiple'):
-                    # A multiple-value can either be comma-separated or split
-                    # across lines (but not both)
-                    for sep in ('\n', ','):
-                        if sep in val:
-                            val = [v.strip() for v in val.split(sep)
-                                   if v.strip()]
-                            break
-                    else:
-                        val = [val]
+                    val = split_multiple_value(val)
                 elif config_map.get('negate'):
                     val = not val
                 config_defaults[argname] = val
@@ -288,6 +1370,22 @@ def init_config(argv):
 
     args = arg_parser.parse_args(argv)
 
+    # The issue selection is only optional when running as a daemon, in which
+    # case it defaults to all issues, when verifying, which checks all migrated
+    # issues, or for workers, which are given their issues by the
+    # coordinator; nor when the issues are loaded from a snapshot
+    if args.import_issues is None and not (
+            args.listen or args.verify or args.worker or
+            (args.snapshot and os.path.exists(args.snapshot))):
+        arg_parser.error("one of the arguments --all --open --closed "
+                         "--migrated -i/--issues is required")
+
+    if args.select:
+        try:
+            parse_selection(args.select)
+        except ValueError as error:
+            arg_parser.error("invalid --select expression: %s" % error)
+
     # Now load parsed args in to config dict; would be nice if there were a
     # better way to do this than to loop over CONFIG_MAP a second time.
     for argname, config_map in CONFIG_MAP.items():
@@ -317,7 +1415,16 @@ def init_config(argv):
     # GitHub seems to be case-insensitive wrt username/repository name, so
     # lowercase all repositories for consistency
     sources = config['global']['sources'] = [s.lower() for s in sources]
-    target = config['global']['target'] = target.lower()
+    targets = config['global']['targets'] = [
+            t.lower() for t in split_multiple_value(target)]
+    # The first target is the target for everything that only supports one
+    target = config['global']['target'] = targets[0]
+
+    if len(targets) > 1:
+        for option in ('coordinate', 'worker', 'listen', 'verify'):
+            if config['global'].get(option):
+                sys.exit("ERROR: --%s does not support more than one target "
+                         "repository" % option)
 
     for section in list(config):
         if section.startswith('repository:'):
@@ -336,10 +1443,14 @@ def init_config(argv):
         # (yourdomain.com/api/v3...)
         if server == "github.com":
             api_url = "https://api.github.com"
+            graphql_url = "https://api.github.com/graphql"
         else:
             api_url = "https://%s/api/v3" % server
+            graphql_url = "https://%s/api/graphql" % server
 
         set_repository_option(repo, 'url', '%s/repos/%s' % (api_url, repo))
+        set_repository_option(repo, 'search-url', '%s/search/issues' % api_url)
+        set_repository_option(repo, 'graphql-url', graphql_url)
 
     # Prompt for username/password if none is provided in either the config or an argument
     def get_credentials_for(repo):
@@ -351,10 +1462,20 @@ def init_config(argv):
         query_msg_3 = ("Enter your password for '%s' at '%s': " %
                        (repo, server))
 
+        # Tokens can be given per-repository or in the login section; if
+        # there is a token there is no need for a username or password
+        for option in ('token', 'read-tokens'):
+            if (get_repository_option(repo, option) is None and
+                    config['login'].get(option)):
+                set_repository_option(repo, option, config['login'][option])
+
+        if get_repository_option(repo, 'token'):
+            return
+
         if get_repository_option(repo, 'username') is None:
             if config['login'].get('username'):
                 username = config['login']['username']
-            elif (repo == target and len(sources) == 1 and
+            elif (repo in targets and len(sources) == 1 and
                     yes_no(query_msg_1)):
                 # One target and one source, where credentials for the target
                 # were not supplied--ask to use the same credentials
@@ -376,7 +1497,7 @@ def init_config(argv):
             # multiple sources, but it's not a priority right now.
             if config['login'].get('password'):
                 password = config['login']['password']
-            elif (repo == target and len(sources) == 1):
+            elif (repo in targets and len(sources) == 1):
                 source = sources[0]
                 source_username = get_repository_option(source, 'username')
                 source_server = get_repository_option(source, 'server')
@@ -384,8 +1505,7 @@ def init_config(argv):
                 target_username = get_repository_option(repo, 'username')
                 target_server = get_repository_option(repo, 'server')
 
-                if (repo == target and
-                        source_username == target_username and
+                if (source_username == target_username and
                         source_server == target_server):
                     password = get_repository_option(source, 'password')
                 else:
@@ -395,7 +1515,7 @@ def init_config(argv):
 
             set_repository_option(repo, 'password', password)
 
-    for repo in sources + [target]:
+    for repo in sources + targets:
         get_server_for(repo)
         get_credentials_for(repo)
 
@@ -424,6 +1544,22 @@ def load_config_file(config_file_name):
         return False
 
 
+def split_multiple_value(val):
+    """
+    Split a config option that takes multiple values into a list; the values
+    can either be comma-separated or split across lines (but not both).
+    """
+
+    if isinstance(val, list):
+        return val
+
+    for sep in ('\n', ','):
+        if sep in val:
+            return [v.strip() for v in val.split(sep) if v.strip()]
+
+    return [val]
+
+
 def get_repository_option(repo, option, default=None):
     """
     Looks up per-repository options in the configuration; if not found it just
@@ -448,13 +1584,20 @@ def set_repository_option(repo, option, value):
     config['repository:' + repo][option] = value
 
 
+# Runs of whitespace replaced with hyphens in normalized label names
+LABEL_WHITESPACE_RE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=None)
 def normalize_label_name(label):
     """
     Lowercases a label name and replaces all whitespace with hyphens.
+
+    There are few distinct label names however many issues use them, so the
+    normalized names are cached and interned.
     """
 
-    label = label.lower()
-    return re.sub(r'\s+', '-', label)
+    return sys.intern(LABEL_WHITESPACE_RE.sub('-', label.lower()))
 
 
 def format_date(datestring):
@@ -464,9 +1607,14 @@ def format_date(datestring):
     return date.strftime(date_format)
 
 
+@functools.lru_cache(maxsize=None)
+def load_template(template_filename):
+    with open(template_filename, 'r') as template_file:
+        return Template(template_file.read())
+
+
 def format_from_template(template_filename, template_data):
-    template_file = open(template_filename, 'r')
-    template = Template(template_file.read())
+    template = load_template(template_filename)
     return template.substitute(template_data)
 
 
@@ -489,626 +1637,3816 @@ def format_comment(template_data):
     return format_from_template(template, template_data)
 
 
-def send_request(repo, url, post_data=None, method=None):
-    if post_data is not None:
-        post_data = json.dumps(post_data).encode("utf-8")
+class RequestError(Exception):
+    """
+    Raised by `request_with_retries` when a request to the GitHub API fails.
+
+    ``code`` is the HTTP status code (or `None` if no response was received at
+    all), and ``details`` the error message returned by the API, if any.
+    """
 
-    repo_url = get_repository_option(repo, 'url')
-    full_url = "%s/%s" % (repo_url, url)
-    req = urllib.request.Request(full_url, post_data)
+    def __init__(self, code, reason, details=None, retry_after=None):
+        super().__init__(code, reason, details)
+        self.code = code
+        self.reason = reason
+        self.details = details
+        self.retry_after = retry_after
 
-    if method is not None:
-        req.method = method
+    @property
+    def transient(self):
+        """
+        Whether the request might succeed if tried again: no response was
+        received, the server had an internal error, or the request was
+        rate-limited.
+        """
 
-    username = get_repository_option(repo, 'username')
-    password = get_repository_option(repo, 'password')
-    auth = base64.urlsafe_b64encode(
-            ('%s:%s' % (username, password)).encode('utf-8'))
-    req.add_header("Authorization", b'Basic ' + auth)
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Accept", "application/json")
-    req.add_header("User-Agent", "spacetelescope/github-issues-import")
+        if self.code is None or self.code >= 500 or self.code == 429:
+            return True
 
-    try:
-        response = urllib.request.urlopen(req)
-        json_data = response.read()
-    except urllib.error.HTTPError as error:
+        return (self.code == 403 and self.details is not None and
+                'rate limit' in self.details.lower())
 
-        error_details = error.read();
-        error_details = json.loads(error_details.decode("utf-8"))
+    def __str__(self):
+        if self.code in HTTP_ERROR_MESSAGES:
+            return HTTP_ERROR_MESSAGES[self.code]
 
-        if error.code in HTTP_ERROR_MESSAGES:
-            sys.exit(HTTP_ERROR_MESSAGES[error.code])
+        if self.code is None:
+            message = ("ERROR: There was a problem importing the issues.\n%s" %
+                       self.reason)
         else:
-            error_message = ("ERROR: There was a problem importing the "
-                             "issues.\n%s %s" % (error.code, error.reason))
-            if 'message' in error_details:
-                error_message += "\nDETAILS: " + error_details['message']
-            sys.exit(error_message)
+            message = ("ERROR: There was a problem importing the issues.\n"
+                       "%s %s" % (self.code, self.reason))
 
-    return json.loads(json_data.decode("utf-8"))
+        if self.details:
+            message += "\nDETAILS: " + self.details
 
+        return message
 
-def get_milestones(repo):
-    """
-    Get all open milestones for repository.
 
-    Returns an `OrderedDict` keyed on the milestone title.
+class TransportError(RequestError):
+    """
+    Raised by a `Transport` when no response was received at all (a connection
+    error, timeout or dropped connection).
     """
 
-    milestones = send_request(repo, "milestones?state=open")
-    return OrderedDict((m['title'], m) for m in milestones)
+    def __init__(self, reason):
+        super().__init__(None, reason)
 
 
-def get_labels(repo):
+class HTTPStatusError(RequestError):
     """
-    Get all labels for repository.
-
-    Returns an `OrderedDict` keyed on label names.  If normalize-labels was
-    specified in the configuration, this also normalizes all label names and
-    ignores their original spellings.
+    Raised by a `Transport` when the GitHub API responds with an error status;
+    the full `Response` is available as ``response``.
     """
 
-    normalize = get_repository_option(repo, 'normalize-labels')
-    labels = send_request(repo, "labels")
-    labels_dict = OrderedDict()
-    for label in labels:
-        if normalize:
-            name = normalize_label_name(label['name'])
+    def __init__(self, response, reason=None):
+        details = None
+        if isinstance(response.body, dict):
+            details = response.body.get('message')
+
+        # Wait as long as the server asks us to if this is due to rate
+        # limiting
+        headers = response.headers
+        retry_after = headers.get('Retry-After')
+        reset = headers.get('X-RateLimit-Reset')
+        if retry_after is not None and retry_after.isdigit():
+            retry_after = int(retry_after)
+        elif headers.get('X-RateLimit-Remaining') == '0' and reset:
+            retry_after = max(0, int(reset) - int(time.time()) + 1)
         else:
-            name = label['name']
-
-        labels_dict[name] = label
-    return labels_dict
-
+            retry_after = None
 
-def get_issue_by_id(repo, issue_id):
-    """Get single issue from repository."""
+        if reason is None:
+            reason = http.client.responses.get(response.status, '')
 
-    issue = send_request(repo, "issues/%d" % issue_id)
-    issue['repository'] = repo
-    return issue
+        super().__init__(response.status, reason, details, retry_after)
+        self.response = response
 
 
-def get_issues_by_id(repo, issue_ids):
-    """Get list of issues from repository for multiple issue numbers."""
+def send_request(repo, url, post_data=None, method=None, recover=None,
+                 full_response=False):
+    """
+    Send a request to the GitHub API for the given repository and return the
+    decoded JSON response (or the full `Response`, if ``full_response``),
+    retrying transient failures (see `request_with_retries`).  Exits the
+    script if the request fails.
+    """
 
-    return [get_issue_by_id(repo, int(issue_id)) for issue_id in issue_ids]
+    try:
+        return request_with_retries(repo, url, post_data, method, recover,
+                                    full_response=full_response)
+    except RequestError as error:
+        sys.exit(str(error))
 
 
-def get_issues(repo, state=None):
+def request_with_retries(repo, url, post_data=None, method=None,
+                         recover=None, idempotent=False, full_response=False):
+    """
+    Send a request to the GitHub API, retrying with exponential backoff and
+    jitter for as long as it fails with a transient error (a network error,
+    timeout, 5xx response or rate limiting), up to the max-retries option.
+    Raises `RequestError` if the request ultimately fails.
+
+    Retrying is only safe for idempotent requests; a failed POST may have
+    been carried out by the server even though no response was received.  For
+    POSTs, ``recover`` should be given as a function that checks whether the
+    object was in fact created, returning it if so (in which case it is used as
+    the result instead of sending the request again), or `None` otherwise.  A
+    POST without ``recover`` is not retried, unless it is flagged as
+    ``idempotent`` (such as a GraphQL query).
+
+    ``url`` is relative to the repository's API URL, unless it is absolute.
+    If ``full_response``, the `Response` is returned rather than just its
+    body.
     """
-    Get all issues from repository.
 
-    Optionally, only retrieve issues of in the specified state ('open' or
-    'closed')."""
+    if method is None:
+        method = 'GET' if post_data is None else 'POST'
 
-    issues = []
-    page = 1
+    max_retries = int(get_repository_option(repo, 'max-retries', 5))
+    if method == 'POST' and recover is None and not idempotent:
+        max_retries = 0
+
+    attempt = 0
     while True:
-        query_args = {'direction': 'asc', 'page': page}
-        if state in ('open', 'closed', 'all'):
-            query_args['state'] = state
+        try:
+            if method == 'GET':
+                return request_read(repo, url, full_response)
+            else:
+                return request_once(repo, url, post_data, method,
+                                    full_response)
+        except RequestError as error:
+            if not error.transient or attempt >= max_retries:
+                raise
+
+            # "Full jitter" exponential backoff, unless the server told us
+            # how long to wait
+            if error.retry_after is not None:
+                delay = error.retry_after
+            else:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY,
+                                              RETRY_BASE_DELAY * 2 ** attempt))
 
-        # TODO: Consider building this into send_request in the form of
-        # optional kwargs or something
-        query = urllib.parse.urlencode(query_args)
-        new_issues = send_request(repo, 'issues?' + query)
-        if not new_issues:
-            break
+            attempt += 1
+            print("WARNING: %s %s failed (%s); retrying in %.1f seconds "
+                  "(retry %d of %d)" % (method, url, error.code or error.reason,
+                                        delay, attempt, max_retries))
+            time.sleep(delay)
+            progress.throttle(delay)
 
-        # Add a 'repository' key to each issue; although this information can
-        # be gleaned from the issue data it's easier to include here explicitly
-        for issue in new_issues:
-            issue['repository'] = repo
+            if recover is not None:
+                result = recover()
+                if result is not None:
+                    print("Request %s %s had succeeded after all" %
+                          (method, url))
+                    return result
 
-        issues.extend(new_issues)
-        page += 1
-    return issues
 
+class Credential:
+    """
+    One set of credentials for a server, along with what is known of its
+    remaining rate limit budget (from the X-RateLimit headers of the latest
+    response to a request made with it).
+    """
 
-def get_comments_on_issue(repo, issue):
-    """Get all comments on an issue in the specified repository."""
+    def __init__(self, auth):
+        self.auth = auth
+        self.remaining = None
+        self.reset = None
+        self.lock = threading.Lock()
 
-    if issue['comments'] != 0:
-        return send_request(repo, "issues/%s/comments" % issue['number'])
-    else :
-        return []
+    def budget(self):
+        """
+        The number of requests that can still be made with these credentials
+        before hitting the rate limit, as far as we know.
+        """
 
+        with self.lock:
+            if (self.remaining is None or self.reset is None or
+                    self.reset <= time.time()):
+                return DEFAULT_RATE_LIMIT
 
-def import_milestone(source):
-    data = {
-        "title": source['title'],
-        "state": "open",
-        "description": source['description'],
-        "due_on": source['due_on']
-    }
+            return self.remaining
 
-    target = config['global']['target']
-    result_milestone = send_request(target, "milestones", source)
-    print("Successfully created milestone '%s'" % result_milestone['title'])
-    return result_milestone
+    def reserve(self):
+        """
+        Count a request against the budget ahead of its response, so that
+        concurrent requests are spread across credentials.
+        """
 
+        with self.lock:
+            if self.remaining is not None:
+                self.remaining -= 1
 
-def import_label(source):
-    data = {
-        "name": source['name'],
-        "color": source['color']
-    }
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
 
-    target = config['global']['target']
-    result_label = send_request(target, "labels", source)
-    print("Successfully created label '%s'" % result_label['name'])
-    return result_label
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
 
 
-def import_comments(orig_issue_id, comments, issue_number, issue_map):
-    result_comments = []
-    source_repo = orig_issue_id.repository
+# Maps (server, Authorization header) pairs to their Credential, so that the
+# budget of credentials used for several repositories on the same server is
+# shared between them
+credentials = {}
+credentials_lock = threading.Lock()
 
-    for comment in comments:
-        body = fixup_cross_references(comment['body'], source_repo, issue_map)
 
-        template_data = {}
-        template_data['user_name'] = comment['user']['login']
-        template_data['user_url'] = comment['user']['html_url']
-        template_data['user_avatar'] = comment['user']['avatar_url']
-        template_data['date'] = format_date(comment['created_at'])
-        template_data['url'] =  comment['html_url']
-        template_data['body'] = body
+def get_credential(server, auth):
+    with credentials_lock:
+        if (server, auth) not in credentials:
+            credentials[(server, auth)] = Credential(auth)
 
-        new_comment = {'body': format_comment(template_data)}
+        return credentials[(server, auth)]
 
-        target = config['global']['target']
-        result_comment = send_request(target, "issues/%s/comments" %
-                                      issue_number, new_comment)
-        result_comments.append(result_comment)
 
-        if get_repository_option(source_repo, 'create-backrefs'):
-            # Update the original comment to mark it as migrated, and link to
-            # the migrated comment
+def choose_credential(repo, method):
+    """
+    Choose the credentials to use for a request to the given repository.
 
-            message = (
-                '*Migrated to [%s#%s (comment)](%s) by '
-                '[spacetelescope/github-issues-import]'
-                '(https://github.com/spacetelescope/github-issues-import)*' %
-                (target, issue_number, result_comment['html_url']))
+    Anything other than a read is made with the designated identity for the
+    repository (its token, or otherwise its username and password).  Reads
+    are made with whichever of the repository's read-tokens or designated
+    identity has the most rate limit budget left, preferring the read-tokens
+    so as to leave as much budget as possible to the designated identity.
+    """
 
-            update = {'body': message + '\n\n' + comment['body']}
-            send_request(source_repo, 'issues/comments/%s' % comment['id'],
-                         update, 'PATCH')
+    server = get_repository_option(repo, 'server')
 
-    return result_comments
+    token = get_repository_option(repo, 'token')
+    if token:
+        auth = 'token ' + token
+    else:
+        username = get_repository_option(repo, 'username')
+        password = get_repository_option(repo, 'password')
+        auth = 'Basic ' + base64.urlsafe_b64encode(
+                ('%s:%s' % (username, password)).encode('utf-8')).decode()
 
+    candidates = []
+    if method == 'GET':
+        read_tokens = get_repository_option(repo, 'read-tokens') or []
+        candidates = [get_credential(server, 'token ' + read_token)
+                      for read_token in split_multiple_value(read_tokens)]
 
-def fixup_cross_references(text, source_repo, issue_map):
-    """
-    Before inserting new issues into the target repository, this checks the
-    original issue body for references to other issues in the original
-    repository *or* issues in any of the other source repositories being
-    migrated from.
+    candidates.append(get_credential(server, auth))
+    credential = max(candidates, key=lambda c: c.budget())
+    credential.reserve()
+    return credential
 
-    This can't reasonably update every existing reference to the original
-    issue, but it can ensure that all issue cross-references made in the new
-    issue are internally consistent.
 
-    This can also be used to update cross references in comments.
+class LatencyTracker:
+    """
+    Keeps a window of the latencies of recent successful reads from a server,
+    from which the hedging delay is determined.
     """
 
-    def repl_issue_reference(matchobj):
+    def __init__(self):
+        self.samples = deque(maxlen=HEDGE_WINDOW)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def percentile(self, percentile):
         """
-        If a matched issue reference is to within the same repository,
-        it is updated to explictly reference the source repository (rather
-        than a 'bare' issue reference like '#42').  However, if the referenced
-        issue is one of the other issues being migrated, then it updates the
-        reference to point to the newly migrated issue.
+        Returns the given percentile of the observed latencies, or `None` if
+        too few have been observed yet for it to be meaningful.
         """
 
-        repo = matchobj.group(1) or source_repo
-        issue_num = int(matchobj.group(2))
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
 
-        issue = Issue(repo, issue_num)
+            samples = sorted(self.samples)
 
-        if issue in issue_map:
-            # Update to reference another issue being migrated to the target
-            # repository
-            return '#' + str(issue_map[issue][1])
-        else:
-            return str(issue)
+        idx = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[idx]
 
-    return GH_ISSUE_REF_RE.sub(repl_issue_reference, text)
 
+# Maps servers to their LatencyTracker
+read_latencies = defaultdict(LatencyTracker)
 
-def import_new_issue(new_issue, issue_map):
-    """
-    Perform actual migration of new issues, including updates to the original
-    source issue.
-    """
 
-    target = config['global']['target']
-    old_issue = new_issue['origin']
+class CachedResponse(namedtuple('CachedResponse',
+                                ('body', 'etag', 'last_modified', 'link',
+                                 'fresh'))):
+    """A response from the `HTTPCache`, with the headers it was stored with."""
 
-    if 'milestone_object' in new_issue:
-        new_issue['milestone'] = new_issue['milestone_object']['number']
-        del new_issue['milestone_object']
+    def headers(self):
+        """
+        The headers of the response that were kept in the cache (``ETag``,
+        ``Last-Modified`` and ``Link``), as an `http.client.HTTPMessage`.
+        """
 
-    if 'label_objects' in new_issue:
+        headers = http.client.HTTPMessage()
+        for name, value in (('ETag', self.etag),
+                            ('Last-Modified', self.last_modified),
+                            ('Link', self.link)):
+            if value is not None:
+                headers[name] = value
+        return headers
+
+
+class HTTPCache:
+    """
+    A persistent cache of responses to GET requests, stored in an SQLite
+    database (see the --http-cache option).
+
+    Cached responses are revalidated with ``If-None-Match`` and
+    ``If-Modified-Since`` requests, unless they are still within the TTL
+    configured for their endpoint and nothing has been written to their
+    repository since they were fetched.  Once the cache grows beyond
+    ``max_size`` bytes the least recently used responses are evicted.
+    """
+
+    def __init__(self, filename, max_size, ttls):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.last_write = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, '
+            'etag TEXT, last_modified TEXT, link TEXT, body TEXT NOT NULL, '
+            'size INTEGER NOT NULL, stored REAL NOT NULL, '
+            'used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used '
+                          'ON responses (used)')
+        self.size = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def endpoint(url):
+        """
+        The kind of endpoint a URL is for, to look up its TTL: the last
+        component of its path that is not a number (e.g. ``issues`` for both
+        ``.../issues?page=2`` and ``.../issues/12``, or ``comments`` for
+        ``.../issues/12/comments``).
+        """
+
+        path = urllib.parse.urlparse(url).path
+        parts = [part for part in path.split('/') if part and
+                 not part.isdigit()]
+        return parts[-1] if parts else ''
+
+    def get(self, repo, url):
+        """
+        Returns the `CachedResponse` for the URL, or `None` if it is not
+        cached.
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                    'SELECT body, etag, last_modified, link, stored '
+                    'FROM responses '
+                    'WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+
+            self.conn.execute('UPDATE responses SET used = ? WHERE url = ?',
+                              (now, url))
+
+        body, etag, last_modified, link, stored = row
+        ttl = self.ttls.get(self.endpoint(url), 0)
+        fresh = (now - stored < ttl and
+                 stored > self.last_write.get(repo, 0))
+        return CachedResponse(body, etag, last_modified, link, fresh)
+
+    def store(self, url, headers, body):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        link = headers.get('Link')
+        if not (etag or last_modified or self.ttls.get(self.endpoint(url))):
+            # Could never be used without fetching it again in full anyway
+            return
+
+        now = time.time()
+        size = len(url) + len(body)
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE url = ?',
+                                    (url,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.conn.execute(
+                    'INSERT OR REPLACE INTO responses VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, etag, last_modified, link, body, size, now, now))
+            self.evict()
+
+    def revalidated(self, url):
+        """Mark a cached response as confirmed to be up to date."""
+
+        with self.lock:
+            self.conn.execute('UPDATE responses SET stored = ? WHERE url = ?',
+                              (time.time(), url))
+
+    def written(self, repo):
+        """
+        Record a write to the repository; responses for it cached before now
+        are no longer used without revalidating them.
+        """
+
+        self.last_write[repo] = time.time()
+
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.conn.execute(
+                    'SELECT url, size FROM responses ORDER BY used '
+                    'LIMIT 100').fetchall()
+            if not rows:
+                self.size = 0
+                break
+
+            for url, size in rows:
+                self.conn.execute('DELETE FROM responses WHERE url = ?',
+                                  (url,))
+                self.size -= size
+                if self.size <= self.max_size:
+                    break
+
+
+# The HTTPCache, if the http-cache option is given
+http_cache = None
+
+
+def open_http_cache():
+    """Open the HTTPCache if the http-cache option is given."""
+
+    global http_cache
+
+    filename = config['global'].get('http-cache')
+    if not filename:
+        return
+
+    max_size = float(config['global'].get('http-cache-size') or 100)
+    ttls = {}
+    for ttl in split_multiple_value(config['global'].get('http-cache-ttl')
+                                    or []):
+        endpoint, sep, seconds = ttl.partition('=')
+        try:
+            ttls[endpoint.strip()] = float(seconds)
+        except ValueError:
+            sep = None
+        if not sep:
+            sys.exit("ERROR: Invalid http-cache-ttl '%s'; it should be in the "
+                     "format ENDPOINT=SECONDS" % ttl)
+
+    http_cache = HTTPCache(filename, max_size * 1024 * 1024, ttls)
+
+
+class Response(namedtuple('Response', ('status', 'headers', 'body'))):
+    """
+    A response from the GitHub API, as returned by a `Transport`: the HTTP
+    ``status`` code, the ``headers`` (a mapping with case-insensitive `get`,
+    such as `http.client.HTTPMessage`), and the ``body`` decoded from JSON
+    (`None` if it was empty).
+    """
+
+
+def decode_json(data):
+    """Decode a JSON response body given as bytes; `None` if empty."""
+
+    return json.loads(data.decode('utf-8')) if data else None
+
+
+class Transport:
+    """
+    Sends requests to the GitHub API.  Every request made by the script goes
+    through the transport returned by `get_transport`; this is a
+    `UrllibTransport` unless another is given with the transport option.
+
+    Subclasses implement `request`, which returns a `Response`, and raises
+    `HTTPStatusError` for responses with an error status (but not for 304 Not
+    Modified, which is returned) or `TransportError` if no response was
+    received at all.  Requests may be made from several threads at once.
+    """
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        """
+        Send a request; ``data`` is the request body as an object to encode as
+        JSON, or `None` for no body.
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the transport."""
+
+
+class AsyncTransport:
+    """
+    The asynchronous counterpart of `Transport`, whose `request` and `close`
+    are coroutines.  Given as the transport option, it is run by an
+    `EventLoopTransport`.
+    """
+
+    async def request(self, method, url, headers, data=None, timeout=None):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class EventLoopTransport(Transport):
+    """
+    Adapts an `AsyncTransport` to the `Transport` interface by running it on
+    an event loop in a background thread, which serves the requests made from
+    all of the script's threads.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        return self.run(self.transport.request(method, url, headers, data,
+                                               timeout))
+
+    def close(self):
+        self.run(self.transport.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class UrllibTransport(Transport):
+    """The default `Transport`, sending requests with `urllib.request`."""
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        if data is not None:
+            data = json.dumps(data).encode('utf-8')
+
+        req = urllib.request.Request(url, data, headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                return Response(response.status, response.headers,
+                                decode_json(response.read()))
+        except urllib.error.HTTPError as error:
+            try:
+                body = decode_json(error.read())
+            except (ValueError, OSError, http.client.HTTPException):
+                body = None
+
+            response = Response(error.code, error.headers, body)
+            if error.code == 304:
+                return response
+
+            raise HTTPStatusError(response, error.reason)
+        except (urllib.error.URLError, OSError,
+                http.client.HTTPException) as error:
+            # Covers connection errors, timeouts and dropped connections
+            reason = getattr(error, 'reason', None) or error
+            raise TransportError(str(reason) or type(error).__name__)
+
+
+class RecordingTransport(Transport):
+    """
+    Wraps another `Transport`, recording each request made through it with
+    its response and latency to a file of JSON lines (see the --record
+    option), to be served back by a `ReplayTransport`.
+    """
+
+    def __init__(self, transport, filename):
+        self.transport = transport
+        self.filename = filename
+        self.file = open(filename, 'w')
+        self.lock = threading.Lock()
+        self.count = 0
+        self.started = time.monotonic()
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        start = time.monotonic()
+        try:
+            response = self.transport.request(method, url, headers, data,
+                                              timeout)
+        except HTTPStatusError as error:
+            self.add(method, url, data, error.response,
+                     time.monotonic() - start)
+            raise
+
+        self.add(method, url, data, response, time.monotonic() - start)
+        return response
+
+    def add(self, method, url, data, response, latency):
+        record = {'method': method, 'url': url, 'data': data,
+                  'status': response.status,
+                  'headers': list(response.headers.items()),
+                  'body': response.body, 'latency': latency}
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        self.transport.close()
+        self.file.close()
+        print("Recorded %d requests to '%s' in %.1f seconds" %
+              (self.count, self.filename, time.monotonic() - self.started))
+
+
+class ReplayTransport(Transport):
+    """
+    Serves the responses recorded by a `RecordingTransport` in place of the
+    GitHub API (see the --replay option), each after its recorded latency
+    multiplied by ``latency_factor``.
+
+    Requests are matched to the recorded ones on their method, URL and
+    request body, in the order they were recorded.  Failing an exact match
+    (such as for requests whose query includes the current time) the next
+    response recorded for the same method and URL, or else the same method
+    and path, is used.  Once all the responses recorded for a request have
+    been used, the last of them is served again.
+    """
+
+    def __init__(self, filename, latency_factor):
+        self.filename = filename
+        self.latency_factor = latency_factor
+        self.responses = defaultdict(deque)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.recorded = 0
+        self.started = time.monotonic()
+
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                for key in self.keys(record['method'], record['url'],
+                                     record['data']):
+                    self.responses[key].append(record)
+                self.recorded += 1
+
+    @staticmethod
+    def keys(method, url, data):
+        """The keys to look up responses for a request, best match first."""
+
+        path = urllib.parse.urlparse(url).path
+        return [(method, url, json.dumps(data, sort_keys=True)),
+                (method, url), (method, path)]
+
+    def request(self, method, url, headers, data=None, timeout=None):
+        with self.lock:
+            for key in self.keys(method, url, data):
+                responses = self.responses.get(key)
+                if responses:
+                    record = (responses.popleft() if len(responses) > 1
+                              else responses[0])
+                    break
+            else:
+                raise TransportError("No response to %s %s recorded in '%s'" %
+                                     (method, url, self.filename))
+
+            self.count += 1
+
+        time.sleep(record['latency'] * self.latency_factor)
+
+        headers = http.client.HTTPMessage()
+        for name, value in record['headers']:
+            headers[name] = value
+
+        response = Response(record['status'], headers, record['body'])
+        if response.status >= 400:
+            raise HTTPStatusError(response)
+
+        return response
+
+    def close(self):
+        print("Replayed %d requests (of %d recorded) from '%s' in %.1f "
+              "seconds" % (self.count, self.recorded, self.filename,
+                           time.monotonic() - self.started))
+
+
+# The Transport through which all requests are sent; see get_transport
+transport = None
+transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the `Transport` through which all requests to the GitHub API are
+    sent, creating it on first use from the transport option (or a
+    `UrllibTransport` by default), wrapped for the record and replay options.
+    """
+
+    global transport
+
+    with transport_lock:
+        if transport is not None:
+            return transport
+
+        name = config['global'].get('transport')
+        if config['global'].get('replay'):
+            factor = config['global'].get('replay-latency')
+            transport = ReplayTransport(config['global']['replay'],
+                                        1.0 if factor is None
+                                        else float(factor))
+        elif name:
+            module_name, _, class_name = name.partition(':')
+            try:
+                cls = getattr(importlib.import_module(module_name), class_name)
+            except (ImportError, AttributeError, ValueError) as error:
+                sys.exit("ERROR: Unable to load the transport '%s': %s" %
+                         (name, error))
+
+            transport = cls()
+            if isinstance(transport, AsyncTransport):
+                transport = EventLoopTransport(transport)
+        else:
+            transport = UrllibTransport()
+
+        if config['global'].get('record'):
+            transport = RecordingTransport(transport,
+                                           config['global']['record'])
+
+        atexit.register(transport.close)
+        return transport
+
+
+def request_read(repo, url, full_response=False):
+    """
+    Send a GET request to the GitHub API, subject to the read-deadline and
+    hedge-percentile options.
+
+    If hedging is enabled and no response has arrived after the configured
+    percentile of the latencies observed for the server, a duplicate request
+    is sent and whichever response arrives first is used.  If no response
+    has arrived by the deadline, this fails with a (transient) `RequestError`.
+    Requests that are given up on are left to finish in the background, and
+    their responses are discarded.
+    """
+
+    tracker = read_latencies[get_repository_option(repo, 'server')]
+    deadline = get_repository_option(repo, 'read-deadline')
+    percentile = get_repository_option(repo, 'hedge-percentile')
+
+    if deadline is None and percentile is None:
+        start = time.monotonic()
+        result = request_once(repo, url, full_response=full_response)
+        tracker.add(time.monotonic() - start)
+        return result
+
+    results = queue.Queue()
+
+    def attempt():
+        start = time.monotonic()
+        try:
+            result = request_once(repo, url, full_response=full_response)
+        except RequestError as error:
+            results.put((error, None))
+        else:
+            results.put((None, result))
+            tracker.add(time.monotonic() - start)
+
+    start = time.monotonic()
+    if deadline is not None:
+        deadline = start + float(deadline)
+
+    hedge_at = None
+    if percentile is not None:
+        hedge_delay = tracker.percentile(float(percentile))
+        if hedge_delay is not None:
+            hedge_at = start + hedge_delay
+
+    threading.Thread(target=attempt, daemon=True).start()
+    outstanding = 1
+
+    while True:
+        wake_at = min(t for t in (deadline, hedge_at, float('inf'))
+                      if t is not None)
+        timeout = None
+        if wake_at != float('inf'):
+            timeout = max(0, wake_at - time.monotonic())
+
+        try:
+            error, result = results.get(timeout=timeout)
+        except queue.Empty:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RequestError(None, 'No response within the read '
+                                   'deadline of %.1f seconds' %
+                                   (deadline - start))
+
+            # Time to hedge
+            threading.Thread(target=attempt, daemon=True).start()
+            outstanding += 1
+            hedge_at = None
+            continue
+
+        outstanding -= 1
+        if error is None:
+            return result
+        elif not outstanding:
+            raise error
+
+
+def request_once(repo, url, post_data=None, method=None,
+                 full_response=False):
+    """
+    Send a single request to the GitHub API through the transport and return
+    the decoded JSON response (or the full `Response`, if ``full_response``),
+    raising `RequestError` on any failure.
+    """
+
+    if method is None:
+        method = 'GET' if post_data is None else 'POST'
+
+    if urllib.parse.urlparse(url).scheme:
+        full_url = url
+    else:
+        repo_url = get_repository_option(repo, 'url')
+        full_url = "%s/%s" % (repo_url, url)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "User-Agent": "spacetelescope/github-issues-import"
+    }
+
+    cached = None
+    if http_cache is not None:
+        if method == 'GET':
+            cached = http_cache.get(repo, full_url)
+        else:
+            http_cache.written(repo)
+
+    if cached is not None:
+        if cached.fresh:
+            body = json.loads(cached.body)
+            if full_response:
+                return Response(200, cached.headers(), body)
+            return body
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    credential = choose_credential(repo, method)
+    headers["Authorization"] = credential.auth
+
+    timeout = float(get_repository_option(repo, 'request-timeout', 60))
+    progress.request()
+
+    try:
+        with trace_span(method, 'http', url=full_url):
+            response = get_transport().request(method, full_url, headers,
+                                               post_data, timeout)
+    except HTTPStatusError as error:
+        credential.update(error.response.headers)
+        raise
+
+    credential.update(response.headers)
+    if response.status == 304 and cached is not None:
+        http_cache.revalidated(full_url)
+        headers = cached.headers()
+        for name in set(response.headers.keys()):
+            del headers[name]
+        for name, value in response.headers.items():
+            headers[name] = value
+        response = Response(200, headers, json.loads(cached.body))
+    elif method == 'GET' and http_cache is not None:
+        http_cache.store(full_url, response.headers,
+                         json.dumps(response.body))
+
+    return response if full_response else response.body
+
+
+def get_milestones(repo):
+    """
+    Get all open milestones for repository.
+
+    Returns an `OrderedDict` keyed on the milestone title.
+    """
+
+    milestones = send_request(repo, "milestones?state=open")
+    return OrderedDict((m['title'], m) for m in milestones)
+
+
+def get_labels(repo):
+    """
+    Get all labels for repository.
+
+    Returns an `OrderedDict` keyed on label names.  If normalize-labels was
+    specified in the configuration, this also normalizes all label names and
+    ignores their original spellings.
+    """
+
+    normalize = get_repository_option(repo, 'normalize-labels')
+    labels = send_request(repo, "labels")
+    labels_dict = OrderedDict()
+    for label in labels:
+        if normalize:
+            name = normalize_label_name(label['name'])
+        else:
+            name = label['name']
+
+        labels_dict[name] = label
+    return labels_dict
+
+
+def get_issue_by_id(repo, issue_id):
+    """Get single issue from repository."""
+
+    with trace_span('fetch', issue='%s#%s' % (repo, issue_id)):
+        issue = send_request(repo, "issues/%d" % issue_id)
+    issue['repository'] = repo
+    return issue
+
+
+def get_issues_by_id(repo, issue_ids):
+    """Get list of issues from repository for multiple issue numbers."""
+
+    return [get_issue_by_id(repo, int(issue_id)) for issue_id in issue_ids]
+
+
+def get_issues(repo, state=None):
+    """
+    Get all issues from repository.
+
+    Optionally, only retrieve issues of in the specified state ('open' or
+    'closed')."""
+
+    return list(iter_issues(repo, state=state))
+
+
+def iter_issues(repo, state=None, filters=None):
+    """
+    Like `get_issues`, but returns an iterator over the issues, fetching them
+    one page at a time as needed.
+
+    If given, ``filters`` further restricts the issues returned (see
+    `get_issue_filters`).  Where the issues list API does not support all of
+    the filters the issues are found using the search API instead.
+    """
+
+    filters = filters or {}
+    if set(filters) - set(LIST_API_FILTERS):
+        try:
+            yield from search_issues(repo, state, filters)
+        except RequestError as error:
+            sys.exit(str(error))
+        return
+
+    page = 1
+    while True:
+        query_args = {'direction': 'asc', 'page': page}
+        if state in ('open', 'closed', 'all'):
+            query_args['state'] = state
+
+        for option, value in filters.items():
+            if isinstance(value, list):
+                value = ','.join(value)
+            query_args[LIST_API_FILTERS[option]] = value
+
+        # TODO: Consider building this into send_request in the form of
+        # optional kwargs or something
+        query = urllib.parse.urlencode(query_args)
+        with trace_span('fetch', repository=repo, page=page):
+            new_issues = send_request(repo, 'issues?' + query)
+        if not new_issues:
+            break
+
+        # Add a 'repository' key to each issue; although this information can
+        # be gleaned from the issue data it's easier to include here explicitly
+        for issue in new_issues:
+            issue['repository'] = repo
+            yield issue
+
+        page += 1
+
+
+def search_issues(repo, state, filters, terms=()):
+    """
+    Returns an iterator over the issues in the repository in the given state
+    ('open', 'closed', or 'all'/`None`) that match the given filters, and any
+    additional search ``terms``, found using the search API, in order of
+    creation.  Raises `RequestError` if a search fails.
+
+    As the search API returns no more than the first 1000 results of any
+    query, once those are exhausted the search is repeated for only the issues
+    created since the last one returned so far (skipping those at the boundary
+    that were already returned).
+    """
+
+    qualifiers = ['repo:%s' % repo]
+    if state in ('open', 'closed'):
+        qualifiers.append('state:%s' % state)
+    if filters.get('issue-type') == 'issues':
+        qualifiers.append('is:issue')
+    elif filters.get('issue-type') == 'pulls':
+        qualifiers.append('is:pr')
+    for label in filters.get('filter-labels', []):
+        qualifiers.append('label:"%s"' % label)
+    if filters.get('filter-milestone'):
+        qualifiers.append('milestone:"%s"' % filters['filter-milestone'])
+    if filters.get('filter-creator'):
+        qualifiers.append('author:%s' % filters['filter-creator'])
+    if filters.get('created-before'):
+        qualifiers.append('created:<%s' % filters['created-before'])
+    if filters.get('updated-since'):
+        qualifiers.append('updated:>=%s' % filters['updated-since'])
+    if filters.get('updated-before'):
+        qualifiers.append('updated:<%s' % filters['updated-before'])
+    qualifiers.extend(terms)
+
+    search_url = get_repository_option(repo, 'search-url')
+    per_page = 100
+    created_since = filters.get('created-since')
+    seen = set()
+
+    while True:
+        query = list(qualifiers)
+        if created_since:
+            query.append('created:>=%s' % created_since)
+
+        last_created = None
+        for page in range(1, SEARCH_RESULT_LIMIT // per_page + 1):
+            query_args = {'q': ' '.join(query), 'sort': 'created',
+                          'order': 'asc', 'per_page': per_page, 'page': page}
+            with trace_span('fetch', repository=repo, page=page):
+                result = request_with_retries(repo, '%s?%s' % (
+                        search_url, urllib.parse.urlencode(query_args)))
+
+            for issue in result['items']:
+                last_created = issue['created_at']
+                if issue['number'] in seen:
+                    continue
+
+                seen.add(issue['number'])
+                issue['repository'] = repo
+                yield issue
+
+            if len(result['items']) < per_page:
+                return
+
+        if last_created is None or last_created == created_since:
+            # More than SEARCH_RESULT_LIMIT issues were created in the same
+            # second; there is no way to page past them
+            raise RequestError(None, 'Unable to search for issues in %s '
+                               'created after %s: too many issues were '
+                               'created at the same time.' %
+                               (repo, last_created))
+
+        created_since = last_created
+
+
+def get_issue_filters(repo):
+    """
+    Returns the filters on which issues are selected from the repository (the
+    label, milestone, creator, created and updated date, and issue type
+    options) as a `dict` of only those options that are set.
+    """
+
+    filters = {}
+    for option in ISSUE_FILTER_OPTS:
+        value = get_repository_option(repo, option)
+        if value and option == 'filter-labels':
+            value = split_multiple_value(value)
+        if value:
+            filters[option] = value
+
+    return filters
+
+
+def issue_matches_filters(issue, filters):
+    """
+    Returns `True` if the given issue matches the filters returned by
+    `get_issue_filters`; for issues that were not already filtered by the
+    GitHub API (such as those selected by number, or received by webhook).
+    """
+
+    labels = [label['name'] for label in issue['labels']]
+    if not all(label in labels for label in filters.get('filter-labels', [])):
+        return False
+
+    if 'filter-milestone' in filters and (
+            not issue['milestone'] or
+            issue['milestone']['title'] != filters['filter-milestone']):
+        return False
+
+    if 'filter-creator' in filters and (
+            issue['user']['login'].lower() !=
+            filters['filter-creator'].lower()):
+        return False
+
+    # Dates given as YYYY-MM-DD compare correctly with full ISO-8601
+    # timestamps as strings
+    for option, field in (('created', 'created_at'), ('updated', 'updated_at')):
+        if (option + '-since' in filters and
+                issue[field] < filters[option + '-since']):
+            return False
+        if (option + '-before' in filters and
+                issue[field] >= filters[option + '-before']):
+            return False
+
+    if 'issue-type' in filters:
+        is_pull_request = 'pull_request' in issue
+        if is_pull_request != (filters['issue-type'] == 'pulls'):
+            return False
+
+    return True
+
+
+def iter_migrated_issues(repo, filters):
+    """
+    Returns an iterator over the issues in the repository that were already
+    migrated to any of the target repositories.
+
+    Rather than fetching every issue and checking its body for the backref,
+    the search API is used to find only those issues that mention one of the
+    target repositories in their body, and only those are checked.  If the search
+    fails (the search API may be unavailable, for example on some GitHub
+    Enterprise installations), all issues are checked instead.
+    """
+
+    targets = config['global']['targets']
+    terms = [' OR '.join('"Migrated to %s"' % target for target in targets),
+             'in:body']
+
+    def was_migrated(issue):
+        return any(issue_was_migrated(issue, target) for target in targets)
+
+    # Collect the results of the search before returning any of them, so that
+    # if it fails part way there are no duplicates from falling back to the
+    # full scan
+    try:
+        migrated_issues = [issue for issue in
+                           search_issues(repo, 'all', filters, terms)
+                           if was_migrated(issue)]
+    except RequestError as error:
+        print("WARNING: Searching for migrated issues in '%s' failed; "
+              "checking all of its issues instead:\n%s" % (repo, error))
+        return (issue for issue in iter_issues(repo, state='all',
+                                               filters=filters)
+                if was_migrated(issue))
+
+    return iter(migrated_issues)
+
+
+def iter_selected_issues(repo):
+    """
+    Returns an iterator over the issues selected from a source repository by
+    the import-issues option and the issue filters.
+    """
+
+    issues_to_import = get_repository_option(repo, 'import-issues')
+    filters = get_issue_filters(repo)
+
+    if (len(issues_to_import) == 1 and
+            issues_to_import[0] in ('all', 'open', 'closed')):
+        return iter_issues(repo, state=issues_to_import[0], filters=filters)
+    elif len(issues_to_import) == 1 and issues_to_import[0] == 'migrated':
+        return iter_migrated_issues(repo, filters)
+    else:
+        return (issue for issue in get_issues_by_id(repo, issues_to_import)
+                if issue_matches_filters(issue, filters))
+
+
+def iter_source_issues(sources):
+    """
+    Returns an iterator over ``(repository, issue)`` for the selected issues
+    from all of the given source repositories.
+
+    The repositories are fetched concurrently, each by its own thread (so
+    that each uses the connections and rate limit budget of its own server),
+    and the issues are returned in the order they arrive; they are sorted
+    afterwards.  If fetching from any of the repositories fails the error is
+    re-raised here.
+    """
+
+    results = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+
+    def fetch(repo):
+        try:
+            for issue in iter_selected_issues(repo):
+                results.put((repo, issue, None))
+        except BaseException as error:
+            # Including the SystemExit from send_request, which would
+            # otherwise only end this thread
+            results.put((repo, None, error))
+        else:
+            results.put((repo, None, None))
+
+    for repo in sources:
+        threading.Thread(target=fetch, args=(repo,), name='fetch ' + repo,
+                         daemon=True).start()
+
+    remaining = len(sources)
+    while remaining:
+        repo, issue, error = results.get()
+        if error is not None:
+            raise error
+        elif issue is None:
+            remaining -= 1
+        else:
+            yield repo, issue
+
+
+def issue_sort_key(issue):
+    """
+    Key for sorting issues from all source repositories into the order in
+    which they are inserted into the target repository.
+
+    Sorts chronologically first, then if there there is an overlap there (the
+    API only offers second-level resolution) sort also by issue number so that
+    issues created in the same second in the same repository should still be
+    inserted in the correct order.  This is returned as a string (ISO-8601
+    timestamps in UTC sort chronologically as strings) so that it can also be
+    used for a `DiskDict`.
+    """
+
+    return '%s %010d' % (issue['created_at'], issue['number'])
+
+
+def load_snapshot(filename, sources):
+    """
+    Returns an iterator over ``(repository, issue)`` for the issues from the
+    given source repositories in a snapshot saved by `save_snapshot`.
+    """
+
+    with open(filename) as f:
+        for line in f:
+            issue = json.loads(line)
+            if issue['repository'] in sources:
+                yield issue['repository'], issue
+
+
+def save_snapshot(filename, source_issues):
+    """
+    Save the issues from ``source_issues``, an iterator over ``(repository,
+    issue)``, to a snapshot file (as one JSON object per line) while passing
+    them on.  The file is only put in place once all of the issues are saved.
+    """
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        for repo, issue in source_issues:
+            f.write(json.dumps(issue) + '\n')
+            yield repo, issue
+
+    os.replace(tmp_filename, filename)
+
+
+# Selecting issues with --select: the expression is parsed into a tree of
+# tuples, ('and', a, b), ('or', a, b), ('not', a), or ('term', field, value),
+# where field is None for words and phrases to find in the title or body,
+# which is evaluated against an `IssueIndex` of the fetched issues.
+
+SELECT_TOKEN_RE = re.compile(r'\s*(?:([()])|([^\s()"]+:"[^"]*"|"[^"]*"|'
+                             r'[^\s()"]+))')
+SELECT_FIELDS = ('label', 'milestone', 'author', 'repo', 'state', 'is', 'no',
+                 'created', 'updated', 'closed')
+SELECT_DATE_FIELDS = ('created', 'updated', 'closed')
+SELECT_DATE_OPS = ('<=', '>=', '<', '>')
+
+# Words in issue titles and bodies, as indexed for --select
+WORD_RE = re.compile(r'\w+')
+
+
+def parse_selection(expression):
+    """
+    Parse a --select expression (see the --select option), returning its
+    tree; raises `ValueError` if it is invalid.
+    """
+
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = SELECT_TOKEN_RE.match(expression, pos)
+        if m is None:
+            raise ValueError("unbalanced quotes")
+        tokens.append(m.group(1) or m.group(2))
+        pos = m.end()
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def parse_or():
+        tree = parse_and()
+        while peek() == 'OR':
+            tokens.pop(0)
+            tree = ('or', tree, parse_and())
+        return tree
+
+    def parse_and():
+        tree = parse_not()
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                tokens.pop(0)
+            tree = ('and', tree, parse_not())
+        return tree
+
+    def parse_not():
+        if peek() == 'NOT':
+            tokens.pop(0)
+            return ('not', parse_not())
+        return parse_term()
+
+    def parse_term():
+        if not tokens:
+            raise ValueError("unexpected end of expression")
+
+        token = tokens.pop(0)
+        if token == '(':
+            tree = parse_or()
+            if peek() != ')':
+                raise ValueError("missing closing parenthesis")
+            tokens.pop(0)
+            return tree
+        elif token in (')', 'AND', 'OR'):
+            raise ValueError("unexpected '%s'" % token)
+        elif token.startswith('"'):
+            return ('term', None, token.strip('"'))
+
+        field, sep, value = token.partition(':')
+        if not sep:
+            return ('term', None, token)
+
+        field = field.lower()
+        value = value.strip('"')
+        if field not in SELECT_FIELDS:
+            raise ValueError("unknown field '%s'" % field)
+        if field == 'state' and value not in ('open', 'closed'):
+            raise ValueError("state must be open or closed")
+        if field == 'is' and value not in ('issue', 'pr', 'open', 'closed'):
+            raise ValueError("is must be issue, pr, open or closed")
+        if field == 'no' and value not in ('label', 'milestone'):
+            raise ValueError("no must be label or milestone")
+        if not value:
+            raise ValueError("no value given for '%s'" % field)
+        return ('term', field, value)
+
+    if not tokens:
+        raise ValueError("empty expression")
+
+    tree = parse_or()
+    if tokens:
+        raise ValueError("unexpected '%s'" % tokens[0])
+
+    return tree
+
+
+class IssueIndex:
+    """
+    Indexes of issues for evaluating --select expressions: the positions of
+    the issues with each label, milestone, author, repository and state, of
+    issues and pull requests, and (in order) of the issues with each word in
+    their title or body, and the issues sorted by each of their dates.
+    """
+
+    def __init__(self, issues):
+        self.num_issues = 0
+        self.fields = defaultdict(lambda: defaultdict(set))
+        self.words = defaultdict(list)
+        self.texts = []
+        dates = dict((field, []) for field in SELECT_DATE_FIELDS)
+
+        for pos, issue in enumerate(issues):
+            self.num_issues += 1
+            fields = self.fields
+            for label in issue.get('labels') or []:
+                fields['label'][label['name'].lower()].add(pos)
+            if not issue.get('labels'):
+                fields['no']['label'].add(pos)
+            if issue.get('milestone'):
+                fields['milestone'][
+                        issue['milestone']['title'].lower()].add(pos)
+            else:
+                fields['no']['milestone'].add(pos)
+            fields['author'][issue['user']['login'].lower()].add(pos)
+            fields['repo'][issue['repository'].lower()].add(pos)
+            fields['state'][issue['state']].add(pos)
+            fields['is'][issue['state']].add(pos)
+            fields['is']['pr' if 'pull_request' in issue else 'issue'].add(pos)
+
+            for field in SELECT_DATE_FIELDS:
+                if issue.get(field + '_at'):
+                    dates[field].append((issue[field + '_at'], pos))
+
+            text = '%s\n%s' % (issue['title'], issue['body'] or '')
+            text = text.lower()
+            self.texts.append(text)
+            words = self.words
+            for word in set(WORD_RE.findall(text)):
+                words[word].append(pos)
+
+        self.dates = {}
+        for field, values in dates.items():
+            values.sort()
+            self.dates[field] = ([date for date, _ in values],
+                                 [pos for _, pos in values])
+
+    def select(self, tree):
+        """
+        Returns the set of the positions of the issues selected by a tree
+        returned by `parse_selection`.
+        """
+
+        if tree[0] == 'and':
+            return self.select(tree[1]) & self.select(tree[2])
+        elif tree[0] == 'or':
+            return self.select(tree[1]) | self.select(tree[2])
+        elif tree[0] == 'not':
+            return set(range(self.num_issues)) - self.select(tree[1])
+
+        _, field, value = tree
+        if field is None:
+            return self.select_text(value.lower())
+        elif field in SELECT_DATE_FIELDS:
+            return self.select_dates(field, value)
+        elif field in ('state', 'is', 'no'):
+            return set(self.fields[field].get(value, ()))
+        else:
+            return set(self.fields[field].get(value.lower(), ()))
+
+    def select_text(self, text):
+        words = WORD_RE.findall(text)
+        if not words:
+            return set()
+
+        # Issues containing all of the words (starting from the rarest), and
+        # if that was a phrase, the phrase itself
+        postings = sorted((self.words.get(word, []) for word in words),
+                          key=len)
+        selected = set(postings[0]).intersection(*postings[1:])
+        if len(words) > 1 or words[0] != text:
+            phrase_re = re.compile(r'(?<!\w)%s(?!\w)' % re.escape(text))
+            selected = set(pos for pos in selected
+                           if phrase_re.search(self.texts[pos]))
+
+        return selected
+
+    def select_dates(self, field, value):
+        # Dates given as YYYY-MM-DD (or a prefix of it) compare correctly
+        # with full ISO-8601 timestamps as strings
+        dates, positions = self.dates[field]
+        for op in SELECT_DATE_OPS:
+            if value.startswith(op):
+                value = value[len(op):]
+                break
+        else:
+            op = None
+
+        if op == '<':
+            start, end = 0, bisect.bisect_left(dates, value)
+        elif op == '<=':
+            # Including dates starting with the given date
+            start, end = 0, bisect.bisect_right(dates, value + '\uffff')
+        elif op == '>':
+            start, end = bisect.bisect_right(dates, value + '\uffff'), len(dates)
+        elif op == '>=':
+            start, end = bisect.bisect_left(dates, value), len(dates)
+        else:
+            start = bisect.bisect_left(dates, value)
+            end = bisect.bisect_right(dates, value + '\uffff')
+
+        return set(positions[start:end])
+
+
+def select_issues(issues, expression):
+    """
+    Returns a working set of the issues in the ``issues`` working set (keyed
+    on their `Issue`) that match the given --select expression.
+    """
+
+    tree = parse_selection(expression)
+
+    start = time.perf_counter()
+    keys = list(issues)
+    index = IssueIndex(issues.values())
+    indexed = time.perf_counter()
+    positions = sorted(index.select(tree))
+    selected_time = time.perf_counter() - indexed
+
+    print("Selected %d of %d issues in %.3f seconds (indexed in %.3f "
+          "seconds)" % (len(positions), len(keys), selected_time,
+                        indexed - start))
+
+    selected = new_working_set('selected_issues', key_type=Issue,
+                               sort_key=issue_sort_key)
+    for pos in positions:
+        selected[keys[pos]] = issues[keys[pos]]
+
+    return selected
+
+
+class SharedByTargets:
+    """
+    The state of the source issues that is shared between the imports into
+    several target repositories: the comments on each issue, fetched only
+    once for all the targets, and the bodies of the issue and its comments as
+    last updated with a backref (see `add_backref`).
+
+    The number of targets that will import or update each issue is given up
+    front with `expect`; issues not expected by any target have no shared
+    state.  The comments are dropped once each of those targets has taken
+    them, and the rest once each has released the issue when done with it
+    and all the backrefs queued for it have been written.  Only then are the
+    fingerprints of the issue for each target recorded (see
+    `record_fingerprint`), as the backref for each target changes the issue.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def expect(self, key, num_targets):
+        with self.lock:
+            self.entries[key] = {'lock': threading.Lock(),
+                                 'targets': num_targets, 'taken': 0,
+                                 'released': 0, 'bodies': {}, 'writes': 0,
+                                 'issue': None, 'fingerprints': {}}
+
+    def get(self, key):
+        """
+        Returns the entry for the source issue ``key``, or `None` if not
+        expected; its 'lock' must be held while using it.
+        """
+
+        with self.lock:
+            return self.entries.get(key)
+
+    def release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['released'] += 1
+                self.finish(key)
+
+    def writing(self, key):
+        """
+        Record that an update to the source issue ``key`` was queued, whose
+        result is to be passed to `fingerprinted` once it is written.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['writes'] += 1
+
+    def fingerprinted(self, key, target, fingerprint=None, issue=None):
+        """
+        Record the fingerprint of the source issue ``key`` for the target, to
+        be recorded once all targets are done with it: either ``fingerprint``,
+        or that of ``issue``, the source issue as written by an update queued
+        with `writing`.  Returns `False` if the issue is not shared.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+
+            if issue is not None:
+                entry['writes'] -= 1
+                if (entry['issue'] is None or
+                        issue['updated_at'] >= entry['issue']['updated_at']):
+                    entry['issue'] = issue
+
+            entry['fingerprints'][target] = fingerprint
+            self.finish(key)
+            return True
+
+    def finish(self, key, force=False):
+        # Called with the lock held
+        entry = self.entries[key]
+        if not force and (entry['released'] < entry['targets'] or
+                          entry['writes']):
+            return
+
+        del self.entries[key]
+        # The fingerprints of the issue as last written supersede those of
+        # the issue as it was before
+        for target, fingerprint in entry['fingerprints'].items():
+            if entry['issue'] is not None:
+                fingerprint = issue_fingerprint(entry['issue'], target)
+            fingerprints[fingerprint_key(key, target)] = fingerprint
+
+    def clear(self):
+        """
+        Drop all the shared state, recording the fingerprints of the issues
+        still shared (left by an import that failed).
+        """
+
+        with self.lock:
+            for key in list(self.entries):
+                self.finish(key, force=True)
+
+
+shared_issues = SharedByTargets()
+
+
+def get_comments_on_issue(repo, issue):
+    """
+    Get all comments on an issue in the specified repository.
+
+    With several targets the comments on source issues are only fetched once,
+    and each target gets its own copy of them.
+    """
+
+    if issue['comments'] == 0:
+        return []
+
+    entry = None
+    if len(config['global']['targets']) > 1:
+        entry = shared_issues.get(Issue(repo, int(issue['number'])))
+
+    if entry is None:
+        return fetch_comments_on_issue(repo, issue)
+
+    with entry['lock']:
+        comments = entry.get('comments')
+        if comments is None:
+            comments = entry['comments'] = fetch_comments_on_issue(repo,
+                                                                   issue)
+
+        entry['taken'] += 1
+        if entry['taken'] >= entry['targets']:
+            del entry['comments']
+
+    return [dict(comment) for comment in comments]
+
+
+def fetch_comments_on_issue(repo, issue):
+    with trace_span('fetch comments',
+                    issue='%s#%s' % (repo, issue['number'])):
+        comments = send_request(repo, "issues/%s/comments" % issue['number'])
+    for comment in comments:
+        memory.record('comments', comment)
+    return comments
+
+
+def find_created_issue(repo, new_issue):
+    """
+    Check whether an issue was created in the repository by a request that
+    failed, by looking for an issue with exactly the same title and body among
+    the most recently created ones.  Returns the issue, or `None` if not found.
+    """
+
+    query = urllib.parse.urlencode({'state': 'all', 'sort': 'created',
+                                    'direction': 'desc', 'per_page': 10})
+    for issue in request_with_retries(repo, 'issues?' + query):
+        if (issue['title'] == new_issue['title'] and
+                issue['body'] == new_issue['body']):
+            return issue
+
+    return None
+
+
+def find_created_comment(repo, issue_number, new_comment, since):
+    """
+    Check whether a comment was created on an issue by a request that failed
+    (made no earlier than the ISO-8601 timestamp ``since``), by looking for a
+    comment with exactly the same body.  Returns the comment, or `None` if not
+    found.
+    """
+
+    query = urllib.parse.urlencode({'since': since})
+    comments = request_with_retries(repo, 'issues/%s/comments?%s' %
+                                    (issue_number, query))
+    for comment in comments:
+        if comment['body'] == new_comment['body']:
+            return comment
+
+    return None
+
+
+def find_created_milestone(repo, title):
+    """
+    Check whether a milestone with the given title exists in the repository
+    (e.g. created by a request that failed); returns it, or `None`.
+    """
+
+    query = urllib.parse.urlencode({'state': 'all', 'per_page': 100})
+    for milestone in request_with_retries(repo, 'milestones?' + query):
+        if milestone['title'] == title:
+            return milestone
+
+    return None
+
+
+def find_created_label(repo, name):
+    """
+    Check whether a label with the given name exists in the repository (e.g.
+    created by a request that failed); returns it, or `None`.
+    """
+
+    try:
+        return request_with_retries(repo, 'labels/' +
+                                    urllib.parse.quote(name, safe=''))
+    except RequestError as error:
+        if error.code == 404:
+            return None
+        raise
+
+
+def import_milestone(source, target):
+    data = {
+        "title": source['title'],
+        "state": "open",
+        "description": source['description'],
+        "due_on": source['due_on']
+    }
+
+    result_milestone = send_request(
+            target, "milestones", source,
+            recover=lambda: find_created_milestone(target, source['title']))
+    print("Successfully created milestone '%s'" % result_milestone['title'])
+    return result_milestone
+
+
+def import_label(source, target):
+    data = {
+        "name": source['name'],
+        "color": source['color']
+    }
+
+    result_label = send_request(
+            target, "labels", source,
+            recover=lambda: find_created_label(target, source['name']))
+    print("Successfully created label '%s'" % result_label['name'])
+    return result_label
+
+
+class SourceUpdateQueue:
+    """
+    Queue of updates to issues and comments in the source repositories (adding
+    backrefs or closing issues) that are sent in batches of aliased GraphQL
+    mutations, rather than one REST request each.
+
+    Each update can have a callback, which is called with the updated issue or
+    comment once the update has been made.  Updates that fail as part of a
+    batch are retried individually through the REST API.
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(list)
+        self.lock = threading.RLock()
+
+    def add(self, repo, url, node_id, update, callback=None):
+        with self.lock:
+            self.pending[repo].append((url, node_id, update, callback))
+            if len(self.pending[repo]) >= GRAPHQL_BATCH_SIZE:
+                self.flush(repo)
+
+    def flush(self, repo=None):
+        """Send all queued updates (for the given repository only, if any)."""
+
+        with self.lock:
+            for repo in ([repo] if repo is not None else list(self.pending)):
+                batch = self.pending.pop(repo, [])
+                if batch:
+                    self.send_batch(repo, batch)
+
+    def send_batch(self, repo, batch):
+        variables = {}
+        params = []
+        mutations = []
+
+        for idx, (url, node_id, update, _) in enumerate(batch):
+            inputs = ['id: $id%d' % idx]
+            params.append('$id%d: ID!' % idx)
+            variables['id%d' % idx] = node_id
+
+            if 'body' in update:
+                inputs.append('body: $body%d' % idx)
+                params.append('$body%d: String!' % idx)
+                variables['body%d' % idx] = update['body']
+
+            if url.startswith('issues/comments/'):
+                mutations.append(
+                        'u%d: updateIssueComment(input: {%s}) '
+                        '{ issueComment { id } }' % (idx, ', '.join(inputs)))
+            else:
+                if update.get('state') == 'closed':
+                    inputs.append('state: CLOSED')
+
+                mutations.append(
+                        'u%d: updateIssue(input: {%s}) { issue { %s } }' %
+                        (idx, ', '.join(inputs), GRAPHQL_ISSUE_FIELDS))
+
+        query = 'mutation(%s) {\n%s\n}' % (', '.join(params),
+                                            '\n'.join(mutations))
+
+        try:
+            result = request_with_retries(
+                    repo, get_repository_option(repo, 'graphql-url'),
+                    {'query': query, 'variables': variables},
+                    idempotent=True)
+        except RequestError as error:
+            print("WARNING: Batched update of %d issues and comments in '%s' "
+                  "failed; updating them one at a time instead:\n%s" %
+                  (len(batch), repo, error))
+            result = {}
+
+        data = result.get('data') or {}
+        num_failed = 0
+        for idx, (url, node_id, update, callback) in enumerate(batch):
+            updated = data.get('u%d' % idx)
+            if updated and 'issue' in updated:
+                updated = graphql_issue_to_rest(updated['issue'])
+            elif updated:
+                updated = updated['issueComment']
+            else:
+                # Reconcile any failed updates through the REST API
+                updated = send_request(repo, url, update, 'PATCH')
+                num_failed += 1
+
+            if callback is not None:
+                callback(updated)
+
+        print("Sent %d queued updates to original issues and comments in "
+              "'%s'%s" % (len(batch), repo,
+                          ' (%d retried individually)' % num_failed
+                          if num_failed else ''))
+
+
+def graphql_issue_to_rest(issue):
+    """
+    Convert an issue returned by a GraphQL mutation (with the fields in
+    GRAPHQL_ISSUE_FIELDS) to the corresponding subset of a REST API issue.
+    """
+
+    assignees = issue['assignees']['nodes']
+    return {
+        'updated_at': issue['updatedAt'],
+        'title': issue['title'],
+        'state': issue['state'].lower(),
+        'comments': issue['comments']['totalCount'],
+        'labels': issue['labels']['nodes'],
+        'milestone': issue['milestone'],
+        'assignee': assignees[0] if assignees else None
+    }
+
+
+source_updates = SourceUpdateQueue()
+
+
+def update_source(repo, url, node_id, update, callback=None):
+    """
+    Update an issue or comment (at ``url``) in a source repository, either
+    right away, or by queuing it on ``source_updates`` if the
+    batch-source-updates option is set.  ``callback``, if given, is called
+    with the updated issue or comment once the update has been made.
+
+    Returns `True` if the update was made right away, or `False` if queued.
+    """
+
+    if get_repository_option(repo, 'batch-source-updates') and node_id:
+        source_updates.add(repo, url, node_id, update, callback)
+        return False
+
+    result = send_request(repo, url, update, 'PATCH')
+    if callback is not None:
+        callback(result)
+
+    return True
+
+
+def add_backref(orig_issue_id, url, message, current, update=None,
+                callback=None):
+    """
+    Add a backref ``message`` to the top of the body of a source issue or one
+    of its comments (at ``url``) with `update_source`, along with any other
+    ``update``.  ``current`` is called to get its current body and node ID.
+
+    With several targets, each adds its backref to the same issues and
+    comments concurrently; the body last written for each is kept (and used
+    instead of calling ``current`` again), so that the backrefs to all the
+    targets accumulate rather than overwriting each other.
+    """
+
+    repo = orig_issue_id.repository
+    update = dict(update or {})
+
+    entry = None
+    if len(config['global']['targets']) > 1:
+        entry = shared_issues.get(orig_issue_id)
+
+    if entry is None:
+        body, node_id = current()
+        update['body'] = message + '\n\n' + body
+        return update_source(repo, url, node_id, update, callback)
+
+    with entry['lock']:
+        body, node_id = entry['bodies'].get(url) or current()
+        update['body'] = message + '\n\n' + body
+        entry['bodies'][url] = (update['body'], node_id)
+        # Still holding the entry, so that the updates are made in order
+        return update_source(repo, url, node_id, update, callback)
+
+
+def render_comment(comment, source_repo, issue_map):
+    """Render a comment from the source repository with the comment template."""
+
+    body = fixup_cross_references(comment['body'], source_repo, issue_map)
+
+    template_data = {}
+    template_data['user_name'] = comment['user']['login']
+    template_data['user_url'] = comment['user']['html_url']
+    template_data['user_avatar'] = comment['user']['avatar_url']
+    template_data['date'] = format_date(comment['created_at'])
+    template_data['url'] =  comment['html_url']
+    template_data['body'] = body
+
+    return format_comment(template_data)
+
+
+def rendered_comment(comment, source_repo, issue_map):
+    """
+    Returns the comment rendered with the comment template, as rendered
+    already by `render_new_issue` if it was, or rendering it now otherwise.
+    """
+
+    if 'rendered' in comment:
+        return comment['rendered']
+
+    return render_comment(comment, source_repo, issue_map)
+
+
+def post_comment(target, issue_number, body):
+    """Create a comment on an issue in the target repository."""
+
+    new_comment = {'body': body}
+
+    # Allow for some clock skew between us and the server when checking for
+    # comments created by a failed request
+    since = time.strftime(ISO_8601_UTC, time.gmtime(time.time() - 600))
+    return send_request(
+            target, "issues/%s/comments" % issue_number, new_comment,
+            recover=lambda: find_created_comment(target, issue_number,
+                                                 new_comment, since))
+
+
+def collapse_comments(orig_issue_id, comments, issue_map, body=None):
+    """
+    Render comments for the collapse-comments option: each comment is
+    rendered with the comment template, preceded by a hidden marker of the
+    original comment (see `collapsed_comment_ids`).
+
+    As many of the comments as fit within `MAX_BODY_LENGTH` are appended to
+    ``body``, if given, and the rest are packed into as few comment bodies as
+    possible.  Returns the new body, and a list of ``(comment_body,
+    num_comments)`` for the comments to create.
+    """
+
+    source_repo = orig_issue_id.repository
+    bodies = []
+    counts = []
+    if body is not None:
+        bodies.append(body)
+        counts.append(0)
+
+    for comment in comments:
+        rendered = '%s\n%s' % (
+                COLLAPSED_COMMENT_MARKER % (source_repo, comment['id']),
+                rendered_comment(comment, source_repo, issue_map))
+        if len(rendered) > MAX_BODY_LENGTH:
+            truncated = '\n\n*(truncated)*'
+            rendered = (rendered[:MAX_BODY_LENGTH - len(truncated)] +
+                        truncated)
+
+        if not bodies or (len(bodies[-1]) + len(COLLAPSED_COMMENT_SEPARATOR) +
+                          len(rendered) > MAX_BODY_LENGTH):
+            bodies.append(rendered)
+            counts.append(1)
+        elif bodies[-1]:
+            bodies[-1] += COLLAPSED_COMMENT_SEPARATOR + rendered
+            counts[-1] += 1
+        else:
+            bodies[-1] = rendered
+            counts[-1] += 1
+
+    if body is not None:
+        body = bodies.pop(0)
+        counts.pop(0)
+
+    return body, list(zip(bodies, counts))
+
+
+def post_collapsed_comments(chunks, target, issue_number):
+    """
+    Create the comments returned by `collapse_comments` on an issue in the
+    target repository.
+    """
+
+    result_comments = []
+    for body, num_comments in chunks:
+        result_comments.append(post_comment(target, issue_number, body))
+        for _ in range(num_comments):
+            progress.comment_done()
+
+    return result_comments
+
+
+def import_comments(orig_issue_id, comments, issue_id, issue_map):
+    result_comments = []
+    source_repo = orig_issue_id.repository
+    target, issue_number = issue_id
+
+    if get_repository_option(source_repo, 'collapse-comments'):
+        _, chunks = collapse_comments(orig_issue_id, comments, issue_map)
+        return post_collapsed_comments(chunks, target, issue_number)
+
+    for comment in comments:
+        result_comment = post_comment(
+                target, issue_number, rendered_comment(comment, source_repo,
+                                                       issue_map))
+        result_comments.append(result_comment)
+        progress.comment_done()
+
+        if get_repository_option(source_repo, 'create-backrefs'):
+            # Update the original comment to mark it as migrated, and link to
+            # the migrated comment
+
+            message = (
+                '*Migrated to [%s#%s (comment)](%s) by '
+                '[spacetelescope/github-issues-import]'
+                '(https://github.com/spacetelescope/github-issues-import)*' %
+                (target, issue_number, result_comment['html_url']))
+
+            add_backref(orig_issue_id, 'issues/comments/%s' % comment['id'],
+                        message, lambda: (comment['body'],
+                                          comment.get('node_id')))
+
+    return result_comments
+
+
+def collapsed_comment_ids(repo, issue):
+    """
+    Returns the set of ``(repository, comment_id)`` of the original comments
+    that were migrated, with the collapse-comments option, into the body of
+    the given issue in the repository or its comments.
+    """
+
+    bodies = [issue['body'] or '']
+    bodies.extend(comment['body'] for comment in
+                  get_comments_on_issue(repo, issue))
+
+    return set((match.group(1), int(match.group(2)))
+               for body in bodies
+               for match in COLLAPSED_COMMENT_RE.finditer(body))
+
+
+def issue_fingerprint(issue, target=None):
+    """
+    Returns a fingerprint of a source issue (as returned by the API) that
+    changes whenever anything that --update-existing would transfer to the
+    migrated issue (in the given target, by default the first) may have
+    changed.
+    """
+
+    data = [target or config['global']['target'],
+            issue['updated_at'],
+            issue.get('comments', 0),
+            issue['title'],
+            issue['state'],
+            sorted(label['name'] for label in issue.get('labels') or []),
+            (issue.get('milestone') or {}).get('title'),
+            (issue.get('assignee') or {}).get('login')]
+
+    return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def record_fingerprint(orig_issue_id, target, fingerprint=None, issue=None):
+    """
+    Record the fingerprint of a source issue migrated to or updated in the
+    target: either the given ``fingerprint``, or that of ``issue``, the source
+    issue as written with its backref to the target.
+
+    With several targets the fingerprints are only recorded once every
+    target is done with the issue (see `SharedByTargets`), from the source
+    issue as last written, so that the backrefs to the other targets do not
+    count as changes next time.
+    """
+
+    if shared_issues.fingerprinted(orig_issue_id, target, fingerprint, issue):
+        return
+
+    if fingerprint is None:
+        fingerprint = issue_fingerprint(issue, target)
+    fingerprints[fingerprint_key(orig_issue_id, target)] = fingerprint
+
+
+def fingerprint_key(orig_issue_id, target):
+    """
+    Returns the key in ``fingerprints`` for the fingerprint of the given
+    source issue as migrated to the given target.
+    """
+
+    if target == config['global']['target']:
+        return str(orig_issue_id)
+
+    return '%s -> %s' % (orig_issue_id, target)
+
+
+def load_fingerprints():
+    """
+    Load the fingerprints recorded by previous runs from the file given by
+    the fingerprints option, if any.
+    """
+
+    filename = config['global'].get('fingerprints')
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            fingerprints.update(json.load(f))
+
+
+def save_fingerprints():
+    """Save the fingerprints to the file given by the fingerprints option."""
+
+    filename = config['global'].get('fingerprints')
+    if not filename:
+        return
+
+    # Write to a temporary file first so that an interrupted save does not
+    # lose all the fingerprints
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(fingerprints, f)
+
+    os.replace(filename + '.tmp', filename)
+
+
+@functools.lru_cache(maxsize=None)
+def migrated_issue_re(target):
+    """
+    The pattern matching the backref added to an original issue migrated to
+    the target repository, capturing the repository and the migrated issue's
+    number.
+    """
+
+    return re.compile(r'^\*Migrated to (%s)#(\d+) by.*'
+                      r'spacetelescope/github-issues-import' % target)
+
+
+@functools.lru_cache(maxsize=None)
+def migrated_comment_re(target):
+    """
+    The pattern matching the backref added to an original comment migrated to
+    the target repository.
+    """
+
+    return re.compile(r'^\*Migrated to \[(%s)#(\d+) \(comment\)\].* by.*'
+                      r'spacetelescope/github-issues-import' % target)
+
+
+def issue_was_migrated(issue, target=None):
+    """
+    Determine if the issue looks like it has already been migrated by this
+    script to the target repository (by default the first).
+
+    If the issue was migrated, it returns an `Issue` object representing
+    its migration destination; returns `False` otherwise.
+    """
+
+    target = target or config['global']['target']
+    migrated_re = migrated_issue_re(target)
+
+    for line in (issue['body'] or '').splitlines():
+        m = migrated_re.match(line)
+        if m:
+            return Issue(m.group(1), int(m.group(2)))
+
+    return False
+
+
+def make_issue_map(issues, new_issue_idx, target=None):
+    """
+    Create a map from issues in the source repositories to the issues they
+    will become in the target repository (by default the first); ``issues``
+    is a working set of source issues keyed on their `Issue`.
+
+    Issues that have already been migrated map to their existing migrated
+    issue; all others are assigned consecutive issue numbers starting from
+    ``new_issue_idx``, except those selected with --migrated (which were
+    migrated to another of the targets), which are left out of the map.
+    """
+
+    target = target or config['global']['target']
+    issue_map = new_working_set(target_working_set_name('issue_map', target),
+                                key_type=Issue, value_type=Issue)
+    for old, issue in issues.items():
+        migrated = issue_was_migrated(issue, target)
+        if migrated:
+            new = migrated
+        elif list(get_repository_option(old.repository, 'import-issues') or
+                  []) == ['migrated']:
+            continue
+        else:
+            new = Issue(target, new_issue_idx)
+            new_issue_idx += 1
+
+        issue_map[old] = new
+
+    return issue_map
+
+
+def fixup_cross_references(text, source_repo, issue_map):
+    """
+    Before inserting new issues into the target repository, this checks the
+    original issue body for references to other issues in the original
+    repository *or* issues in any of the other source repositories being
+    migrated from.
+
+    This can't reasonably update every existing reference to the original
+    issue, but it can ensure that all issue cross-references made in the new
+    issue are internally consistent.
+
+    This can also be used to update cross references in comments.
+    """
+
+    def repl_issue_reference(matchobj):
+        """
+        If a matched issue reference is to within the same repository,
+        it is updated to explictly reference the source repository (rather
+        than a 'bare' issue reference like '#42').  However, if the referenced
+        issue is one of the other issues being migrated, then it updates the
+        reference to point to the newly migrated issue.
+        """
+
+        repo = matchobj.group(1) or source_repo
+        issue_num = int(matchobj.group(2))
+
+        issue = Issue(repo, issue_num)
+
+        if issue in issue_map:
+            # Update to reference another issue being migrated to the target
+            # repository
+            return '#' + str(issue_map[issue][1])
+        else:
+            return str(issue)
+
+    return GH_ISSUE_REF_RE.sub(repl_issue_reference, text)
+
+
+def import_new_issue(new_issue, issue_map, target=None):
+    """
+    Perform actual migration of new issues, including updates to the original
+    source issue.
+    """
+
+    target = target or config['global']['target']
+    # Convert back to an Issue in case this was read from a DiskDict
+    old_issue = Issue(*new_issue['origin'])
+
+    if 'milestone_object' in new_issue:
+        new_issue['milestone'] = new_issue['milestone_object']['number']
+        del new_issue['milestone_object']
+
+    if 'label_objects' in new_issue:
         issue_labels = []
         for label in new_issue['label_objects']:
             issue_labels.append(label['name'])
         new_issue['labels'] = issue_labels
         del new_issue['label_objects']
 
-    result_issue = send_request(target, "issues", new_issue)
-    result_issue_id = Issue(target, result_issue['number'])
+    source_repo, number = old_issue
+
+    # With collapse-comments, as much of the discussion as fits goes into the
+    # body of the new issue, and the rest into as few comments as possible
+    chunks = None
+    if ('comments' in new_issue and
+            get_repository_option(source_repo, 'collapse-comments')):
+        comments = new_issue.pop('comments')
+        new_issue['body'], chunks = collapse_comments(
+                old_issue, comments, issue_map, new_issue['body'] or '')
+
+    with trace_span('create', issue=str(old_issue)):
+        result_issue = send_request(
+                target, "issues", new_issue,
+                recover=lambda: find_created_issue(target, new_issue))
+    result_issue_id = Issue(target, result_issue['number'])
+
+    close_issue = get_repository_option(source_repo, 'close-issues')
+
+    if close_issue:
+        close_message = '; the original issue will be closed'
+    else:
+        close_message = ''
+
+    print("Successfully created issue '%s'%s" % (result_issue['title'],
+                                                 close_message))
+
+    # Now update the original issue to mention the new issue.
+    update = {}
+    if close_issue:
+        update['state'] = 'closed'
+
+    def updated(orig_issue):
+        # Fingerprint the original issue as of after the update, so that the
+        # update itself does not count as a change next time
+        record_fingerprint(old_issue, target, issue=orig_issue)
+
+    def current():
+        orig_issue = get_issue_by_id(source_repo, int(number))
+        return orig_issue['body'], orig_issue.get('node_id')
+
+    url = 'issues/%s' % number
+    shared_issues.writing(old_issue)
+    with trace_span('backref', issue=str(old_issue)):
+        if get_repository_option(source_repo, 'create-backrefs'):
+            message = (
+                '*Migrated to %s by [spacetelescope/github-issues-import]'
+                '(https://github.com/spacetelescope/github-issues-import)*' %
+                str(result_issue_id))
+            updated_now = add_backref(old_issue, url, message, current,
+                                      update, updated)
+        else:
+            updated_now = update_source(source_repo, url, None, update,
+                                        updated)
+
+    if updated_now:
+        print("Updated original issue with mapping from %s -> %s" %
+              (old_issue, result_issue_id))
+    else:
+        print("Queued update of original issue with mapping from %s -> %s" %
+              (old_issue, result_issue_id))
+
+    if chunks is not None:
+        num_in_body = len(comments) - sum(n for _, n in chunks)
+        for _ in range(num_in_body):
+            progress.comment_done()
+
+        with trace_span('comments', issue=str(old_issue)):
+            result_comments = post_collapsed_comments(chunks, target,
+                                                      result_issue['number'])
+        print(" > Successfully added %d comments (%d in the issue body, the "
+              "rest in %d comments)." % (len(comments), num_in_body,
+                                        len(result_comments)))
+    elif 'comments' in new_issue:
+        with trace_span('comments', issue=str(old_issue)):
+            result_comments = import_comments(old_issue,
+                                              new_issue['comments'],
+                                              result_issue_id, issue_map)
+        print(" > Successfully added", len(result_comments), "comments.")
+
+    progress.issue_done()
+
+    # Return value is currently used only for debugging
+    return result_issue
+
+
+def import_updated_issue(orig_issue_id, issue_id, updates, issue_map):
+    """
+    Push updates to an existing issue, including any new comments.
+    """
+
+    comments = updates.pop('comments', [])
+
+    if 'milestone_object' in updates:
+        updates['milestone'] = updates['milestone_object']['number']
+
+    if 'new_labels' in updates:
+        issue_labels = []
+        for label in updates['label_objects']:
+            issue_labels.append(label['name'])
+        updates['labels'] = issue_labels
+        del updates['label_objects']
+        del updates['new_labels']
+
+    with trace_span('update', issue=str(orig_issue_id)):
+        result_issue = send_request(issue_id.repository,
+                                    'issues/%s' % issue_id.number, updates,
+                                    'PATCH')
+
+    print(" > Successfully updated", issue_map[orig_issue_id])
+
+    if comments:
+        with trace_span('comments', issue=str(orig_issue_id)):
+            result_comments = import_comments(orig_issue_id, comments,
+                                              issue_id, issue_map)
+        print(" > Successfully added", len(result_comments), "new comments.")
+
+    progress.issue_done()
+
+    return result_issue
+
+
+def make_new_issue(orig_issue_id, orig_issue, issue_map,
+                   defer_comments=False, render=True):
+    """
+    Returns a dict representing a new issue to be inserted into the target
+    repository, based on the source issue specified by orig_issue_id/orig_issue
+    as loaded from the source repo.
+
+    If ``defer_comments``, rather than fetching the comments on the issue just
+    their number is recorded (as ``deferred_comments``), for the comments to
+    be fetched later with `fetch_deferred_comments`.
+
+    Unless ``render``, the body of the new issue is not rendered yet; instead
+    the fields of the source issue needed to do so are recorded (as
+    ``unrendered``), for the issue to be rendered later with
+    `render_new_issue`.
+    """
+
+    repo = orig_issue['repository']
+    new_issue = {}
+    new_issue['origin'] = orig_issue_id
+    new_issue['title'] = orig_issue['title']
+
+    # Temporary fix for marking closed issues
+    if orig_issue['closed_at']:
+        new_issue['title'] = CLOSED_TITLE_PREFIX + new_issue['title']
+
+    import_assignee = get_repository_option(repo, 'import-assignee')
+    if import_assignee and orig_issue.get('assignee'):
+        new_issue['assignee'] = orig_issue['assignee']['login']
+
+    num_comments = int(orig_issue.get('comments', 0))
+    if (get_repository_option(repo, 'import-comments') and
+            num_comments != 0):
+        if defer_comments:
+            new_issue['deferred_comments'] = num_comments
+        else:
+            new_issue['comments'] = get_comments_on_issue(repo, orig_issue)
+
+    import_milestone = get_repository_option(repo, 'import-milestone')
+    if import_milestone and orig_issue.get('milestone') is not None:
+        # Since the milestones' ids are going to differ, we will compare
+        # them by title instead
+        new_issue['milestone_object'] = orig_issue['milestone']
+
+    import_labels = get_repository_option(repo, 'import-labels')
+    normalize_labels = get_repository_option(repo, 'normalize-labels')
+    if import_labels and orig_issue.get('labels') is not None:
+        new_issue['label_objects'] = []
+        for issue_label in orig_issue['labels']:
+            if normalize_labels:
+                issue_label['name'] = \
+                        normalize_label_name(issue_label['name'])
+
+            new_issue['label_objects'].append(issue_label)
+
+    if render:
+        orig_issue['body'] = fixup_cross_references(orig_issue['body'], repo,
+                                                    issue_map)
+        new_issue['body'] = render_issue_body(orig_issue)
+    else:
+        new_issue['unrendered'] = dict((field, orig_issue[field])
+                                       for field in RENDER_FIELDS
+                                       if field in orig_issue)
+
+    return new_issue
+
+
+def render_issue_body(orig_issue):
+    """
+    Render the body of the new issue for a source issue (whose body has had
+    its cross references fixed up already) with the issue or pull request
+    template.
+    """
+
+    repo = orig_issue['repository']
+
+    template_data = {}
+    template_data['user_name'] = orig_issue['user']['login']
+    template_data['user_url'] = orig_issue['user']['html_url']
+    template_data['user_avatar'] = orig_issue['user']['avatar_url']
+    template_data['date'] = format_date(orig_issue['created_at'])
+    template_data['url'] =  orig_issue['html_url']
+    template_data['body'] = orig_issue['body']
+    template_data['num_comments'] = int(orig_issue.get('comments', 0))
+
+    if get_repository_option(repo, 'create-backrefs'):
+        if ("pull_request" in orig_issue and
+                orig_issue['pull_request']['html_url'] is not None):
+            return format_pull_request(template_data)
+        else:
+            return format_issue(template_data)
+    else:
+        return orig_issue['body']
+
+
+def render_new_issue(new_issue, issue_map):
+    """
+    Render a new issue made by `make_new_issue` without rendering it, along
+    with its comments (if they were fetched already); returns the new issue.
+    This only depends on the issue map and the configuration, and may be done
+    in a separate process (see `render_new_issues`).
+    """
+
+    source_repo = new_issue['origin'][0]
+    orig_issue = new_issue.pop('unrendered', None)
+    if orig_issue is not None:
+        orig_issue['body'] = fixup_cross_references(orig_issue['body'],
+                                                    source_repo, issue_map)
+        new_issue['body'] = render_issue_body(orig_issue)
+
+    for comment in new_issue.get('comments', []):
+        comment['rendered'] = render_comment(comment, source_repo, issue_map)
+
+    return new_issue
+
+
+def init_render_worker(config_sections):
+    config.clear()
+    config.update(config_sections)
+
+
+def render_batch(batch, issue_map_items):
+    issue_map = dict((Issue(*old), Issue(*new))
+                     for old, new in issue_map_items)
+    return [render_new_issue(new_issue, issue_map) for new_issue in batch]
+
+
+# The numbers of the issues referenced in a text, however they are referenced
+# (see GH_ISSUE_REF_RE, which is far slower to search for)
+ISSUE_NUMBER_RE = re.compile(r'#([1-9]\d*)')
+
+
+def batch_issue_map(batch, issue_map):
+    """
+    Returns the entries of the issue map that may be needed to render a batch
+    of new issues, to send to a render worker along with the batch: those for
+    the issues in any of the source repositories with the numbers of issues
+    that their bodies and comments refer to.
+    """
+
+    numbers = set()
+    for new_issue in batch:
+        texts = [comment['body'] for comment in new_issue.get('comments', [])]
+        if 'unrendered' in new_issue:
+            texts.append(new_issue['unrendered']['body'] or '')
+        numbers.update(ISSUE_NUMBER_RE.findall('\n'.join(texts)))
+
+    entries = []
+    for repo in config['global']['sources']:
+        for number in numbers:
+            old = Issue(repo, int(number))
+            try:
+                entries.append((tuple(old), tuple(issue_map[old])))
+            except KeyError:
+                pass
+
+    return entries
+
 
-    source_repo, number = old_issue
-    close_issue = get_repository_option(source_repo, 'close-issues')
+def render_new_issues(new_issues, issue_map, workers):
+    """
+    Render all new issues in the ``new_issues`` working set (see
+    `render_new_issue`) in a pool of ``workers`` processes, each given a copy
+    of the configuration, replacing them with the rendered issues.  Rather
+    than the whole issue map (which may be kept on disk with --working-set),
+    each batch of issues is sent with only the entries it refers to.
+    """
 
-    if close_issue:
-        close_message = '; the original issue will be closed'
+    pending = deque()
+
+    def submit(keys, batch):
+        future = executor.submit(render_batch, batch,
+                                 batch_issue_map(batch, issue_map))
+        pending.append((keys, future))
+
+    def collect(max_pending):
+        while len(pending) > max_pending:
+            keys, future = pending.popleft()
+            for key, new_issue in zip(keys, future.result()):
+                new_issues[key] = new_issue
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_render_worker,
+            initargs=(dict(config),)) as executor:
+        keys = []
+        batch = []
+        for key, new_issue in new_issues.items():
+            keys.append(key)
+            batch.append(new_issue)
+            if len(batch) == RENDER_BATCH_SIZE:
+                submit(keys, batch)
+                keys = []
+                batch = []
+                # Limit the number of batches (and so the number of issues
+                # held in memory, with a DiskDict) waiting to be rendered
+                collect(workers * RENDER_QUEUE_DEPTH)
+
+        if batch:
+            submit(keys, batch)
+
+        collect(0)
+
+
+def fetch_deferred_comments(new_issue):
+    """
+    Fetch the comments on the original issue of a new issue made with
+    ``defer_comments`` (see `make_new_issue`), if any; returns the new issue.
+    """
+
+    num_comments = new_issue.pop('deferred_comments', 0)
+    if num_comments:
+        repo, number = new_issue['origin']
+        new_issue['comments'] = get_comments_on_issue(
+                repo, {'number': number, 'comments': num_comments})
+
+    return new_issue
+
+
+def pipelined(items, prepare, depth):
+    """
+    Returns an iterator over ``prepare(item)`` for each of ``items``, with
+    ``prepare`` called by a background thread running up to ``depth`` items
+    ahead of the consumer.  Errors raised in the background thread are
+    re-raised by the iterator.
+    """
+
+    results = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for item in items:
+                results.put((prepare(item), None))
+        except BaseException as error:
+            # Including the SystemExit from send_request, which would
+            # otherwise only end this thread
+            results.put((None, error))
+        else:
+            results.put((done, None))
+
+    threading.Thread(target=producer, name='prefetch', daemon=True).start()
+
+    while True:
+        result, error = results.get()
+        if error is not None:
+            raise error
+        elif result is done:
+            return
+
+        yield result
+
+
+# Note: This could also probably make use of the events API to determine
+# updates to the original issue, but directly comparing to the migrated issue
+# is just as easy, so...
+
+def make_updated_issue(orig_issue_id, orig_issue, issue_map, target=None):
+    """
+    Returns a dict containing updates to an issue that has already been
+    migrated once, determined by checking the original issue and seeing if
+    there are any new differences (including new comments on) the original
+    issue compared to the issue when it was first migrated.
+    """
+
+    target = target or config['global']['target']
+    repo = orig_issue_id.repository
+
+    migrated_issue_id = issue_map[orig_issue_id]
+    migrated_issue = get_issue_by_id(target, migrated_issue_id.number)
+
+    updated_issue = {}
+
+    if orig_issue['title'] != migrated_issue['title']:
+        updated_issue['title'] = orig_issue['title']
+
+    if get_repository_option(repo, 'import-assignee'):
+        orig_assignee = orig_issue.get('assignee') or {}
+        migrated_assignee = migrated_issue.get('assignee') or {}
+
+        if (orig_assignee.get('login') is not None and
+                orig_assignee.get('login') != migrated_assignee.get('login')):
+            updated_issue['assignee'] = orig_assignee['login']
+
+    if get_repository_option(repo, 'import-milestone'):
+        orig_milestone = orig_issue.get('milestone') or {}
+        migrated_milestone = migrated_issue.get('milestone') or {}
+
+        if (orig_milestone.get('title') is not None and
+                orig_milestone.get('title') != migrated_milestone.get('title')):
+            updated_issue['milestone_object'] = orig_milestone
+
+    normalize_labels = get_repository_option(repo, 'normalize-labels')
+    if get_repository_option(repo, 'import-labels'):
+        issue_labels = orig_issue['labels']
+        migrated_label_names = set(label['name'] for label in
+                                   migrated_issue.get('labels', []))
+        if normalize_labels:
+            for issue_label in issue_labels:
+                issue_label['name'] = \
+                        normalize_label_name(issue_label['name'])
+            migrated_label_names = set(normalize_label_name(name)
+                                       for name in migrated_label_names)
+
+        # Note: We will update any new labels added to the original issue
+        # by copying them over the the migrated issue.  However, if any
+        # labels were later *deleted* from the original issue we do not
+        # transfer the deletions over, which could have unintended
+        # consequences
+        new_labels = [label['name'] for label in issue_labels
+                      if label['name'] not in migrated_label_names]
+
+        # If there are no *new* labels then there is no need to update the
+        # labels at all.  Otherwise we still want to keep all the existing
+        # labels in the list of labels on this issue; when updating labels on
+        # an issue via the API it does not perform a union or anything like
+        # that--it's all or nothing.
+        if new_labels:
+            updated_issue['new_labels'] = new_labels
+            updated_issue['label_objects'] = list(issue_labels)
+
+    migrated_re = migrated_comment_re(target)
+
+    def comment_was_migrated(comment):
+        for line in comment['body'].splitlines():
+            if migrated_re.match(line):
+                return True
+
+        return False
+
+    if get_repository_option(repo, 'import-comments'):
+        update_comments = []
+        orig_comments = get_comments_on_issue(repo, orig_issue)
+
+        # Comments migrated with collapse-comments are not marked in the
+        # original comments, but in the migrated issue
+        collapsed_ids = set()
+        if orig_comments and get_repository_option(repo, 'collapse-comments'):
+            collapsed_ids = collapsed_comment_ids(target, migrated_issue)
+
+        # Note: This does *not* check for *edits* to comments that have already
+        # been migrated.  We could probably due it as well but there currently
+        # isn't any use case...
+        for comment in orig_comments:
+            if not (comment_was_migrated(comment) or
+                    (repo, comment['id']) in collapsed_ids):
+                update_comments.append(comment)
+
+        if update_comments:
+            updated_issue['comments'] = update_comments
+
+    return updated_issue
+
+
+class Catalog:
+    """
+    The milestones and labels known to exist in a target repository (or to
+    be created there), against which those used by the new or updated issues
+    are resolved by `resolve_milestones_and_labels`.
+
+    Milestones are matched by title, and labels by name (as normalized by
+    `get_labels` and `make_new_issue` with normalize-labels).  Since far
+    fewer distinct sets of labels are used than there are issues, each set
+    is resolved once and remembered, so that resolving the labels of an issue
+    is a single lookup.
+    """
+
+    def __init__(self, target):
+        self.milestones = get_milestones(target)
+        self.labels = get_labels(target)
+        self.label_sets = {}
+
+    def resolve(self, issue, new_milestones, new_labels):
+        """
+        Point the milestone and labels of a new or updated issue to the
+        target's copies, adding any not known yet to ``new_milestones`` and
+        ``new_labels``.
+        """
+
+        milestone = issue.get('milestone_object')
+        if milestone:
+            known_milestone = self.milestones.get(milestone['title'])
+            if not known_milestone:
+                # A copy, as its number in the target is filled in when it is
+                # created, and it may be shared with other targets' issues
+                known_milestone = dict(milestone)
+                new_milestones.append(known_milestone)
+                self.milestones[milestone['title']] = known_milestone
+
+            issue['milestone_object'] = known_milestone
+
+        labels = issue.get('label_objects')
+        if labels:
+            key = tuple([label['name'] for label in labels])
+            known_labels = self.label_sets.get(key)
+            if known_labels is None:
+                known_labels = self.label_sets[key] = []
+                for label in labels:
+                    known_label = self.labels.get(label['name'])
+                    if not known_label:
+                        known_label = self.labels[label['name']] = label
+                        new_labels.append(label)
+
+                    known_labels.append(known_label)
+
+            # Shared by all issues with this set of labels, which do not
+            # modify it
+            issue['label_objects'] = known_labels
+
+
+def resolve_milestones_and_labels(issues, catalog):
+    """
+    Match the milestones and labels used by the given new or updated issues
+    against the target repository's `Catalog`.
+
+    Issues referencing an existing milestone or label are updated in place to
+    point to the target's copy.  Any milestones or labels not yet known are
+    added to the catalog and returned as a pair of lists ``(new_milestones,
+    new_labels)`` that still need to be created.
+    """
+
+    new_milestones = []
+    new_labels = []
+
+    for issue in issues:
+        catalog.resolve(issue, new_milestones, new_labels)
+
+    return new_milestones, new_labels
+
+
+def import_milestones_and_labels(new_milestones, new_labels, target=None):
+    """
+    Create the milestones and labels returned by
+    `resolve_milestones_and_labels` in the target repository (by default the
+    first).
+    """
+
+    target = target or config['global']['target']
+    for milestone in new_milestones:
+        result_milestone = import_milestone(milestone, target)
+        milestone['number'] = result_milestone['number']
+        milestone['url'] = result_milestone['url']
+
+    for label in new_labels:
+        result_label = import_label(label, target)
+
+
+class ImportPlan:
+    """
+    The plan for importing the issues into one target repository, as made by
+    `plan_imports`: the new issues to create, the updates to make to issues
+    that were already migrated, and the milestones and labels to create for
+    them.
+    """
+
+    def __init__(self, target, issue_map):
+        self.target = target
+        self.issue_map = issue_map
+        self.catalog = Catalog(target)
+
+        self.new_issues = new_working_set(
+                target_working_set_name('new_issues', target), key_type=Issue)
+        self.updated_issues = new_working_set(
+                target_working_set_name('updated_issues', target),
+                key_type=Issue)
+        self.skipped_issues = new_working_set(
+                target_working_set_name('skipped_issues', target),
+                key_type=Issue)
+
+        self.num_new_comments = 0
+        self.num_updated = 0
+        self.num_unchanged = 0
+        self.new_milestones = []
+        self.new_labels = []
+        self.new_fingerprints = {}
+
+
+# Will only import milestones and issues that are in use by the imported
+# issues, and do not exist in the target repository
+def plan_imports(issues, plans):
+    """
+    Fill in the plans (see `ImportPlan`) for importing the given working set
+    of source issues into each of their targets.
+
+    Each issue is planned for all the targets in turn, so that with several
+    targets its comments are only held (see `SharedByTargets`) until all the
+    targets needing them have taken them.
+    """
+
+    for old_issue, issue in issues.items():
+        needed = []
+        for plan in plans:
+            kind = plan_kind(plan, old_issue, issue)
+            if kind is not None:
+                needed.append((plan, kind))
+
+        if len(plans) > 1 and needed:
+            shared_issues.expect(old_issue, len(needed))
+
+        for plan, kind in needed:
+            plan_issue(plan, old_issue, issue, kind)
+
+
+def plan_kind(plan, old_issue, issue):
+    """
+    Returns whether the source issue needs to be created in the plan's target
+    ('new') or an already migrated issue updated from it ('update'); or, if
+    neither, records it in the plan as skipped or unchanged and returns
+    `None`.
+    """
+
+    target = plan.target
+    if old_issue not in plan.issue_map:
+        # Selected with --migrated, but only migrated to other targets
+        return None
+
+    if not issue_was_migrated(issue, target):
+        return 'new'
+
+    if not get_repository_option(issue['repository'], 'update-existing'):
+        plan.skipped_issues[old_issue] = plan.issue_map[old_issue]
+        return None
+
+    fingerprint = issue_fingerprint(issue, target)
+    if fingerprints.get(fingerprint_key(old_issue, target)) == fingerprint:
+        # Nothing has changed since it was last migrated/updated
+        plan.updated_issues[old_issue] = {}
+        plan.num_unchanged += 1
+        return None
+
+    plan.new_fingerprints[old_issue] = fingerprint
+    return 'update'
+
+
+def plan_issue(plan, old_issue, issue, kind):
+    """
+    Add the new issue or the updates (as returned by `plan_kind`) for a
+    source issue to the plan.
+    """
+
+    if kind == 'update':
+        with trace_span('render', issue=str(old_issue)):
+            new_issue = make_updated_issue(old_issue, issue, plan.issue_map,
+                                           plan.target)
+        if new_issue:
+            plan.num_updated += 1
+        working_set = plan.updated_issues
+    else:
+        pipeline = config['global'].get('pipeline')
+        render_workers = int(config['global'].get('render-workers') or 0)
+        # Rendering rewrites the body of the issue it is given, which may be
+        # shared with the plans for other targets
+        with trace_span('render', issue=str(old_issue)):
+            new_issue = make_new_issue(old_issue, dict(issue), plan.issue_map,
+                                       defer_comments=pipeline,
+                                       render=not render_workers)
+        working_set = plan.new_issues
+
+    plan.num_new_comments += (len(new_issue.get('comments', [])) +
+                              new_issue.get('deferred_comments', 0))
+
+    # Find any new milestones or labels
+    milestones, labels = resolve_milestones_and_labels([new_issue],
+                                                       plan.catalog)
+    plan.new_milestones += milestones
+    plan.new_labels += labels
+
+    working_set[old_issue] = new_issue
+
+
+def print_plan(plan):
+    """Print what the given `ImportPlan` will do, for confirmation."""
+
+    issue_map = plan.issue_map
+    updated_issues = plan.updated_issues
+    skipped_issues = plan.skipped_issues
+
+    print("You are about to add to '%s':" % plan.target)
+    print(" *", len(plan.new_issues), "new issues:")
+
+    for old, new in issue_map.items():
+        if old in skipped_issues or old in updated_issues:
+            continue
+
+        print("   *", old, "->", new)
+
+    print(" *", plan.num_new_comments, "new comments")
+    print(" *", len(plan.new_milestones), "new milestones")
+    print(" *", len(plan.new_labels), "new labels")
+
+    if plan.num_unchanged:
+        print(" *", plan.num_unchanged, "already migrated issues are "
+              "unchanged since they were last updated")
+
+    # Unchanged issues are recorded with no updates
+    if any(updated_issues.values()):
+        print("The following issues that were already migrated will be "
+              "updated:")
+        for orig_issue_id, updates in updated_issues.items():
+            if not updates:
+                continue
+
+            print(" *", orig_issue_id, "->", issue_map[orig_issue_id])
+            if 'title' in updates:
+                print("   * Title updated to:", updates['title'])
+            if 'assignee' in updates:
+                print("   * Assignee updated to:", updates['assignee'])
+            if 'milestone_object' in updates:
+                print("   * Milestone update to:",
+                      updates['milestone_object']['title'])
+            if 'new_labels' in updates:
+                print("   * The following new labels will be added:")
+                for label in updates['new_labels']:
+                    print("     *", label)
+            if 'comments' in updates:
+                print("   *", str(len(updates['comments'])),
+                      "new comments added")
+
+    if skipped_issues:
+        print(" *", "The following issues look like they have already been "
+                    "migrated to the target repository by this script and "
+                    "will not be migrated:")
+        for key, issue in skipped_issues.items():
+            print ("   *", key)
+
+
+def run_import(plan):
+    """Carry out an `ImportPlan`."""
+
+    target = plan.target
+    issue_map = plan.issue_map
+    catalog = plan.catalog
+
+    import_milestones_and_labels(plan.new_milestones, plan.new_labels, target)
+
+    # Issues read back from a DiskDict hold copies of the milestones and labels
+    # that were just created; resolving them again against the now complete
+    # catalog picks up their numbers in the target repository
+    if config['global'].get('pipeline'):
+        # Fetch the comments on the next new issues while creating earlier ones
+        new_issue_values = pipelined(plan.new_issues.values(),
+                                     fetch_deferred_comments, PIPELINE_DEPTH)
+    else:
+        new_issue_values = plan.new_issues.values()
+
+    # With several targets, each releases its hold on the state shared
+    # between them (see plan_imports) once done with an issue, even if that
+    # failed
+    for new_issue in new_issue_values:
+        orig_issue_id = Issue(*new_issue['origin'])
+        try:
+            resolve_milestones_and_labels([new_issue], catalog)
+            result_issue = import_new_issue(new_issue, issue_map, target)
+        finally:
+            shared_issues.release(orig_issue_id)
+
+    for orig_issue_id, updated_issue in plan.updated_issues.items():
+        if orig_issue_id not in plan.new_fingerprints:
+            # Unchanged
+            continue
+
+        try:
+            if updated_issue:
+                resolve_milestones_and_labels([updated_issue], catalog)
+                result_issue = import_updated_issue(
+                        orig_issue_id, issue_map[orig_issue_id],
+                        updated_issue, issue_map)
+            record_fingerprint(orig_issue_id, target,
+                               plan.new_fingerprints[orig_issue_id])
+        finally:
+            shared_issues.release(orig_issue_id)
+
+
+def run_imports(plans):
+    """
+    Carry out the plans for each target; with several targets each is carried
+    out concurrently by its own thread, and if any of them fails the error is
+    re-raised here.
+    """
+
+    if len(plans) == 1:
+        return run_import(plans[0])
+
+    results = queue.Queue()
+
+    def writer(plan):
+        try:
+            run_import(plan)
+        except BaseException as error:
+            # Including the SystemExit from send_request, which would
+            # otherwise only end this thread
+            results.put(error)
+        else:
+            results.put(None)
+
+    for plan in plans:
+        threading.Thread(target=writer, args=(plan,),
+                         name='import ' + plan.target, daemon=True).start()
+
+    for _ in plans:
+        error = results.get()
+        if error is not None:
+            raise error
+
+
+def import_issues(issues, issue_maps):
+    """
+    Import the given working set of source issues into each of the target
+    repositories, given their issue maps (in the order of the targets).
+
+    The issues have only been fetched once; they are rendered for each target
+    separately (as their issue numbers differ), and after confirming the plans
+    for all of them the imports into each target run concurrently.
+    """
+
+    set_state(state.GENERATING)
+
+    plans = [ImportPlan(target, issue_map)
+             for target, issue_map in zip(config['global']['targets'],
+                                          issue_maps)]
+    plan_imports(issues, plans)
+
+    render_workers = int(config['global'].get('render-workers') or 0)
+    if render_workers and any(plan.new_issues for plan in plans):
+        set_state(state.RENDERING)
+        for plan in plans:
+            render_new_issues(plan.new_issues, plan.issue_map,
+                              render_workers)
+
+    set_state(state.IMPORT_CONFIRMATION)
+
+    for plan in plans:
+        print_plan(plan)
+
+    if not yes_no("Are you sure you wish to continue?"):
+        sys.exit()
+
+    set_state(state.IMPORTING)
+    progress.plan(sum(len(plan.new_issues) + plan.num_updated
+                      for plan in plans),
+                  sum(plan.num_new_comments for plan in plans))
+
+    try:
+        run_imports(plans)
+    finally:
+        # Make sure any queued backrefs are added even if the import was
+        # interrupted, as otherwise the issues migrated so far would not be
+        # recognized as such next time; likewise keep their fingerprints
+        source_updates.flush()
+        save_fingerprints()
+        # Anything still shared was left by an import that failed
+        shared_issues.clear()
+
+    set_state(state.IMPORT_COMPLETE)
+
+
+def last_page(headers):
+    """
+    Returns the number of the last page of a paginated response, from its
+    Link header; `None` if there is none.
+    """
+
+    match = re.search(r'<([^>]*)>;\s*rel="last"', headers.get('Link') or '')
+    if match is None:
+        return None
+
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(match.group(1)).query)
+    return int(query['page'][0]) if 'page' in query else None
+
+
+def fetch_all_issues(repos):
+    """
+    Fetch all issues (in any state) from each of the given repositories, with
+    the pages read concurrently: the first page from each repository is
+    fetched first, its Link header giving the number of pages, and then all
+    the remaining pages are fetched in parallel.  Returns a dict mapping each
+    repository to a list of its issues, in order of issue number.
+    """
+
+    def fetch_page(repo, page):
+        query = urllib.parse.urlencode({'state': 'all', 'direction': 'asc',
+                                        'per_page': VERIFY_PAGE_SIZE,
+                                        'page': page})
+        with trace_span('fetch', repository=repo, page=page):
+            return send_request(repo, 'issues?' + query, full_response=True)
+
+    def fetch_from(repo, page, pages=None):
+        # Fetch the given number of pages, or if that is not known, all the
+        # pages from the given page onwards
+        issues = []
+        while True:
+            response = fetch_page(repo, page)
+            issues.extend(response.body)
+            if (page == pages or pages is None and
+                    len(response.body) < VERIFY_PAGE_SIZE):
+                return issues
+            page += 1
+
+    with concurrent.futures.ThreadPoolExecutor(VERIFY_WORKERS) as executor:
+        first_pages = [(repo, executor.submit(fetch_page, repo, 1))
+                       for repo in repos]
+        pages = {}
+        for repo, future in first_pages:
+            response = future.result()
+            last = last_page(response.headers)
+            if last is not None:
+                rest = [executor.submit(fetch_from, repo, page, page)
+                        for page in range(2, last + 1)]
+            elif len(response.body) == VERIFY_PAGE_SIZE:
+                rest = [executor.submit(fetch_from, repo, 2)]
+            else:
+                rest = []
+            pages[repo] = (response.body, rest)
+
+        all_issues = {}
+        for repo in repos:
+            issues, rest = pages[repo]
+            for future in rest:
+                issues.extend(future.result())
+            for issue in issues:
+                issue['repository'] = repo
+            all_issues[repo] = issues
+
+    return all_issues
+
+
+def body_hash(body):
+    """A hash of the body of an issue, to compare it with another."""
+
+    return hashlib.sha1((body or '').strip().encode('utf-8')).hexdigest()
+
+
+def verify_migrated_issue(orig_issue_id, orig_issue, migrated_issue,
+                          issue_map):
+    """
+    Compare a migrated issue in the target repository with its original,
+    returning a list of descriptions of the differences found.
+    """
+
+    repo = orig_issue_id.repository
+    target = config['global']['target']
+    problems = []
+
+    # Render the issue as it would be migrated now, without the backref that
+    # was added to the original when it was migrated
+    backref_re = re.compile(r'^\*Migrated to %s#\d+ by.*'
+                            r'spacetelescope/github-issues-import.*$\n*' %
+                            re.escape(target), re.M)
+    orig_issue = dict(orig_issue, body=backref_re.sub('', orig_issue['body']
+                                                      or '', count=1))
+    expected = make_new_issue(orig_issue_id, orig_issue, issue_map,
+                              defer_comments=True)
+
+    # The original may have been closed since it was migrated (in particular
+    # by the migration itself, with close-issues), so the titles are compared
+    # without the prefix marking closed issues, and the states separately
+    def strip_closed(title):
+        if title.startswith(CLOSED_TITLE_PREFIX):
+            return title[len(CLOSED_TITLE_PREFIX):]
+        return title
+
+    if strip_closed(expected['title']) != strip_closed(migrated_issue['title']):
+        problems.append('title is %r rather than %r' %
+                        (migrated_issue['title'], expected['title']))
+
+    # Migrated issues are created open, marked as closed in their title if the
+    # original was closed at the time
+    if migrated_issue['title'].startswith(CLOSED_TITLE_PREFIX):
+        migrated_state = 'closed'
     else:
-        close_message = ''
+        migrated_state = migrated_issue['state']
+
+    if (orig_issue['state'] != migrated_state and
+            not (orig_issue['state'] == 'closed' and
+                 get_repository_option(repo, 'close-issues'))):
+        problems.append('state is %r rather than %r' %
+                        (migrated_state, orig_issue['state']))
+
+    body = migrated_issue['body'] or ''
+    collapse = get_repository_option(repo, 'collapse-comments')
+    if collapse:
+        # Drop the discussion appended to the body; if the original body was
+        # empty the discussion starts right away, without a separator
+        marker = COLLAPSED_COMMENT_MARKER.split('%')[0]
+        if body.startswith(marker):
+            body = ''
+        else:
+            body = body.split(COLLAPSED_COMMENT_SEPARATOR + marker)[0]
 
-    print("Successfully created issue '%s'%s" % (result_issue['title'],
-                                                 close_message))
+    if body_hash(body) != body_hash(expected['body']):
+        problems.append('body differs')
 
-    # Now update the original issue to mention the new issue.
-    update = {}
+    if (get_repository_option(repo, 'import-comments') and not collapse and
+            orig_issue['comments'] != migrated_issue['comments']):
+        problems.append('%d comments rather than %d' %
+                        (migrated_issue['comments'], orig_issue['comments']))
 
-    if get_repository_option(source_repo, 'create-backrefs'):
-        orig_issue = get_issue_by_id(source_repo, int(number))
-        message = (
-            '*Migrated to %s by [spacetelescope/github-issues-import]'
-            '(https://github.com/spacetelescope/github-issues-import)*' %
-            str(result_issue_id))
-        update['body'] = message + '\n\n' + orig_issue['body']
+    if 'label_objects' in expected:
+        expected_labels = set(label['name'] for label in
+                              expected['label_objects'])
+        labels = set(label['name'] for label in migrated_issue['labels'])
+        if get_repository_option(repo, 'normalize-labels'):
+            labels = set(normalize_label_name(label) for label in labels)
+        if labels != expected_labels:
+            problems.append('labels are [%s] rather than [%s]' %
+                            (', '.join(sorted(labels)),
+                             ', '.join(sorted(expected_labels))))
 
-    if close_issue:
-        update['state'] = 'closed'
+    if 'milestone_object' in expected:
+        milestone = (migrated_issue['milestone'] or {}).get('title')
+        if milestone != expected['milestone_object']['title']:
+            problems.append('milestone is %r rather than %r' %
+                            (milestone, expected['milestone_object']['title']))
 
-    send_request(source_repo, 'issues/%s' % number, update, 'PATCH')
-    print("Updated original issue with mapping from %s -> %s" %
-          (old_issue, result_issue_id))
+    return problems
 
-    if 'comments' in new_issue:
-        result_comments = import_comments(old_issue, new_issue['comments'],
-                                          result_issue['number'], issue_map)
-        print(" > Successfully added", len(result_comments), "comments.")
 
-    # Return value is currently used only for debugging
-    return result_issue
+def verify_migration():
+    """
+    Check all issues in the source repositories that were migrated to the
+    target repository against their migrated counterparts (see the --verify
+    option).  Returns the exit status: 1 if any mismatches were found.
+    """
 
+    set_state(state.FETCHING_ISSUES)
+    target = config['global']['target']
+    sources = config['global']['sources']
+    all_issues = fetch_all_issues(sources + [target])
+    target_issues = dict((issue['number'], issue)
+                         for issue in all_issues.pop(target))
 
-def import_updated_issue(orig_issue_id, issue_id, updates, issue_map):
+    set_state(state.VERIFYING)
+
+    # Pair the original and migrated issues through the backrefs
+    issue_map = OrderedDict()
+    orig_issues = OrderedDict()
+    for repo in sources:
+        for issue in all_issues[repo]:
+            migrated = issue_was_migrated(issue)
+            if migrated:
+                orig_issue_id = Issue(repo, issue['number'])
+                issue_map[orig_issue_id] = migrated
+                orig_issues[orig_issue_id] = issue
+
+    num_mismatches = 0
+    for orig_issue_id, orig_issue in orig_issues.items():
+        migrated_issue_id = issue_map[orig_issue_id]
+        migrated_issue = target_issues.get(migrated_issue_id.number)
+        if migrated_issue is None:
+            problems = ['migrated issue does not exist']
+        else:
+            problems = verify_migrated_issue(orig_issue_id, orig_issue,
+                                             migrated_issue, issue_map)
+
+        if problems:
+            num_mismatches += 1
+            print("MISMATCH: %s -> %s: %s" % (orig_issue_id,
+                                              migrated_issue_id,
+                                              '; '.join(problems)))
+
+    print("Verified %d migrated issues: %d mismatched" %
+          (len(orig_issues), num_mismatches))
+
+    set_state(state.COMPLETE)
+    return 1 if num_mismatches else 0
+
+
+# Distributed imports: a coordinator assigns the new issue numbers and splits
+# the new issues into shards in a shared directory; any number of workers
+# claim the shards (by renaming them, which is atomic) and write the rendered
+# issues back as payloads, which the coordinator creates in order.
+#
+#   DIR/plan.json      the issue map, written once all shards are in place
+#   DIR/shards/        shards not yet claimed by a worker
+#   DIR/claimed/       shards claimed by a worker, touched by the worker
+#                      after rendering each issue
+#   DIR/payloads/      rendered new issues, named by their position in order
+
+def write_json_atomically(filename, data):
     """
-    Push updates to an existing issue, including any new comments.
+    Write data as JSON to a file such that other processes only ever see
+    the complete file.
     """
 
-    comments = updates.pop('comments', [])
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
 
-    if 'milestone_object' in updates:
-        updates['milestone'] = updates['milestone_object']['number']
+    os.replace(tmp_filename, filename)
 
-    if 'new_labels' in updates:
-        issue_labels = []
-        for label in updates['label_objects']:
-            issue_labels.append(label['name'])
-        updates['labels'] = issue_labels
-        del updates['label_objects']
-        del updates['new_labels']
 
-    result_issue = send_request(issue_id.repository,
-                                'issues/%s' % issue_id.number, updates,
-                                'PATCH')
+def requeue_stale_shard(work_dir, seq):
+    """
+    If the shard with the new issue ``seq`` was claimed by a worker that has
+    made no progress on it for `SHARD_CLAIM_TIMEOUT` seconds (most likely
+    because it died), put the issues in it not rendered yet back for another
+    worker to claim.
+    """
 
-    print(" > Successfully updated", issue_map[orig_issue_id])
+    name = '%08d.json' % (seq - seq % SHARD_SIZE)
+    claimed_filename = os.path.join(work_dir, 'claimed', name)
+    try:
+        idle = time.time() - os.path.getmtime(claimed_filename)
+        if idle < SHARD_CLAIM_TIMEOUT:
+            return
 
-    if comments:
-        result_comments = import_comments(orig_issue_id, comments,
-                                          issue_id.number, issue_map)
-        print(" > Successfully added", len(result_comments), "new comments.")
+        with open(claimed_filename) as f:
+            shard = json.load(f)
+    except FileNotFoundError:
+        return
 
-    return result_issue
+    remaining = [[n, issue] for n, issue in shard
+                 if n >= seq and not os.path.exists(
+                     os.path.join(work_dir, 'payloads', '%08d.json' % n))]
+    write_json_atomically(os.path.join(work_dir, 'shards', name), remaining)
+    os.remove(claimed_filename)
+
+    print("WARNING: The worker that claimed batch %s has made no progress on "
+          "it for %d seconds; its remaining %d issues were put back for "
+          "another worker (run with --worker %s) to claim" %
+          (name, idle, len(remaining), work_dir))
 
 
-def make_new_issue(orig_issue_id, orig_issue, issue_map):
+def coordinate(work_dir, issues, issue_map):
     """
-    Returns a dict representing a new issue to be inserted into the target
-    repository, based on the source issue specified by orig_issue_id/orig_issue
-    as loaded from the source repo.
+    Perform the import as the coordinator of a distributed import (see the
+    --coordinate option), with the new issues rendered by workers.
     """
 
-    repo = orig_issue['repository']
-    new_issue = {}
-    new_issue['origin'] = orig_issue_id
-    new_issue['title'] = orig_issue['title']
+    target = config['global']['target']
+    plan_filename = os.path.join(work_dir, 'plan.json')
+    if os.path.exists(plan_filename):
+        sys.exit("ERROR: '%s' already contains the plan of an import" %
+                 work_dir)
 
-    # Temporary fix for marking closed issues
-    if orig_issue['closed_at']:
-        new_issue['title'] = "[CLOSED] " + new_issue['title']
+    if any(get_repository_option(repo, 'update-existing')
+           for repo in config['global']['sources']):
+        sys.exit("ERROR: --update-existing is not supported with "
+                 "--coordinate")
 
-    import_assignee = get_repository_option(repo, 'import-assignee')
-    if import_assignee and orig_issue.get('assignee'):
-        new_issue['assignee'] = orig_issue['assignee']['login']
+    set_state(state.IMPORT_CONFIRMATION)
 
-    num_comments = int(orig_issue.get('comments', 0))
-    if (get_repository_option(repo, 'import-comments') and
-            num_comments != 0):
-        new_issue['comments'] = get_comments_on_issue(repo, orig_issue)
+    new_issues = []
+    skipped_issues = []
+    num_comments = 0
+    for old_issue, issue in issues.items():
+        if issue_was_migrated(issue):
+            skipped_issues.append(old_issue)
+        else:
+            new_issues.append((old_issue, issue))
+            if get_repository_option(old_issue.repository, 'import-comments'):
+                num_comments += issue['comments']
 
-    import_milestone = get_repository_option(repo, 'import-milestone')
-    if import_milestone and orig_issue.get('milestone') is not None:
-        # Since the milestones' ids are going to differ, we will compare
-        # them by title instead
-        new_issue['milestone_object'] = orig_issue['milestone']
+    print("You are about to add to '%s':" % target)
+    print(" *", len(new_issues), "new issues:")
+    for old_issue, _ in new_issues:
+        print("   *", old_issue, "->", issue_map[old_issue])
+    print(" *", num_comments, "new comments")
 
-    import_labels = get_repository_option(repo, 'import-labels')
-    normalize_labels = get_repository_option(repo, 'normalize-labels')
-    if import_labels and orig_issue.get('labels') is not None:
-        new_issue['label_objects'] = []
-        for issue_label in orig_issue['labels']:
-            if normalize_labels:
-                issue_label['name'] = \
-                        normalize_label_name(issue_label['name'])
+    if skipped_issues:
+        print(" *", "The following issues look like they have already been "
+                    "migrated to the target repository by this script and "
+                    "will not be migrated:")
+        for old_issue in skipped_issues:
+            print("   *", old_issue)
 
-            new_issue['label_objects'].append(issue_label)
+    if not yes_no("Are you sure you wish to continue?"):
+        sys.exit()
 
-    orig_issue['body'] = fixup_cross_references(orig_issue['body'], repo,
-                                                issue_map)
+    for subdir in ('shards', 'claimed', 'payloads'):
+        os.makedirs(os.path.join(work_dir, subdir), exist_ok=True)
 
-    template_data = {}
-    template_data['user_name'] = orig_issue['user']['login']
-    template_data['user_url'] = orig_issue['user']['html_url']
-    template_data['user_avatar'] = orig_issue['user']['avatar_url']
-    template_data['date'] = format_date(orig_issue['created_at'])
-    template_data['url'] =  orig_issue['html_url']
-    template_data['body'] = orig_issue['body']
-    template_data['num_comments'] = num_comments
+    for start in range(0, len(new_issues), SHARD_SIZE):
+        shard = [[seq, issue] for seq, (_, issue) in
+                 enumerate(new_issues[start:start + SHARD_SIZE], start)]
+        write_json_atomically(os.path.join(work_dir, 'shards',
+                                           '%08d.json' % start), shard)
 
-    if get_repository_option(repo, 'create-backrefs'):
-        if ("pull_request" in orig_issue and
-                orig_issue['pull_request']['html_url'] is not None):
-            new_issue['body'] = format_pull_request(template_data)
-        else:
-            new_issue['body'] = format_issue(template_data)
-    else:
-        new_issue['body'] = orig_issue['body']
+    write_json_atomically(plan_filename, {
+        'issue_map': [list(old) + list(new) for old, new in issue_map.items()]
+    })
 
-    return new_issue
+    print("Waiting for workers (run with --worker %s) to render the issues" %
+          work_dir)
 
+    set_state(state.IMPORTING)
+    progress.plan(len(new_issues), num_comments)
 
-# Note: This could also probably make use of the events API to determine
-# updates to the original issue, but directly comparing to the migrated issue
-# is just as easy, so...
+    catalog = Catalog(target)
 
-def make_updated_issue(orig_issue_id, orig_issue, issue_map):
+    try:
+        for seq in range(len(new_issues)):
+            payload_filename = os.path.join(work_dir, 'payloads',
+                                            '%08d.json' % seq)
+            while not os.path.exists(payload_filename):
+                requeue_stale_shard(work_dir, seq)
+                time.sleep(WORK_DIR_POLL_INTERVAL)
+
+            with open(payload_filename) as f:
+                new_issue = json.load(f)
+
+            # Milestones and labels are created as they are first needed
+            new_milestones, new_labels = resolve_milestones_and_labels(
+                    [new_issue], catalog)
+            import_milestones_and_labels(new_milestones, new_labels)
+            import_new_issue(new_issue, issue_map)
+            os.remove(payload_filename)
+    finally:
+        source_updates.flush()
+        save_fingerprints()
+
+    set_state(state.IMPORT_COMPLETE)
+
+
+def run_worker(work_dir):
     """
-    Returns a dict containing updates to an issue that has already been
-    migrated once, determined by checking the original issue and seeing if
-    there are any new differences (including new comments on) the original
-    issue compared to the issue when it was first migrated.
+    Render new issues as a worker of a distributed import (see the --worker
+    option), until all shards of the plan have been claimed.
     """
 
-    target = config['global']['target']
-    repo = orig_issue_id.repository
+    plan_filename = os.path.join(work_dir, 'plan.json')
+    print("Waiting for the plan in '%s'" % work_dir)
+    while not os.path.exists(plan_filename):
+        time.sleep(WORK_DIR_POLL_INTERVAL)
 
-    migrated_issue_id = issue_map[orig_issue_id]
-    migrated_issue = get_issue_by_id(target, migrated_issue_id.number)
+    with open(plan_filename) as f:
+        plan = json.load(f)
 
-    updated_issue = {}
+    issue_map = OrderedDict(
+            (Issue(*entry[:2]), Issue(*entry[2:])) for entry in
+            plan['issue_map'])
 
-    if orig_issue['title'] != migrated_issue['title']:
-        updated_issue['title'] = orig_issue['title']
+    set_state(state.GENERATING)
 
-    if get_repository_option(repo, 'import-assignee'):
-        orig_assignee = orig_issue.get('assignee') or {}
-        migrated_assignee = migrated_issue.get('assignee') or {}
+    shards_dir = os.path.join(work_dir, 'shards')
+    claimed_dir = os.path.join(work_dir, 'claimed')
+    num_shards = 0
+    num_issues = 0
 
-        if (orig_assignee.get('login') is not None and
-                orig_assignee.get('login') != migrated_assignee.get('login')):
-            updated_issue['assignee'] = orig_assignee['login']
+    while True:
+        names = sorted(os.listdir(shards_dir))
+        if not names:
+            break
 
-    if get_repository_option(repo, 'import-milestone'):
-        orig_milestone = orig_issue.get('milestone') or {}
-        migrated_milestone = migrated_issue.get('milestone') or {}
+        for name in names:
+            claimed_filename = os.path.join(claimed_dir, name)
+            try:
+                os.rename(os.path.join(shards_dir, name), claimed_filename)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
 
-        if (orig_milestone.get('title') is not None and
-                orig_milestone.get('title') != migrated_milestone.get('title')):
-            updated_issue['milestone_object'] = orig_milestone
+            with open(claimed_filename) as f:
+                shard = json.load(f)
+
+            for seq, issue in shard:
+                old_issue = Issue(issue['repository'], issue['number'])
+                with trace_span('render', issue=str(old_issue)):
+                    new_issue = render_new_issue(
+                            make_new_issue(old_issue, issue, issue_map,
+                                           render=False), issue_map)
+                write_json_atomically(os.path.join(work_dir, 'payloads',
+                                                   '%08d.json' % seq),
+                                      new_issue)
+                num_issues += 1
+
+                # Show the coordinator that this batch is still being worked
+                # on (see requeue_stale_shard)
+                try:
+                    os.utime(claimed_filename)
+                except FileNotFoundError:
+                    print("Batch %s was put back for another worker after "
+                          "making no progress for too long" % name)
+                    break
+            else:
+                num_shards += 1
+                print("Rendered batch %s (%d issues)" % (name, len(shard)))
 
-    normalize_labels = get_repository_option(repo, 'normalize-labels')
-    if get_repository_option(repo, 'import-labels'):
-        for issue_label in orig_issue['labels']:
-            if normalize_labels:
-                issue_label['name'] = \
-                        normalize_label_name(issue_label['name'])
+    print("Rendered %d issues in %d batches" % (num_issues, num_shards))
+    set_state(state.COMPLETE)
 
-            # Note: We will update any new labels added to the original issue
-            # by copying them over the the migrated issue.  However, if any
-            # labels were later *deleted* from the original issue we do not
-            # transfer the deletions over, which could have unintended
-            # consequences
-            for label in migrated_issue.get('labels', []):
-                if normalize_labels:
-                    migrated_label_name = normalize_label_name(label['name'])
-                else:
-                    migrated_label_name = label['name']
 
-                if migrated_label_name == issue_label['name']:
-                    break
-            else:
-                # This label is newly applied to the issue since it was
-                # migrated
-                if 'new_labels' not in updated_issue:
-                    updated_issue['new_labels'] = []
+# Continuous mirroring: rather than performing a one-off import, listen for
+# webhook events from the source repositories and apply each one to the target
+# repository incrementally.
 
-                updated_issue['new_labels'].append(issue_label['name'])
+class EventQueue:
+    """
+    A queue of source issues with pending webhook events.
 
-            # We still want to keep all the existing labels in the list of
-            # labels on this issue; when updating labels on an issue via the
-            # API it does not perform a union or anything like that--it's all
-            # or nothing.
-            if 'label_objects' not in updated_issue:
-                updated_issue['label_objects'] = []
+    Events are coalesced per issue: an issue only becomes ready once no new
+    events have arrived for it for ``delay`` seconds (or once it has been
+    pending for ``max_delay`` seconds, so that a steady stream of events cannot
+    postpone it indefinitely).  A burst of events on the same issue (an edit,
+    a relabel and two comments, say) then results in a single update.
+    """
 
-            updated_issue['label_objects'].append(issue_label)
+    def __init__(self, delay, max_delay=None):
+        self.delay = delay
+        self.max_delay = max_delay if max_delay is not None else 10 * delay
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
 
-        # If there are no *new* labels then there is no need to update the
-        # labels at all, so delete the label_objects list
-        if ('new_labels' not in updated_issue and
-                'label_objects' in updated_issue):
-            del updated_issue['label_objects']
+    def put(self, issue_id):
+        now = time.monotonic()
+        with self.cond:
+            first_seen, _ = self.pending.pop(issue_id, (now, None))
+            ready_at = min(now + self.delay, first_seen + self.max_delay)
+            self.pending[issue_id] = (first_seen, ready_at)
+            self.cond.notify()
 
-    migrated_re = re.compile(
-            r'^\*Migrated to \[(%s)#(\d+) \(comment\)\].* by.*'
-            r'spacetelescope/github-issues-import' % target)
+    def get(self):
+        """Block until an issue is ready to be mirrored and return it."""
 
-    def comment_was_migrated(comment):
-        for line in comment['body'].splitlines():
-            if migrated_re.match(line):
-                return True
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for issue_id, (_, ready_at) in self.pending.items():
+                    if ready_at <= now:
+                        del self.pending[issue_id]
+                        return issue_id
 
-        return False
+                    if timeout is None or ready_at - now < timeout:
+                        timeout = ready_at - now
 
-    if get_repository_option(repo, 'import-comments'):
-        update_comments = []
-        orig_comments = get_comments_on_issue(repo, orig_issue)
+                self.cond.wait(timeout)
 
-        # Note: This does *not* check for *edits* to comments that have already
-        # been migrated.  We could probably due it as well but there currently
-        # isn't any use case...
-        for comment in orig_comments:
-            if not comment_was_migrated(comment):
-                update_comments.append(comment)
 
-        if update_comments:
-            updated_issue['comments'] = update_comments
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Accepts GitHub webhook deliveries and queues the issues they refer to on
+    ``self.server.events``.  Only ``issues`` and ``issue_comment`` events for
+    one of the configured source repositories are acted on; everything else is
+    acknowledged and ignored.
+    """
 
-    return updated_issue
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+
+        if not self.verify_signature(payload):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        event = self.headers.get('X-GitHub-Event')
+        try:
+            data = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        issue_id = None
+        if event in ('issues', 'issue_comment'):
+            repo = data.get('repository', {}).get('full_name', '').lower()
+            issue = data.get('issue') or {}
+            if repo in config['global']['sources'] and 'number' in issue:
+                issue_id = Issue(repo, issue['number'])
+
+        if issue_id is not None:
+            print("Received '%s' event for %s" % (event, issue_id))
+            self.server.events.put(issue_id)
+            self.send_response(202)
+        else:
+            self.send_response(204)
 
+        self.end_headers()
 
-# Will only import milestones and issues that are in use by the imported
-# issues, and do not exist in the target repository
-def import_issues(issues, issue_map):
-    state.current = state.GENERATING
+    def verify_signature(self, payload):
+        secret = config['global'].get('webhook-secret')
+        if not secret:
+            return True
 
-    target = config['global']['target']
-    known_milestones = get_milestones(target)
-    known_labels = get_labels(target)
+        signature = self.headers.get('X-Hub-Signature-256', '')
+        expected = 'sha256=' + hmac.new(secret.encode('utf-8'), payload,
+                                        hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, expected)
 
-    new_issues = []
-    updated_issues = OrderedDict()
-    skipped_issues = OrderedDict()
+    def log_message(self, format, *args):
+        # Received events are already reported when they are queued
+        pass
 
-    num_new_comments = 0
-    new_milestones = []
-    new_labels = []
 
-    for issue, old_issue in zip(issues, issue_map):
-        repo = issue['repository']
+def issue_selected(issue, selection):
+    """
+    Returns `True` if the given source issue is included by an issue selection
+    (the 'import-issues' option: 'all', 'open', 'closed', 'migrated', or a list
+    of issue numbers).
+    """
 
-        if issue['migrated']:
-            if get_repository_option(repo, 'update-existing'):
-                updated_issues[old_issue] = \
-                        make_updated_issue(old_issue, issue, issue_map)
-            else:
-                skipped_issues[old_issue] = issue
-                continue
+    if len(selection) == 1 and selection[0] in ('all', 'open', 'closed',
+                                                'migrated'):
+        if selection[0] == 'all':
+            return True
+        elif selection[0] == 'migrated':
+            return bool(issue_was_migrated(issue))
         else:
-            new_issues.append(make_new_issue(old_issue, issue, issue_map))
+            return issue['state'] == selection[0]
 
-    for issue in new_issues + list(updated_issues.values()):
-        num_new_comments += len(issue.get('comments', []))
-        # Find any new milestones or labels
-        milestone = issue.get('milestone_object')
-        if milestone:
-            known_milestone = known_milestones.get(milestone['title'])
-            if not known_milestone:
-                new_milestones.append(milestone)
-                known_milestones[milestone['title']] = milestone
-            else:
-                issue['milestone_object'] = known_milestone
-
-        labels = issue.get('label_objects', [])
-        for idx, label in enumerate(labels):
-            known_label = known_labels.get(label['name'])
-            if not known_label:
-                new_labels.append(label)
-                known_labels[label['name']] = label
-            else:
-                issue['label_objects'][idx] = known_label
+    return issue['number'] in [int(issue_id) for issue_id in selection]
 
-    state.current = state.IMPORT_CONFIRMATION
 
-    print("You are about to add to '%s':" % target)
-    print(" *", len(new_issues), "new issues:")
+def get_next_issue_number(repo):
+    """
+    Returns the number that the next issue created in the repository will
+    receive.
+    """
 
-    for old, new in issue_map.items():
-        if old in skipped_issues or old in updated_issues:
-            continue
+    query = urllib.parse.urlencode({'state': 'all', 'sort': 'created',
+                                    'direction': 'desc', 'per_page': 1})
+    latest = send_request(repo, 'issues?' + query)
+    if not latest:
+        return 1
 
-        print("   *", old, "->", new)
+    return latest[0]['number'] + 1
 
-    print(" *", num_new_comments, "new comments")
-    print(" *", len(new_milestones), "new milestones")
-    print(" *", len(new_labels), "new labels")
 
-    if updated_issues:
-        print("The following issues that were already migrated will be "
-              "updated:")
-        for orig_issue_id, updates in updated_issues.items():
-            if not updates:
-                continue
+def mirror_issue(orig_issue_id, issue_map, catalog):
+    """
+    Bring the target repository up to date with a single source issue, either
+    by migrating it if it was not migrated yet, or otherwise by pushing any
+    updates to the already migrated issue (as with --update-existing).
+    """
 
-            print(" *", orig_issue_id, "->", issue_map[orig_issue_id])
-            if 'title' in updates:
-                print("   * Title updated to:", updates['title'])
-            if 'assignee' in updates:
-                print("   * Assignee updated to:", updates['assignee'])
-            if 'milestone_object' in updates:
-                print("   * Milestone update to:",
-                      updates['milestone_object']['title'])
-            if 'new_labels' in updates:
-                print("   * The following new labels will be added:")
-                for label in updates['new_labels']:
-                    print("     *", label)
-            if 'comments' in updates:
-                print("   *", str(len(updates['comments'])),
-                      "new comments added")
+    target = config['global']['target']
+    repo = orig_issue_id.repository
 
-    if skipped_issues:
-        print(" *", "The following issues look like they have already been "
-                    "migrated to the target repository by this script and "
-                    "will not be migrated:")
-        for key, issue in skipped_issues.items():
-            print ("   *", key)
+    orig_issue = get_issue_by_id(repo, orig_issue_id.number)
+    selection = get_repository_option(repo, 'import-issues') or ['all']
+    if not (issue_selected(orig_issue, selection) and
+            issue_matches_filters(orig_issue, get_issue_filters(repo))):
+        return
+
+    migrated = issue_was_migrated(orig_issue)
+    if migrated:
+        issue_map[orig_issue_id] = migrated
+
+        # This is often just the echo of our own update to the original issue
+        fingerprint = issue_fingerprint(orig_issue)
+        if fingerprints.get(str(orig_issue_id)) == fingerprint:
+            return
+
+        updates = make_updated_issue(orig_issue_id, orig_issue, issue_map)
+        if updates:
+            new_milestones, new_labels = resolve_milestones_and_labels(
+                    [updates], catalog)
+            import_milestones_and_labels(new_milestones, new_labels)
+            import_updated_issue(orig_issue_id, migrated, updates, issue_map)
+
+        fingerprints[str(orig_issue_id)] = fingerprint
+    else:
+        issue_map[orig_issue_id] = Issue(target, get_next_issue_number(target))
+        new_issue = make_new_issue(orig_issue_id, orig_issue, issue_map)
 
-    if not yes_no("Are you sure you wish to continue?"):
-        sys.exit()
+        new_milestones, new_labels = resolve_milestones_and_labels(
+                [new_issue], catalog)
+        import_milestones_and_labels(new_milestones, new_labels)
+        result_issue = import_new_issue(new_issue, issue_map)
+        issue_map[orig_issue_id] = Issue(target, result_issue['number'])
 
-    state.current = state.IMPORTING
 
-    for milestone in new_milestones:
-        result_milestone = import_milestone(milestone)
-        milestone['number'] = result_milestone['number']
-        milestone['url'] = result_milestone['url']
+def run_daemon(listen):
+    """
+    Run the continuous mirroring daemon, listening for webhooks on ``listen``
+    (given as either ``PORT`` or ``HOST:PORT``) until interrupted.
+    """
 
-    for label in new_labels:
-        result_label = import_label(label)
+    target = config['global']['target']
 
-    for new_issue in new_issues:
-        result_issue = import_new_issue(new_issue, issue_map)
+    host, _, port = listen.rpartition(':')
+    host = host or 'localhost'
 
-    for orig_issue_id, updated_issue in updated_issues.items():
-        if not updated_issue:
-            continue
+    # Seed the issue map with all previously migrated issues (found with the
+    # search API rather than fetching every issue), so that cross-references
+    # to them in newly mirrored issues and comments are rewritten correctly
+    set_state(state.FETCHING_ISSUES)
+    issue_map = OrderedDict()
+    for repo in config['global']['sources']:
+        for issue in iter_migrated_issues(repo, {}):
+            issue_map[Issue(repo, issue['number'])] = issue_was_migrated(issue)
 
-        result_issue = import_updated_issue(orig_issue_id,
-                                            issue_map[orig_issue_id],
-                                            updated_issue, issue_map)
+    catalog = Catalog(target)
 
-    state.current = state.IMPORT_COMPLETE
+    delay = config['global'].get('coalesce-delay')
+    events = EventQueue(5.0 if delay is None else float(delay))
+
+    def worker():
+        while True:
+            orig_issue_id = events.get()
+            try:
+                mirror_issue(orig_issue_id, issue_map, catalog)
+                source_updates.flush()
+                save_fingerprints()
+            except (Exception, SystemExit) as exc:
+                # Errors in send_request exit the script; in daemon mode a
+                # failure should only affect the one event
+                print("ERROR: Failed to mirror %s:\n%s" % (orig_issue_id,
+                                                            exc))
+
+    server = http.server.HTTPServer((host, int(port)), WebhookHandler)
+    server.events = events
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    set_state(state.IMPORTING)
+    print("Mirroring %s to '%s'; listening for webhooks on %s:%s" %
+          (', '.join(config['global']['sources']), target, host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    set_state(state.COMPLETE)
 
 
 def get_username(question):
@@ -1148,95 +5486,86 @@ def yes_no(question, default=True):
 
 
 def main(argv):
-    state.current = state.LOADING_CONFIG
+    set_state(state.LOADING_CONFIG)
 
     init_config(argv)
+    start_tracing()
+    progress.start()
+    memory.start()
+    open_http_cache()
+    get_transport()
+    load_fingerprints()
 
-    target = config['global']['target']
-
-    migrated_re = re.compile(
-            r'^\*Migrated to (%s)#(\d+) by.*'
-            r'spacetelescope/github-issues-import' % target)
-
-    # Determine if any of the found issues have already been migrated and mark
-    # them if such.  Already migrated issues will be ignored unless the
-    # update-existing option is set.
-
-    def issue_was_migrated(issue):
-        """
-        Determine if the issue looks like it has already been migrated by this
-        script.
-
-        If the issue was migrated, it returns an `Issue` object representing
-        its migration destination; returns `False` otherwise.
-        """
+    if config['global'].get('listen'):
+        return run_daemon(config['global']['listen'])
 
-        for line in issue['body'].splitlines():
-            m = migrated_re.match(line)
-            if m:
-                return Issue(m.group(1), int(m.group(2)))
+    if config['global'].get('verify'):
+        return verify_migration()
 
-        return False
+    if config['global'].get('worker'):
+        return run_worker(config['global']['worker'])
 
-    state.current = state.FETCHING_ISSUES
+    set_state(state.FETCHING_ISSUES)
     # Argparser will prevent us from getting both issue ids and specifying
     # issue state, so no duplicates will be added
-    issues = []
-    for repo in config['global']['sources']:
-        issues_to_import = get_repository_option(repo, 'import-issues')
-
-        if (len(issues_to_import) == 1 and
-                issues_to_import[0] in ('all', 'open', 'closed')):
-            issues += get_issues(repo, state=issues_to_import[0])
-        elif len(issues_to_import) == 1 and issues_to_import[0] == 'migrated':
-            for issue in get_issues(repo, state='all'):
-                if issue_was_migrated(issue):
-                    issues.append(issue)
-        else:
-            issues += get_issues_by_id(repo, issues_to_import)
+    issues = new_working_set('issues', key_type=Issue,
+                             sort_key=issue_sort_key)
+    snapshot = config['global'].get('snapshot')
+    if snapshot and os.path.exists(snapshot):
+        print("Loading issues from snapshot '%s'" % snapshot)
+        source_issues = load_snapshot(snapshot, config['global']['sources'])
+    else:
+        source_issues = iter_source_issues(config['global']['sources'])
+        if snapshot:
+            source_issues = save_snapshot(snapshot, source_issues)
 
-    # Sort issues from all repositories
-    def sort_key(issue):
-        # Sort chronologically first, then if there there is an overlap there
-        # (the API only offers second-level resolution) sort also by issue
-        # number so that issues created in the same second in the same
-        # repository should still be inserted in the correct order)
-        created = datetime.strptime(issue['created_at'], ISO_8601_UTC)
-        return (created, issue['number'])
-
-    issues.sort(key=sort_key)
-
-    # Get all issues in the target repository; obviously if issues are created
-    # in the target repo before the script is finished running this list will
-    # be inaccurate; later we will warn the user to lock down the target (and
-    # source) repos before merging in order to prevent this
-    # TODO: I wonder if this lockdown could actually be done via the API?
-    target_issues = get_issues(target)
-    # Annoyingly, the GitHub API does not have a way to ask for a simple count
-    # of issues; instead we have to download all the issues in full in order to
-    # count them
-
-    # Create a map from issues in the source repositories to the issues they
-    # will become in the new repository
-    new_issue_idx = len(target_issues) + 1
-    issue_map = OrderedDict()
-    for issue in issues:
-        migrated = issue['migrated'] = issue_was_migrated(issue)
-        old = Issue(issue['repository'], issue['number'])
-        if migrated:
-            new = migrated
-        else:
-            new = Issue(target, new_issue_idx)
-            new_issue_idx += 1
+    for repo, issue in source_issues:
+        issues[Issue(repo, issue['number'])] = issue
+        memory.record('issues', issue)
 
-        issue_map[old] = new
+    # Sort issues from all repositories
+    issues = sort_working_set(issues, issue_sort_key)
+
+    if config['global'].get('select'):
+        issues = select_issues(issues, config['global']['select'])
+
+    issue_maps = []
+    for target in config['global']['targets']:
+        # Count all issues in the target repository; obviously if issues are
+        # created in the target repo before the script is finished running
+        # this count will be inaccurate; later we will warn the user to lock
+        # down the target (and source) repos before merging in order to
+        # prevent this
+        # TODO: I wonder if this lockdown could actually be done via the API?
+        num_target_issues = sum(1 for issue in iter_issues(target))
+        # Annoyingly, the GitHub API does not have a way to ask for a simple
+        # count of issues; instead we have to download all the issues in full
+        # in order to count them
+
+        # Create a map from issues in the source repositories to the issues
+        # they will become in the new repository
+        issue_maps.append(make_issue_map(issues, num_target_issues + 1,
+                                         target))
 
     # Further states defined within the function
-    # Finally, add these issues to the target repository
-    import_issues(issues, issue_map)
+    # Finally, add these issues to the target repositories
+    if config['global'].get('coordinate'):
+        coordinate(config['global']['coordinate'], issues, issue_maps[0])
+    else:
+        import_issues(issues, issue_maps)
 
-    state.current = state.COMPLETE
+    set_state(state.COMPLETE)
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv[1:]))
+    try:
+        status = main(sys.argv[1:])
+    except KeyboardInterrupt:
+        if memory.exceeded is None:
+            raise
+        status = None
+
+    if memory.exceeded is not None:
+        memory.abort()
+
+    sys.exit(status)